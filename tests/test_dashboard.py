@@ -3,13 +3,71 @@ import urllib
 import csv
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.web.client import getPage
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.protocol import Protocol
+from twisted.web.client import getPage, Agent
+from twisted.web import error
+from twisted.python.failure import Failure
 
 from vumi.tests.utils import PersistenceMixin
 
 from vxpolls.manager import PollManager
-from vxpolls.dashboard import PollDashboardServer
+from vxpolls.dashboard import (
+    PollDashboardServer, PollLiveResultsResource, PollTimeSeriesResource,
+    ChangeSubscriberFactory)
+
+
+class EventStreamProtocol(Protocol):
+
+    def __init__(self):
+        self.events = []
+        self.ids = []
+        self.comments = []
+        self.buffer = ''
+        self.waiting = None
+
+    def dataReceived(self, data):
+        self.buffer += data
+        while '\n\n' in self.buffer:
+            event, self.buffer = self.buffer.split('\n\n', 1)
+            if event.startswith(':'):
+                self.comments.append(event[1:].strip())
+                continue
+            fields = dict(line.split(': ', 1) for line in event.split('\n'))
+            self.events.append((fields['event'], json.loads(fields['data'])))
+            self.ids.append(int(fields['id']))
+        self.check_waiting()
+
+    def check_waiting(self):
+        if self.waiting is not None and self.waiting[0]():
+            d, self.waiting = self.waiting[1], None
+            d.callback(self.events)
+
+    def wait_for(self, condition):
+        d = Deferred()
+        self.waiting = (condition, d)
+        self.check_waiting()
+        return d
+
+    def wait_for_events(self, count):
+        return self.wait_for(lambda: len(self.events) >= count)
+
+    def wait_for_comments(self, count):
+        return self.wait_for(lambda: len(self.comments) >= count)
+
+
+class FakeRequest(object):
+
+    def __init__(self):
+        self.written = []
+        self.finished = False
+
+    def write(self, data):
+        self.written.append(data)
+
+    def finish(self):
+        self.finished = True
 
 
 class PollDashboardTestCase(PersistenceMixin, TestCase):
@@ -32,7 +90,7 @@ class PollDashboardTestCase(PersistenceMixin, TestCase):
     def setUp(self):
         yield self._persist_setUp()
         self.redis = yield self.get_redis_manager()
-        self.poll_manager = PollManager(self.redis)
+        self.poll_manager = yield self.get_poll_manager()
         self.poll = yield self.poll_manager.register(self.poll_id, {
             'questions': self.questions,
         })
@@ -52,12 +110,17 @@ class PollDashboardTestCase(PersistenceMixin, TestCase):
                                         'port': 0,
                                         'path': '',
                                         'collection_id': self.poll_id,
-                                        'question': self.questions[0]['copy']
+                                        'question': self.questions[0]['copy'],
+                                        'column_question':
+                                            self.questions[2]['copy'],
                                     })
         yield self.service.startService()
         addr = self.service.webserver.getHost()
         self.url = "http://%s:%s/" % (addr.host, addr.port)
 
+    def get_poll_manager(self):
+        return PollManager(self.redis)
+
     @inlineCallbacks
     def tearDown(self):
         yield self.poll_manager.stop()
@@ -76,6 +139,21 @@ class PollDashboardTestCase(PersistenceMixin, TestCase):
                                 timeout=1)
         returnValue(csv.reader(data))
 
+    @inlineCallbacks
+    def register_poll(self, **config):
+        config['questions'] = self.questions
+        self.poll = yield self.poll_manager.register(self.poll_id, config)
+
+    @inlineCallbacks
+    def assert_route_error(self, code, route, **kwargs):
+        try:
+            yield self.get_route_json(route, **kwargs)
+        except error.Error, e:
+            self.assertEqual(e.status, str(code))
+            returnValue(json.loads(e.response))
+        else:
+            self.fail('Expected a %s from %s' % (code, route))
+
     @inlineCallbacks
     def submit_answers(self, *answers, **kwargs):
         for answer in answers:
@@ -105,6 +183,31 @@ class PollDashboardTestCase(PersistenceMixin, TestCase):
             ]
         })
 
+    @inlineCallbacks
+    def test_crosstab_output(self):
+        yield self.submit_answers('red', 'orange', 'apple', user_id='user-1')
+        yield self.submit_answers('red', 'black', 'orange', user_id='user-2')
+        data = yield self.get_route_json('crosstab',
+            collection_id=self.poll_id,
+            row=self.questions[0]['copy'],
+            column=self.questions[2]['copy'],
+        )
+        self.assertEqual(data, {
+            'row': self.questions[0]['copy'],
+            'column': self.questions[2]['copy'],
+            'results': {
+                'red': {'apple': 1, 'orange': 1},
+                'green': {'apple': 0, 'orange': 0},
+                'blue': {'apple': 0, 'orange': 0},
+            },
+        })
+
+    @inlineCallbacks
+    def test_instructions(self):
+        data = yield getPage(self.url + 'index.html', timeout=1)
+        self.assertTrue('row=%s&amp;column=%s' % (
+            self.questions[0]['copy'], self.questions[2]['copy']) in data)
+
     @inlineCallbacks
     def test_active_output(self):
         starting_output = [
@@ -130,6 +233,153 @@ class PollDashboardTestCase(PersistenceMixin, TestCase):
             "item": updated_output,
         })
 
+    @inlineCallbacks
+    def test_respondents_output(self):
+        yield self.register_poll(count_respondents=True)
+        yield self.submit_answers('red', 'orange', user_id='user-1')
+        yield self.submit_answers('red', user_id='user-2')
+        data = yield self.get_route_json('respondents',
+                                         collection_id=self.poll_id)
+        self.assertEqual(data, {
+            "item": [
+                {"value": 2, "text": "Respondents"},
+                {"value": 2, "text": "Today"},
+            ]
+        })
+
+    @inlineCallbacks
+    def test_respondents_not_counted(self):
+        data = yield self.assert_route_error(400, 'respondents',
+                                             collection_id=self.poll_id)
+        self.assertEqual(data, {
+            'error': 'Respondents are not counted for poll poll-id.'})
+        data = yield self.assert_route_error(404, 'respondents',
+                                             collection_id='unknown')
+        self.assertEqual(data, {'error': 'Unknown poll unknown.'})
+
+    @inlineCallbacks
+    def test_timeseries_output(self):
+        yield self.register_poll(rollup_interval=3600)
+        yield self.submit_answers('red', user_id='user-1')
+        yield self.submit_answers('red', user_id='user-2')
+        yield self.submit_answers('blue', user_id='user-3')
+        data = yield self.get_route_json('timeseries',
+            collection_id=self.poll_id, question=self.questions[0]['copy'],
+            buckets=2)
+        self.assertEqual(len(data['item']), 2)
+        self.assertEqual(sum(data['item']), 3)
+        self.assertEqual(len(data['settings']['axisx']), 2)
+        data = yield self.get_route_json('timeseries',
+            collection_id=self.poll_id, question=self.questions[0]['copy'],
+            answer='red', buckets=2)
+        self.assertEqual(sum(data['item']), 2)
+
+    @inlineCallbacks
+    def test_timeseries_buckets(self):
+        yield self.register_poll(rollup_interval=3600)
+        for buckets in ['0', '-1', 'many']:
+            data = yield self.assert_route_error(400, 'timeseries',
+                collection_id=self.poll_id,
+                question=self.questions[0]['copy'], buckets=buckets)
+            self.assertEqual(data, {
+                'error': 'buckets must be a positive integer, not %r.' % (
+                    buckets,)})
+        self.patch(PollTimeSeriesResource, 'max_buckets', 3)
+        data = yield self.get_route_json('timeseries',
+            collection_id=self.poll_id, question=self.questions[0]['copy'],
+            buckets=10)
+        self.assertEqual(len(data['item']), 3)
+
+    @inlineCallbacks
+    def test_timeseries_without_rollups(self):
+        data = yield self.assert_route_error(400, 'timeseries',
+            collection_id=self.poll_id, question=self.questions[0]['copy'])
+        self.assertEqual(data, {
+            'error': 'Rollups are not enabled for poll poll-id.'})
+
+    @inlineCallbacks
+    def test_live_output(self):
+        response = yield Agent(reactor).request('GET',
+            self.url + 'live?' + urllib.urlencode({
+                'collection_id': self.poll_id,
+            }))
+        self.assertEqual(
+            response.headers.getRawHeaders('content-type'),
+            ['text/event-stream'])
+        stream = EventStreamProtocol()
+        response.deliverBody(stream)
+        self.addCleanup(stream.transport.stopProducing)
+        [snapshot] = yield stream.wait_for_events(1)
+        self.assertEqual(snapshot, ('snapshot', (
+            yield self.results_manager.get_results(self.poll_id))))
+
+        yield self.submit_answers('red', 'orange', user_id='user-1')
+        events = yield stream.wait_for_events(3)
+        self.assertEqual(events[1:], [
+            ('change', {'question': self.questions[0]['copy'],
+                        'answer': 'red', 'previous': None}),
+            ('change', {'question': self.questions[1]['copy'],
+                        'answer': 'orange', 'previous': None}),
+        ])
+        # a single listener however many screens are streaming
+        self.assertEqual(
+            len(self.results_manager.get_change_listeners(self.poll_id)), 1)
+        self.assertEqual(stream.ids, [0, 1, 2])
+
+        self.service.stream.send_keepalive()
+        yield stream.wait_for_comments(1)
+        self.assertEqual(stream.comments, ['keepalive'])
+
+    def test_live_changes_in_snapshot(self):
+        stream = self.service.stream
+        request = FakeRequest()
+        stream.add(self.poll_id, request)
+        stream.publish(self.poll_id, {'question': 'q', 'answer': 'a',
+                                      'previous': None, 'seq': 1})
+        stream.publish(self.poll_id, {'question': 'q', 'answer': 'b',
+                                      'previous': 'a', 'seq': 2})
+        # the snapshot counts the first change already
+        stream.ready(self.poll_id, request, 1)
+        self.assertEqual(request.written, [
+            'id: 2\nevent: change\ndata: %s\n\n' % (json.dumps({
+                'question': 'q', 'answer': 'b', 'previous': 'a'}),)])
+        stream.remove(self.poll_id, request)
+
+    def test_live_changes_after_snapshot(self):
+        stream = self.service.stream
+        request = FakeRequest()
+        stream.add(self.poll_id, request)
+        stream.ready(self.poll_id, request, 2)
+        # changes published elsewhere can arrive after a snapshot that
+        # counts them
+        stream.publish(self.poll_id, {'question': 'q', 'answer': 'a',
+                                      'previous': None, 'seq': 2})
+        stream.publish(self.poll_id, {'question': 'q', 'answer': 'b',
+                                      'previous': 'a', 'seq': 3})
+        self.assertEqual(request.written, [
+            'id: 3\nevent: change\ndata: %s\n\n' % (json.dumps({
+                'question': 'q', 'answer': 'b', 'previous': 'a'}),)])
+        stream.remove(self.poll_id, request)
+
+    def test_live_error(self):
+        resource = PollLiveResultsResource(self.results_manager,
+                                           self.service.stream)
+        request = FakeRequest()
+        # requests that went away aren't finished
+        resource.render_error(Failure(ValueError('Redis went away')),
+                              self.poll_id, request)
+        self.assertFalse(request.finished)
+        self.service.stream.add(self.poll_id, request)
+        resource.render_error(Failure(ValueError('Redis went away')),
+                              self.poll_id, request)
+        self.assertTrue(request.finished)
+        self.service.stream.remove(self.poll_id, request)
+        self.flushLoggedErrors(ValueError)
+
+    def test_subscriber_factory(self):
+        factory = ChangeSubscriberFactory(self.service.stream, 2, 'secret')
+        self.assertEqual(factory._kwargs, {'db': 2, 'password': 'secret'})
+
     @inlineCallbacks
     def test_results_csv(self):
         yield self.get_route_csv('results.csv?%s' % (urllib.urlencode({
@@ -141,3 +391,13 @@ class PollDashboardTestCase(PersistenceMixin, TestCase):
         yield self.get_route_csv('users.csv?%s' % (urllib.urlencode({
             'collection_id': self.poll_id,
         }),))
+
+
+class ShardedPollDashboardTestCase(PollDashboardTestCase):
+
+    @inlineCallbacks
+    def get_poll_manager(self):
+        shards = {}
+        for name in ['a', 'b']:
+            shards[name] = yield self.redis.sub_manager(name)
+        returnValue(PollManager(self.redis, result_shards=shards))
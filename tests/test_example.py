@@ -1,3 +1,4 @@
+import time
 import yaml
 
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -535,3 +536,25 @@ class PollManagerVersioningTestCase(BasePollApplicationTestCase):
         yield self.dispatch(self.mkmsg_in(content=None, from_addr='123'))
         response = self.get_dispatched_messages()[-1]
         self.assertResponse(response, self.updated_questions[0]['copy'])
+
+
+class IdleSessionPollApplicationTestCase(BasePollApplicationTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(IdleSessionPollApplicationTestCase, self).setUp()
+        self.config.update({
+            'session_idle_ttl': 60,
+            'session_sweep_interval': 30,
+        })
+        self.app = yield self.get_application(self.config)
+
+    @inlineCallbacks
+    def test_idle_session_resumes(self):
+        self.assertTrue(self.app.session_sweeper.running)
+        yield self.dispatch(self.mkmsg_in(content=None))
+        yield self.app.pm.sweep_idle_sessions(now=time.time() + 61)
+        yield self.dispatch(self.mkmsg_in(content='red'))
+        [first, second] = self.get_dispatched_messages()
+        self.assertResponse(first, self.default_questions[0]['copy'])
+        self.assertResponse(second, self.default_questions[1]['copy'])
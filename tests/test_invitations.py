@@ -0,0 +1,130 @@
+from twisted.internet.defer import inlineCallbacks, fail
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
+
+from vxpolls.invitations import RateLimiter, PollInviter
+
+from tests.test_example import BasePollApplicationTestCase
+from tests.test_multipoll_example import BaseMultiPollApplicationTestCase
+
+
+class RateLimiterTestCase(TestCase):
+
+    def test_rate_limit(self):
+        clock = Clock()
+        limiter = RateLimiter(2, clock)
+        acquired = []
+        for index in range(3):
+            limiter.acquire().addCallback(
+                lambda _, i=index: acquired.append(i))
+        self.assertEqual(acquired, [0])
+        clock.advance(0.5)
+        self.assertEqual(acquired, [0, 1])
+        clock.advance(0.5)
+        self.assertEqual(acquired, [0, 1, 2])
+
+    def test_no_limit(self):
+        limiter = RateLimiter(None, Clock())
+        acquired = []
+        for index in range(3):
+            limiter.acquire().addCallback(
+                lambda _, i=index: acquired.append(i))
+        self.assertEqual(acquired, [0, 1, 2])
+
+
+class PollInviterTestCase(BasePollApplicationTestCase):
+
+    @inlineCallbacks
+    def test_invite(self):
+        progress = yield self.app.invite(self.poll_id, ['+271', '+272'])
+        self.assertEqual(progress, {
+            'position': 2, 'sent': 2, 'skipped': 0, 'failed': 0})
+        [msg1, msg2] = self.get_dispatched_messages()
+        self.assertEqual(msg1['to_addr'], '+271')
+        self.assertEqual(msg2['to_addr'], '+272')
+        self.assertResponse(msg1, self.default_questions[0]['copy'])
+        self.assertEqual(msg1['helper_metadata']['poll_id'], self.poll_id)
+
+        # the reply answers the question that was sent out
+        participant, poll = yield self.get_participant_and_poll('+271')
+        self.assertTrue(participant.has_unanswered_question)
+        yield self.dispatch(self.mkmsg_in(content='red', from_addr='+271'))
+        reply = self.get_dispatched_messages()[-1]
+        self.assertResponse(reply, self.default_questions[1]['copy'])
+
+    @inlineCallbacks
+    def test_resume(self):
+        inviter = PollInviter(self.app, self.poll_id, batch_size=2)
+        yield inviter.invite(['+271', '+272'])
+        # a restarted run skips the batches already done and participants
+        # who are still waiting to answer
+        yield self.app.pm.r_server.hincrby(inviter.get_progress_key(),
+                                           'position', -1)
+        progress = yield inviter.invite(['+271', '+272', '+273'])
+        self.assertEqual(progress, {
+            'position': 3, 'sent': 3, 'skipped': 1, 'failed': 0})
+        self.assertEqual(
+            [msg['to_addr'] for msg in self.get_dispatched_messages()],
+            ['+271', '+272', '+273'])
+
+        yield inviter.reset_progress()
+        self.assertEqual((yield inviter.get_progress()), {
+            'position': 0, 'sent': 0, 'skipped': 0, 'failed': 0})
+
+
+class MultiPollInviterTestCase(BaseMultiPollApplicationTestCase):
+
+    poll_id_list = ['SCOPE_0']
+    default_questions_dict = {
+        'SCOPE_0': [{
+            'copy': 'What is your favorite colour?',
+            'valid_responses': ['red', 'green', 'blue'],
+        }, {
+            'copy': 'Who are you?',
+            'valid_responses': [],
+        }],
+    }
+
+    @inlineCallbacks
+    def test_invite(self):
+        progress = yield self.app.invite('SCOPE', ['+271'])
+        self.assertEqual(progress, {
+            'position': 1, 'sent': 1, 'skipped': 0, 'failed': 0})
+        [msg] = self.get_dispatched_messages()
+        self.assertResponse(
+            msg, self.default_questions_dict['SCOPE_0'][0]['copy'])
+        self.assertEqual(msg['helper_metadata']['poll_id'], 'SCOPE')
+
+        # the session is saved under the scope the reply carries
+        participant = yield self.app.pm.get_participant('SCOPE', '+271')
+        self.assertTrue(participant.has_unanswered_question)
+        self.assertEqual(participant.get_poll_id(), 'SCOPE_0')
+
+        reply = self.mkmsg_in(content='red', from_addr='+271')
+        reply['helper_metadata']['poll_id'] = 'SCOPE'
+        yield self.dispatch(reply)
+        self.assertResponse(self.get_dispatched_messages()[-1],
+                            self.default_questions_dict['SCOPE_0'][1]['copy'])
+
+    @inlineCallbacks
+    def test_resume_after_failed_send(self):
+        send_to = self.app.send_to
+        self.app.send_to = lambda *args, **kw: fail(
+            Exception('Transport unavailable'))
+        inviter = PollInviter(self.app, 'SCOPE')
+        progress = yield inviter.invite(['+271'])
+        self.assertEqual(progress, {
+            'position': 1, 'sent': 0, 'skipped': 0, 'failed': 1})
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
+        # ask_question saved the participant, the failed send undid that
+        participant = yield self.app.pm.get_participant('SCOPE', '+271')
+        self.assertFalse(participant.has_unanswered_question)
+
+        self.app.send_to = send_to
+        yield inviter.reset_progress()
+        progress = yield inviter.invite(['+271'])
+        self.assertEqual(progress, {
+            'position': 1, 'sent': 1, 'skipped': 0, 'failed': 0})
+        [msg] = self.get_dispatched_messages()
+        self.assertResponse(
+            msg, self.default_questions_dict['SCOPE_0'][0]['copy'])
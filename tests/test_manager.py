@@ -1,12 +1,66 @@
+import time
+import json
 import random
 from datetime import datetime
 
-from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.trial.unittest import TestCase, SkipTest
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, succeed, fail)
+from twisted.internet.error import ConnectError
+from twisted.internet.protocol import ClientCreator, Protocol
+
+from txredis.exceptions import NoScript
 
 from vumi.tests.utils import PersistenceMixin
+from vumi.message import TransportUserMessage
+
+from vxpolls import manager
+from vxpolls.manager import PollManager, PollManagerException
+from vxpolls.results import (
+    ResultManager, CollectionException, AnswerSegment)
+from vxpolls.scripts import RECORD_ANSWER
+from vxpolls.participant import COMPRESSED_MARKER
+
+
+class FakeRecordAnswer(object):
+    """
+    Does in Python what the RECORD_ANSWER script does in Redis.
+    """
 
-from vxpolls.manager import PollManager
+    def __init__(self, scripts):
+        self.scripts = scripts
+
+    def is_supported(self, r_server):
+        return True
+
+    @inlineCallbacks
+    def __call__(self, r_server, keys, args):
+        self.scripts.append((keys, args))
+        (collections_key, questions_key, users_key, updated_key,
+         answers_key, results_key, session_key, changes_key) = keys
+        collection_id, question, user_id, timestamp = args[:4]
+        question_id, answer = args[4:6]
+        if not (yield r_server.sismember(collections_key, collection_id)):
+            returnValue([1])
+        if not (yield r_server.sismember(questions_key, question)):
+            returnValue([2])
+        yield r_server.sadd(users_key, user_id)
+        yield r_server.zadd(updated_key, **{user_id: timestamp})
+        previous = yield r_server.hget(answers_key, question_id)
+        seq = 0
+        if not previous:
+            yield r_server.hincrby(results_key, answer, 1)
+            seq = yield r_server.incr(changes_key)
+        elif previous != answer:
+            yield r_server.hincrby(results_key, answer, 1)
+            yield r_server.hincrby(results_key, previous, -1)
+            seq = yield r_server.incr(changes_key)
+        yield r_server.hset(answers_key, question_id, answer)
+        fields = args[6:]
+        for field, value in zip(fields[::2], fields[1::2]):
+            yield r_server.hset(session_key, field, value)
+        returnValue([0, previous or '', seq])
 
 
 class PollManagerTestCase(PersistenceMixin, TestCase):
@@ -131,6 +185,686 @@ class PollManagerTestCase(PersistenceMixin, TestCase):
         # original question should be repeated
         self.assertEqual(expected_question, response)
 
+    @inlineCallbacks
+    def test_completed_responses(self):
+        poll = yield self.poll_manager.register(self.poll_id, {
+            'questions': self.default_questions,
+            'survey_completed_responses': [{
+                'copy': 'red it is',
+                'checks': [['equal', 'colour', 'red']],
+            }],
+            'batch_completed_response': 'batch done',
+        })
+        self.assertEqual(poll.batch_completed_response, 'batch done')
+        self.assertEqual(poll.survey_completed_response, None)
+
+        def get_config(*args, **kwargs):
+            self.fail('Completed responses should not need the config.')
+
+        self.patch(self.poll_manager, 'get_config', get_config)
+        self.participant.set_label('colour', 'red')
+        self.assertEqual(
+            poll.get_completed_response(self.participant, 'default'),
+            'red it is')
+        self.participant.set_label('colour', 'blue')
+        self.assertEqual(
+            (yield self.poll_manager.get_completed_response(
+                self.participant, poll, 'default')),
+            'default')
+
+    def test_compiled_questions(self):
+        def compile_checks(*args, **kwargs):
+            self.fail('Questions should only be compiled once.')
+
+        self.patch(manager, 'compile_checks', compile_checks)
+        question = self.poll.get_next_question(self.participant)
+        self.assertEqual(question.copy, 'What is your favorite colour?')
+        self.assertTrue(question.answer('red'))
+        # answering doesn't change the poll's question
+        self.assertTrue(self.poll.get_question(0).answer('blue'))
+        self.assertEqual(self.poll.get_question(3), None)
+
+    @inlineCallbacks
+    def test_versions_share_question_records(self):
+        version1 = {'questions': self.default_questions}
+        version2 = {'questions': self.default_questions[:2] + [{
+            'copy': 'What is your favorite vegetable?',
+            'valid_responses': ['carrot', 'pea'],
+        }]}
+        uid1 = yield self.poll_manager.set(self.poll_id, version1)
+        uid2 = yield self.poll_manager.set(self.poll_id, version2)
+        records = yield self.redis.hgetall(
+            self.poll_manager.r_key('question_records'))
+        self.assertEqual(len(records), 4)
+        # a fresh manager has nothing cached and has to reassemble
+        # the versions from Redis
+        poll_manager = PollManager(self.redis)
+        self.assertEqual(
+            (yield poll_manager.get_config(self.poll_id, uid1)), version1)
+        self.assertEqual(
+            (yield poll_manager.get_config(self.poll_id, uid2)), version2)
+        yield poll_manager.stop()
+
+    @inlineCallbacks
+    def test_missing_question_record(self):
+        uid = yield self.poll_manager.set(self.poll_id, {
+            'questions': self.default_questions})
+        records_key = self.poll_manager.r_key('question_records')
+        ref = (yield self.redis.hgetall(records_key)).keys()[0]
+        yield self.redis.hdel(records_key, ref)
+        poll_manager = PollManager(self.redis)
+        self.addCleanup(poll_manager.stop)
+        yield self.assertFailure(poll_manager.get_config(self.poll_id, uid),
+                                 PollManagerException)
+        # misses aren't cached
+        self.assertFalse(ref in poll_manager.question_records)
+
+    @inlineCallbacks
+    def test_cache_size(self):
+        poll_manager = PollManager(self.redis, cache_size=2)
+        self.addCleanup(poll_manager.stop)
+        yield poll_manager.set(self.poll_id, {
+            'questions': self.default_questions})
+        self.assertEqual(len(poll_manager.question_records), 2)
+        # the least recently used record was dropped
+        self.assertEqual(
+            poll_manager.question_records.items.values(),
+            [json.dumps(question, sort_keys=True)
+             for question in self.default_questions[1:]])
+
+    @inlineCallbacks
+    def test_compiled_polls(self):
+        yield self.poll_manager.set(self.poll_id, {
+            'questions': self.default_questions})
+        poll = yield self.poll_manager.get(self.poll_id)
+        self.assertTrue((yield self.poll_manager.get(self.poll_id)) is poll)
+        # a new version is picked up straight away
+        yield self.poll_manager.set(self.poll_id, {
+            'questions': self.default_questions[:1]})
+        new_poll = yield self.poll_manager.get(self.poll_id)
+        self.assertEqual(len(new_poll.questions), 1)
+        # a cached version is returned without a round trip
+        self.assertTrue(
+            (yield self.poll_manager.get(self.poll_id, poll.uid)) is poll)
+
+    @inlineCallbacks
+    def test_compiled_polls_evicted(self):
+        poll_manager = PollManager(self.redis, cache_size=1,
+                                   counter_flush_interval=60)
+        self.addCleanup(poll_manager.stop)
+        yield poll_manager.set('poll-1', {'questions': self.default_questions})
+        yield poll_manager.set('poll-2', {'questions': self.default_questions})
+        poll_1 = yield poll_manager.get('poll-1')
+        participant = yield poll_manager.get_participant('poll-1', 'user-1')
+        poll_1.set_last_question(participant,
+                                 poll_1.get_next_question(participant))
+        yield poll_1.submit_answer(participant, 'red')
+        # evicting a poll writes its buffered counters
+        poll_2 = yield poll_manager.get('poll-2')
+        self.assertEqual(poll_manager.compiled_polls.items.keys(),
+                         [('poll-2', poll_2.uid)])
+        self.assertFalse(poll_1.results_manager.counter_flusher.running)
+        self.assertEqual(
+            (yield poll_1.results_manager.get_results_for_question(
+                'poll-1', self.default_questions[0]['copy'])),
+            {'red': 1, 'green': 0, 'blue': 0})
+
+    @inlineCallbacks
+    def test_warm_up(self):
+        uid = yield self.poll_manager.set(self.poll_id, {
+            'questions': self.default_questions})
+        poll_manager = PollManager(self.redis)
+        polls = yield poll_manager.warm_up([self.poll_id, 'unknown'])
+        self.assertEqual([poll.uid for poll in polls], [uid])
+        self.assertEqual(poll_manager.compiled_polls.items.keys(),
+                         [(self.poll_id, uid)])
+        yield poll_manager.stop()
+
+    @inlineCallbacks
+    def test_submit_answer_fallback(self):
+        # the fake redis can't run scripts
+        poll_manager = PollManager(self.redis, atomic_answers=True)
+        self.assertFalse(poll_manager.can_submit_atomically(self.poll))
+        question = self.poll.get_next_question(self.participant)
+        self.poll.set_last_question(self.participant, question)
+        error_message = yield poll_manager.submit_answer(
+            self.poll, self.participant, 'purple')
+        self.assertEqual(error_message, question.copy)
+        yield poll_manager.submit_answer(self.poll, self.participant, 'red')
+        self.assertEqual(self.participant.interactions, 1)
+        self.assertEqual(
+            (yield self.poll.results_manager.get_user(self.poll_id,
+                                                      'user_id')),
+            {u'question-0': 'red', u'question-1': None,
+             u'question-2': None})
+        yield poll_manager.stop()
+
+    @inlineCallbacks
+    def test_lua_script(self):
+        calls = []
+        cached = set()
+
+        class FakeClient(object):
+            def eval(self, source, keys, args):
+                calls.append(('eval', source, keys, args))
+                cached.add(RECORD_ANSWER.sha1)
+                return succeed([0, ''])
+
+            def evalsha(self, sha1, keys, args):
+                calls.append(('evalsha', sha1, keys, args))
+                if sha1 not in cached:
+                    return fail(NoScript('No matching script.'))
+                return succeed([0, ''])
+
+        self.assertFalse(RECORD_ANSWER.is_supported(self.redis))
+        r_server = self.redis.sub_manager('scripts')
+        r_server._client = FakeClient()
+        self.assertTrue(RECORD_ANSWER.is_supported(r_server))
+        for attempt in range(2):
+            self.assertEqual(
+                (yield RECORD_ANSWER(r_server, ['a', u'b'], [1, u'\xe9'])),
+                [0, ''])
+        # txredis takes the keys and arguments as lists, the source is
+        # only sent when Redis doesn't have it yet
+        keys = [r_server._key('a'), r_server._key('b')]
+        args = ['1', '\xc3\xa9']
+        self.assertEqual(calls, [
+            ('evalsha', RECORD_ANSWER.sha1, keys, args),
+            ('eval', RECORD_ANSWER.source, keys, args),
+            ('evalsha', RECORD_ANSWER.sha1, keys, args),
+        ])
+
+    @inlineCallbacks
+    def get_real_redis_manager(self):
+        config = self._persist_config['redis_manager'].copy()
+        del config['FAKE_REDIS']
+        try:
+            client = yield ClientCreator(reactor, Protocol).connectTCP(
+                config.get('host', '127.0.0.1'), config.get('port', 6379),
+                timeout=1)
+        except ConnectError:
+            raise SkipTest('Needs a Redis server to run scripts.')
+        client.transport.loseConnection()
+        r_server = yield self.get_redis_manager(config)
+        returnValue(r_server)
+
+    @inlineCallbacks
+    def test_record_answer_script(self):
+        r_server = yield self.get_real_redis_manager()
+        poll_manager = PollManager(r_server, atomic_answers=True)
+        self.addCleanup(poll_manager.stop)
+        poll = yield poll_manager.register(self.poll_id, {
+            'questions': self.default_questions})
+        self.assertTrue(poll_manager.can_submit_atomically(poll))
+        participant = yield poll_manager.get_participant(self.poll_id,
+                                                         'user_id')
+        question = poll.get_next_question(participant)
+        poll.set_last_question(participant, question)
+        yield poll_manager.submit_answer(poll, participant, 'red')
+        yield poll_manager.submit_answer(poll, participant, 'green')
+
+        results_manager = poll.results_manager
+        self.assertEqual(
+            (yield results_manager.get_results_for_question(
+                self.poll_id, question.label)),
+            {'red': 0, 'green': 1, 'blue': 0})
+        self.assertEqual(
+            (yield results_manager.get_user(self.poll_id, 'user_id',
+                                            [question.label])),
+            {question.label: 'green'})
+        self.assertEqual(
+            (yield results_manager.get_users(self.poll_id)), ['user_id'])
+        saved = yield poll_manager.get_participant(self.poll_id, 'user_id')
+        self.assertEqual(saved.interactions, 2)
+        self.assertEqual(saved.get_last_question_index(), 0)
+        self.assertEqual((yield results_manager.get_change_seq(self.poll_id)),
+                         2)
+
+    @inlineCallbacks
+    def test_segment_script(self):
+        r_server = yield self.get_real_redis_manager()
+        manager = ResultManager(r_server, 'segments', index_respondents=True)
+        yield manager.register_collection('cid')
+        yield manager.register_question('cid', 'colour', ['red', 'blue'],
+                                        encode_answers=True)
+        yield manager.register_question('cid', 'fruit')
+        for user_id, colour, fruit in [('user-0', 'red', 'apple'),
+                                       ('user-1', 'blue', 'apple'),
+                                       ('user-2', 'red', 'pear'),
+                                       ('user-3', 'blue', None)]:
+            yield manager.add_result('cid', user_id, 'colour', colour)
+            if fruit:
+                yield manager.add_result('cid', user_id, 'fruit', fruit)
+
+        red = AnswerSegment('colour', 'red')
+        apple = AnswerSegment('fruit', 'apple')
+        self.assertEqual((yield manager.count_segment('cid', red & apple)), 1)
+        self.assertEqual((yield manager.count_segment('cid', red | apple)), 3)
+        self.assertEqual((yield manager.count_segment('cid', ~apple)), 2)
+        self.assertEqual((yield manager.get_segment_users('cid', ~red)),
+                         ['user-1', 'user-3'])
+        self.assertEqual(
+            (yield manager.get_segment_users('cid', red, offset=1)),
+            ['user-2'])
+
+    @inlineCallbacks
+    def test_submit_answer_atomically(self):
+        scripts = []
+        self.patch(manager, 'RECORD_ANSWER', FakeRecordAnswer(scripts))
+        poll_manager = PollManager(self.redis, atomic_answers=True)
+        self.assertTrue(poll_manager.can_submit_atomically(self.poll))
+        question = self.poll.get_next_question(self.participant)
+        self.poll.set_last_question(self.participant, question)
+        recorded = []
+
+        @inlineCallbacks
+        def custom_answer_logic(participant, answer, poll_question):
+            # runs once the answer is recorded, like Poll.submit_answer
+            recorded.append((yield self.poll.results_manager.get_user(
+                self.poll_id, 'user_id', [poll_question.label])))
+
+        yield poll_manager.submit_answer(self.poll, self.participant, 'red',
+                                         custom_answer_logic)
+        self.assertEqual(recorded, [{question.label: 'red'}])
+        yield poll_manager.submit_answer(self.poll, self.participant,
+                                         'green')
+        self.assertEqual(len(scripts), 2)
+
+        results_manager = self.poll.results_manager
+        self.assertEqual(
+            (yield results_manager.get_results_for_question(
+                self.poll_id, question.label)),
+            {'red': 0, 'green': 1, 'blue': 0})
+        self.assertEqual(
+            (yield results_manager.get_user(self.poll_id, 'user_id',
+                                            [question.label])),
+            {question.label: 'green'})
+        # the session is saved along with the answer
+        participant = yield poll_manager.get_participant(self.poll_id,
+                                                         'user_id')
+        self.assertEqual(participant.interactions, 2)
+        self.assertEqual(participant.get_last_question_index(), 0)
+
+        # saving afterwards only writes what changed since
+        writes = []
+        self.patch(poll_manager.session_manager, 'save_session',
+                   lambda session_key, session: writes.append(session))
+        yield poll_manager.save_participant(self.poll_id, self.participant)
+        self.assertEqual(writes, [])
+        self.poll.set_last_question(self.participant,
+                                    self.poll.get_next_question(
+                                        self.participant))
+        yield poll_manager.save_participant(self.poll_id, self.participant)
+        [session] = writes
+        self.assertEqual(sorted(session.keys()), ['polls', 'updated_at'])
+        yield poll_manager.save_participant(self.poll_id, self.participant)
+        self.assertEqual(len(writes), 1)
+        # a session saved under another key is written in full
+        yield poll_manager.save_participant('other-poll', self.participant)
+        self.assertEqual(writes[1], self.participant.clean_dump())
+
+        poll = yield poll_manager.register('other-poll', {
+            'questions': self.default_questions})
+        yield self.redis.srem(results_manager.get_collections_key(),
+                              'other-poll')
+        poll.set_last_question(self.participant, question)
+        yield self.assertFailure(
+            poll_manager.submit_answer(poll, self.participant, 'red'),
+            CollectionException)
+        yield poll_manager.stop()
+
+    @inlineCallbacks
+    def test_submit_answer_script_call(self):
+        calls = []
+        client = self.redis._client
+
+        def evalsha(sha1, keys, args):
+            calls.append(('evalsha', sha1, keys, args))
+            return fail(NoScript('No matching script.'))
+
+        def eval(source, keys, args):
+            calls.append(('eval', source, keys, args))
+            return succeed([0, '', 7])
+
+        poll_manager = PollManager(self.redis, atomic_answers=True)
+        self.addCleanup(poll_manager.stop)
+        changes = []
+        self.poll.results_manager.add_change_listener(
+            self.poll_id, lambda collection_id, change: changes.append(change))
+        question = self.poll.get_next_question(self.participant)
+        self.poll.set_last_question(self.participant, question)
+        client.evalsha, client.eval = evalsha, eval
+        try:
+            yield poll_manager.submit_answer(self.poll, self.participant,
+                                             'red')
+        finally:
+            del client.evalsha, client.eval
+
+        # the source is sent once Redis turns out not to have it
+        [(_, sha1, keys, args), (_, source, eval_keys, eval_args)] = calls
+        self.assertEqual((sha1, source), (RECORD_ANSWER.sha1,
+                                          RECORD_ANSWER.source))
+        self.assertEqual((eval_keys, eval_args), (keys, args))
+        results_manager = self.poll.results_manager
+        question_id = yield results_manager.get_question_id(
+            self.poll_id, question.label)
+        session_key = poll_manager.get_session_key(self.poll_id, 'user_id')
+        self.assertEqual(keys, [self.redis._key(key) for key in [
+            results_manager.get_collections_key(),
+            results_manager.get_questions_key(self.poll_id),
+            results_manager.get_users_key(self.poll_id),
+            results_manager.get_updated_key(self.poll_id),
+            results_manager.get_user_answers_key(self.poll_id, 'user_id'),
+            results_manager.get_results_key(self.poll_id, question_id),
+            poll_manager.r_key('session', session_key),
+            results_manager.get_change_counter_key(self.poll_id),
+        ]])
+        # the change is numbered by the script
+        self.assertEqual([change['seq'] for change in changes], [7])
+        self.assertEqual((yield results_manager.get_change_seq(self.poll_id)),
+                         0)
+        self.assertEqual(args[:6], [
+            self.poll_id, question.label, 'user_id',
+            repr(self.participant.updated_at), question_id, 'red'])
+        session = self.participant.clean_dump()
+        self.assertEqual(args[6:], [
+            str(value) for item in sorted(session.items())
+            for value in item])
+
+    @inlineCallbacks
+    def test_written_session_cleared(self):
+        self.patch(manager, 'RECORD_ANSWER', FakeRecordAnswer([]))
+        poll_manager = PollManager(self.redis, atomic_answers=True,
+                                   session_idle_ttl=60)
+        self.addCleanup(poll_manager.stop)
+        writes = []
+        save_session = poll_manager.session_manager.save_session
+
+        def record_save_session(session_key, session):
+            writes.append(session)
+            return save_session(session_key, session)
+
+        self.patch(poll_manager.session_manager, 'save_session',
+                   record_save_session)
+        question = self.poll.get_next_question(self.participant)
+        self.poll.set_last_question(self.participant, question)
+        yield poll_manager.submit_answer(self.poll, self.participant, 'red')
+        self.assertNotEqual(self.participant.written_session, None)
+
+        # once swept the session is gone, it has to be written in full
+        self.assertEqual(
+            (yield poll_manager.sweep_idle_sessions(now=time.time() + 120)),
+            1)
+        yield poll_manager.save_participant(self.poll_id, self.participant)
+        self.assertEqual(writes[-1], self.participant.clean_dump())
+
+        yield poll_manager.archive(self.poll_id, self.participant)
+        self.assertEqual(self.participant.written_session, None)
+
+    @inlineCallbacks
+    def test_legacy_versions(self):
+        version = {'questions': self.default_questions, 'batch_size': 2}
+        yield self.redis.hset(self.poll_manager.r_key('versions', 'legacy'),
+                              'uid', json.dumps(version))
+        self.assertEqual(
+            (yield self.poll_manager.get_config('legacy', 'uid')), version)
+
+    @inlineCallbacks
+    def test_encoded_answers(self):
+        yield self.poll_manager.set('encoded', {
+            'questions': self.default_questions,
+            'encode_answers': True,
+        })
+        poll = yield self.poll_manager.get('encoded')
+        question = poll.get_next_question(self.participant)
+        poll.set_last_question(self.participant, question)
+        yield poll.submit_answer(self.participant, 'green')
+
+        results_manager = poll.results_manager
+        question_id = yield results_manager.get_question_id(
+            'encoded', question.label_or_copy())
+        self.assertTrue(question_id.startswith('%'))
+        answers = yield self.redis.hgetall(
+            results_manager.get_user_answers_key(
+                'encoded', self.participant.user_id))
+        self.assertEqual(answers, {question_id: '2'})
+        results = yield results_manager.get_results_for_question(
+            'encoded', question.label_or_copy())
+        self.assertEqual(results, {'red': 0, 'green': 1, 'blue': 0})
+
+    @inlineCallbacks
+    def test_find_participants(self):
+        poll_manager = PollManager(self.redis, 'indexed',
+                                   indexed_labels=['status', 'age'])
+        labels = {
+            'user-1': {'status': 'registered', 'age': '25'},
+            'user-2': {'status': 'registered', 'age': '40'},
+            'user-3': {'status': 'pending'},
+            'user-4': {'age': '18'},
+        }
+        for user_id, user_labels in labels.items():
+            participant = yield poll_manager.get_participant(self.poll_id,
+                                                             user_id)
+            participant.labels.update(user_labels)
+            participant.set_label('ignored', 'value')
+            yield poll_manager.save_participant(self.poll_id, participant)
+
+        def find(*checks):
+            return poll_manager.find_participants(self.poll_id, list(checks))
+
+        self.assertEqual((yield find(['equal', 'status', 'registered'])),
+                         set(['user-1', 'user-2']))
+        self.assertEqual((yield find(['not equal', 'status', 'registered'])),
+                         set(['user-3', 'user-4']))
+        self.assertEqual((yield find(['exists', 'age', ''])),
+                         set(['user-1', 'user-2', 'user-4']))
+        self.assertEqual((yield find(['not exists', 'age', ''])),
+                         set(['user-3']))
+        self.assertEqual((yield find(['greater', 'age', '20'],
+                                     ['equal', 'status', 'registered'])),
+                         set(['user-1', 'user-2']))
+        self.assertEqual((yield find(['less or equal', 'age', '25'],
+                                     ['exists', 'age', ''])),
+                         set(['user-1', 'user-4']))
+        self.assertEqual(len((yield find())), 4)
+        yield self.assertFailure(find(['equal', 'ignored', 'value']),
+                                 ValueError)
+
+        # changing a label moves the participant in the index
+        participant = yield poll_manager.get_participant(self.poll_id,
+                                                         'user-3')
+        participant.set_label('status', 'registered')
+        yield poll_manager.save_participant(self.poll_id, participant)
+        self.assertEqual((yield find(['equal', 'status', 'registered'])),
+                         set(['user-1', 'user-2', 'user-3']))
+        self.assertEqual((yield find(['equal', 'status', 'pending'])),
+                         set())
+
+        # archived participants leave the index
+        yield poll_manager.archive(self.poll_id, participant)
+        self.assertEqual((yield find(['equal', 'status', 'registered'])),
+                         set(['user-1', 'user-2']))
+        self.assertEqual(len((yield find())), 3)
+        yield poll_manager.stop()
+
+    @inlineCallbacks
+    def test_find_participants_case_insensitive(self):
+        poll_manager = PollManager(self.redis, 'indexed',
+                                   indexed_labels=['status'])
+        self.addCleanup(poll_manager.stop)
+        for user_id, status in [('user-1', 'Yes'), ('user-2', 'no')]:
+            participant = yield poll_manager.get_participant(self.poll_id,
+                                                             user_id)
+            participant.set_label('status', status)
+            yield poll_manager.save_participant(self.poll_id, participant)
+
+        def find(check, case_sensitive):
+            return poll_manager.find_participants(self.poll_id, [check],
+                                                  case_sensitive)
+
+        self.assertEqual((yield find(['equal', 'status', 'Yes'], True)),
+                         set(['user-1']))
+        self.assertEqual((yield find(['equal', 'status', 'yes'], True)),
+                         set())
+        for value in ['yes', 'Yes', 'YES']:
+            self.assertEqual((yield find(['equal', 'status', value], False)),
+                             set(['user-1']))
+        self.assertEqual((yield find(['not equal', 'status', 'YES'], False)),
+                         set(['user-2']))
+
+    @inlineCallbacks
+    def test_reindex_labels(self):
+        for user_id, status in [('user-1', 'registered'), ('user-2', None)]:
+            participant = yield self.poll_manager.get_participant(
+                self.poll_id, user_id)
+            if status:
+                participant.set_label('status', status)
+            yield self.poll_manager.save_participant(self.poll_id,
+                                                     participant)
+        other = yield self.poll_manager.get_participant('poll', 'user-3')
+        other.set_label('status', 'registered')
+        yield self.poll_manager.save_participant('poll', other)
+
+        # the participants were saved before the label was indexed
+        poll_manager = PollManager(self.redis, indexed_labels=['status'])
+        self.addCleanup(poll_manager.stop)
+        self.assertEqual(
+            (yield poll_manager.find_participants(self.poll_id, [])), set())
+        self.assertEqual((yield poll_manager.reindex_labels(self.poll_id)), 2)
+        self.assertEqual(
+            (yield poll_manager.find_participants(self.poll_id, [
+                ['equal', 'status', 'registered']])),
+            set(['user-1']))
+        self.assertEqual(
+            (yield poll_manager.find_participants(self.poll_id, [])),
+            set(['user-1', 'user-2']))
+
+    @inlineCallbacks
+    def test_sweep_idle_sessions(self):
+        poll_manager = PollManager(self.redis, 'idle', session_idle_ttl=60)
+        for user_id in ['user-1', 'user-2']:
+            participant = yield poll_manager.get_participant(self.poll_id,
+                                                             user_id)
+            participant.set_label('colour', 'red')
+            yield poll_manager.save_participant(self.poll_id, participant)
+        now = time.time()
+        self.assertEqual(
+            (yield poll_manager.sweep_idle_sessions(now=now + 30)), 0)
+        self.assertEqual(
+            (yield poll_manager.sweep_idle_sessions(limit=1, now=now + 61)),
+            1)
+        self.assertEqual(
+            (yield poll_manager.sweep_idle_sessions(now=now + 61)), 1)
+
+        session_key = poll_manager.get_session_key(self.poll_id, 'user-1')
+        self.assertEqual(
+            (yield poll_manager.session_manager.load_session(session_key)),
+            {})
+        # offloaded sessions are restored on the next contact
+        participant = yield poll_manager.get_participant(self.poll_id,
+                                                         'user-1')
+        self.assertEqual(participant.get_label('colour'), 'red')
+        self.assertNotEqual(
+            (yield poll_manager.session_manager.load_session(session_key)),
+            {})
+        self.assertEqual((yield self.redis.hgetall(
+            poll_manager.r_key('offloaded_sessions'))).keys(),
+            [poll_manager.get_session_key(self.poll_id, 'user-2')])
+        yield poll_manager.stop()
+
+    @inlineCallbacks
+    def test_sweep_saved_sessions(self):
+        poll_manager = PollManager(self.redis, 'idle', session_idle_ttl=60)
+        self.addCleanup(poll_manager.stop)
+        participant = yield poll_manager.get_participant(self.poll_id, 'user')
+        participant.set_label('colour', 'red')
+        yield poll_manager.save_participant(self.poll_id, participant)
+        session_key = poll_manager.get_session_key(self.poll_id, 'user')
+        now = time.time()
+        load_session = poll_manager.session_manager.load_session
+
+        def load_while_saving(session_key):
+            # the participant's session is saved while it's being swept
+            d = poll_manager.touch_session(session_key, now + 61)
+            return d.addCallback(lambda _: load_session(session_key))
+
+        self.patch(poll_manager.session_manager, 'load_session',
+                   load_while_saving)
+        self.assertEqual(
+            (yield poll_manager.sweep_idle_sessions(now=now + 61)), 0)
+        self.assertNotEqual((yield load_session(session_key)), {})
+        self.assertEqual((yield self.redis.hgetall(
+            poll_manager.r_key('offloaded_sessions'))), {})
+
+    @inlineCallbacks
+    def test_archive_offloaded_session(self):
+        poll_manager = PollManager(self.redis, 'idle', session_idle_ttl=60)
+        self.addCleanup(poll_manager.stop)
+        participant = yield poll_manager.get_participant(self.poll_id, 'user')
+        participant.set_label('colour', 'red')
+        yield poll_manager.save_participant(self.poll_id, participant)
+        yield poll_manager.sweep_idle_sessions(now=time.time() + 61)
+        # a participant whose session was offloaded while they were still
+        # active is archived
+        yield poll_manager.save_participant(self.poll_id, participant)
+        yield poll_manager.archive(self.poll_id, participant)
+        participant = yield poll_manager.get_participant(self.poll_id, 'user')
+        self.assertEqual(participant.get_label('colour'), None)
+
+    @inlineCallbacks
+    def test_no_restore_without_offloading(self):
+        def restore_session(session_key):
+            self.fail('Sessions are only restored when offloading.')
+
+        self.patch(self.poll_manager, 'restore_session', restore_session)
+        participant = yield self.poll_manager.get_participant(self.poll_id,
+                                                              'new-user')
+        self.assertEqual(participant.labels, {})
+
+    @inlineCallbacks
+    def test_expire_idle_sessions(self):
+        poll_manager = PollManager(self.redis, 'idle', session_idle_ttl=60,
+                                   session_idle_action='expire')
+        participant = yield poll_manager.get_participant(self.poll_id, 'user')
+        participant.set_label('colour', 'red')
+        yield poll_manager.save_participant(self.poll_id, participant)
+        yield poll_manager.sweep_idle_sessions(now=time.time() + 61)
+        participant = yield poll_manager.get_participant(self.poll_id, 'user')
+        self.assertEqual(participant.get_label('colour'), None)
+        yield poll_manager.stop()
+
+    @inlineCallbacks
+    def test_compressed_storage(self):
+        poll_manager = PollManager(self.redis, 'compressed',
+                                   compress_threshold=0)
+        version = {'questions': self.default_questions}
+        uid = yield poll_manager.set(self.poll_id, version)
+        stored = yield self.redis.hget(
+            poll_manager.r_key('versions', self.poll_id), uid)
+        self.assertTrue(stored.startswith(COMPRESSED_MARKER))
+        self.assertEqual(
+            (yield PollManager(self.redis, 'compressed').get_config(
+                self.poll_id, uid)), version)
+
+        participant = yield poll_manager.get_participant(self.poll_id, 'user')
+        participant.add_received_message(TransportUserMessage(
+            to_addr='123', from_addr='user', transport_name='sphex',
+            transport_type='sms', content='red'))
+        yield poll_manager.save_participant(self.poll_id, participant)
+        session = yield poll_manager.session_manager.load_session(
+            poll_manager.get_session_key(self.poll_id, 'user'))
+        self.assertTrue(
+            session['received_messages'].startswith(COMPRESSED_MARKER))
+        loaded = yield poll_manager.get_participant(self.poll_id, 'user')
+        self.assertEqual(loaded.received_messages,
+                         participant.received_messages)
+
+        yield poll_manager.archive(self.poll_id, loaded)
+        [archived] = yield poll_manager.get_archive(self.poll_id, 'user')
+        self.assertEqual(archived.received_messages,
+                         participant.received_messages)
+        yield poll_manager.stop()
+
     @inlineCallbacks
     def mkpoll_for_export(self, questions=None):
         if questions is None:
@@ -1,11 +1,14 @@
 import json
 from datetime import date, timedelta
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed)
 
 from vumi.application.tests.utils import ApplicationTestCase
 
-from vxpolls.multipoll_example import MultiPollApplication
+from vxpolls.multipoll_example import (
+    MultiPollApplication, EventPublisher, Event, PollSchedule)
 
 
 class MultiPollTestApplication(MultiPollApplication):
@@ -72,6 +75,12 @@ class CustomMultiPollApplicationTestCase(BaseMultiPollApplicationTestCase):
 
     application_class = CustomMultiPollApplication
 
+    # The full runs below walk through dozens of the 57 weekly polls. The
+    # fake redis adds 5ms of real latency to every operation and vumi's
+    # session manager and fixture cleanup issue theirs one at a time, so
+    # these take several seconds regardless of how vxpolls batches its own.
+    timeout = 60
+
     poll_id_prefix = "CUSTOM_POLL_ID_"
 
     gen = CustomMultiPollApplication.poll_id_generator(poll_id_prefix)
@@ -665,6 +674,21 @@ class CustomMultiPollApplicationTestCase(BaseMultiPollApplicationTestCase):
         # And confirm re-run is possible
         yield self.run_inputs(inputs_and_expected)
 
+    @inlineCallbacks
+    def test_setup_polls(self):
+        compiled_polls = self.app.pm.compiled_polls.items
+        self.assertEqual(set(poll_id for poll_id, uid in compiled_polls),
+                         set(self.poll_id_list))
+        # on restart the existing polls are loaded instead of registered
+        compiled_polls.clear()
+        yield self.app.setup_polls()
+        self.assertEqual(set(poll_id for poll_id, uid in compiled_polls),
+                         set(self.poll_id_list))
+        for poll_id in self.poll_id_list:
+            self.assertEqual(len((yield self.app.pm.r_server.zrange(
+                self.app.pm.r_key('version_timestamps', poll_id), 0, -1))),
+                1)
+
 
 class LiveCustomMultiPollApplicationTestCase(BaseMultiPollApplicationTestCase):
 
@@ -1673,3 +1697,105 @@ class LiveMetricsMultiPollApplicationTestCase(
         r_count = yield self.app.get_registered_count(
                                     self.app.config['poll_id_prefix'])
         self.assertEqual(r_count, 0)
+
+
+class EventPublisherTestCase(TestCase):
+
+    def test_concurrent_delivery(self):
+        publisher = EventPublisher(concurrency=2)
+        slow = Deferred()
+        received = []
+        publisher.subscribe('foo', lambda event: slow)
+        publisher.subscribe('foo', received.append)
+        publisher.send(Event('foo'))
+        # the second subscriber isn't held up by the first one
+        self.assertEqual(received, [Event('foo')])
+        self.assertEqual(publisher.get_metrics()['queue_depth'], 1)
+        slow.callback(None)
+        metrics = publisher.get_metrics()
+        self.assertEqual(metrics['queue_depth'], 0)
+        self.assertEqual(metrics['max_queue_depth'], 1)
+        count, total, slowest = metrics['handler_latency']['foo']
+        self.assertEqual(count, 2)
+
+    def test_backpressure(self):
+        publisher = EventPublisher(concurrency=1, max_pending=1)
+        slow = Deferred()
+        publisher.subscribe('foo', lambda event: slow)
+        d = publisher.send(Event('foo'))
+        self.assertFalse(d.called)
+        slow.callback(None)
+        self.assertTrue(d.called)
+
+    @inlineCallbacks
+    def test_batched_delivery(self):
+        publisher = EventPublisher()
+        batches = []
+        publisher.subscribe('foo', batches.append, batch_size=2)
+        for i in range(3):
+            yield publisher.send(Event('foo', index=i))
+        self.assertEqual(batches, [[Event('foo', index=0),
+                                    Event('foo', index=1)]])
+        yield publisher.flush()
+        self.assertEqual(batches[-1], [Event('foo', index=2)])
+
+
+class FakePollManager(object):
+
+    def __init__(self, poll_ids):
+        self.poll_ids = poll_ids
+
+    def polls(self):
+        return succeed(self.poll_ids)
+
+    def exists(self, poll_id):
+        return succeed(poll_id in self.poll_ids)
+
+
+class PollScheduleTestCase(TestCase):
+
+    def setUp(self):
+        self.current_date = date(2012, 5, 24)
+        self.schedule = PollSchedule(lambda: self.current_date,
+                                     poll_ids=['POLL_0', 'POLL_2'])
+
+    def test_get_poll_number(self):
+        self.assertEqual(self.schedule.get_poll_number('2012-05-21'), 36)
+        self.assertEqual(self.schedule.get_poll_number('2012-06-04'), 34)
+        self.assertEqual(self.schedule.poll_numbers, {
+            '2012-05-21': 36,
+            '2012-06-04': 34,
+        })
+
+    def test_get_poll_number_next_week(self):
+        self.assertEqual(self.schedule.get_poll_number('2012-06-04'), 34)
+        self.current_date = date(2012, 5, 28)
+        self.assertEqual(self.schedule.get_poll_number('2012-06-04'), 35)
+        self.assertEqual(self.schedule.poll_numbers, {'2012-06-04': 35})
+
+    def test_get_poll_id(self):
+        self.assertEqual(self.schedule.get_poll_id('POLL_', 3), 'POLL_3')
+        self.assertEqual(self.schedule.poll_ids, {('POLL_', 3): 'POLL_3'})
+
+    @inlineCallbacks
+    def test_refresh(self):
+        self.assertFalse(self.schedule.exists('POLL_0'))
+        yield self.schedule.refresh(FakePollManager(['POLL_0', 'POLL_1']))
+        self.assertTrue(self.schedule.exists('POLL_0'))
+        # only configured polls are routed to
+        self.assertFalse(self.schedule.exists('POLL_1'))
+        self.assertFalse(self.schedule.exists('POLL_2'))
+
+    @inlineCallbacks
+    def test_poll_exists(self):
+        poll_manager = FakePollManager(['POLL_0', 'POLL_1'])
+        yield self.schedule.refresh(poll_manager)
+        self.assertFalse(
+            (yield self.schedule.poll_exists(poll_manager, 'POLL_2')))
+        # imported after the refresh
+        poll_manager.poll_ids.append('POLL_2')
+        self.assertTrue(
+            (yield self.schedule.poll_exists(poll_manager, 'POLL_2')))
+        self.assertTrue(self.schedule.exists('POLL_2'))
+        self.assertFalse(
+            (yield self.schedule.poll_exists(poll_manager, 'POLL_1')))
@@ -0,0 +1,109 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.utils import PersistenceMixin
+
+from vxpolls.manager import PollManager
+from vxpolls.replica import ReplicaRouter
+
+
+class FakeClock(object):
+
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class ReplicaRouterTestCase(PersistenceMixin, TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield self._persist_setUp()
+        self.primary = yield self.get_redis_manager()
+        self.replica = yield self.primary.sub_manager('replica')
+        self.clock = FakeClock()
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def replicate(self, router):
+        """
+        Copy the primary's heartbeat to the replica as replication would.
+        """
+        d = self.primary.get(router.heartbeat_key)
+        return d.addCallback(
+            lambda heartbeat: self.replica.set(router.heartbeat_key,
+                                               heartbeat))
+
+    @inlineCallbacks
+    def test_no_replica(self):
+        router = ReplicaRouter(self.primary)
+        self.assertTrue((yield router.get_read_server()) is self.primary)
+
+    @inlineCallbacks
+    def test_no_staleness_bound(self):
+        router = ReplicaRouter(self.primary, self.replica)
+        self.assertTrue((yield router.get_read_server()) is self.replica)
+
+    @inlineCallbacks
+    def test_staleness_bound(self):
+        router = ReplicaRouter(self.primary, self.replica, max_staleness=5,
+                               clock=self.clock)
+        # no heartbeat has reached the replica yet
+        self.assertEqual((yield router.get_lag()), None)
+        self.assertTrue((yield router.get_read_server()) is self.primary)
+
+        yield router.beat()
+        yield self.replicate(router)
+        self.clock.now += 1
+        self.assertTrue((yield router.get_read_server()) is self.replica)
+        self.assertEqual((yield router.get_lag()), 1)
+
+        # the replica falls behind
+        self.clock.now += 5
+        self.assertTrue((yield router.get_read_server()) is self.primary)
+
+    @inlineCallbacks
+    def test_check_interval(self):
+        router = ReplicaRouter(self.primary, self.replica, max_staleness=5,
+                               check_interval=10, clock=self.clock)
+        yield router.beat()
+        yield self.replicate(router)
+        self.assertTrue((yield router.get_read_server()) is self.replica)
+        # the last measurement is trusted until the check interval passes
+        self.clock.now += 6
+        self.assertTrue((yield router.get_read_server()) is self.replica)
+        self.clock.now += 4
+        self.assertTrue((yield router.get_read_server()) is self.primary)
+
+    @inlineCallbacks
+    def test_poll_manager(self):
+        poll_manager = PollManager(self.primary, read_server=self.replica)
+        self.addCleanup(poll_manager.stop)
+        replica_manager = PollManager(self.replica)
+        self.addCleanup(replica_manager.stop)
+        questions = [{
+            'copy': 'What is your favorite colour?',
+            'label': 'colour',
+            'valid_responses': ['red', 'green', 'blue'],
+        }]
+        # the replica has only seen the first poll
+        yield replica_manager.set('poll-1', {'questions': questions})
+        yield poll_manager.set('poll-1', {'questions': questions})
+        yield poll_manager.set('poll-2', {'questions': questions})
+        self.assertEqual((yield poll_manager.polls()), set(['poll-1']))
+
+        poll = yield poll_manager.get('poll-2')
+        participant = yield poll_manager.get_participant('poll-2', 'user-1')
+        poll.set_last_question(participant,
+                               poll.get_next_question(participant))
+        yield poll.submit_answer(participant, 'red')
+        # writes go to the primary, reports read from the replica
+        self.assertEqual(
+            (yield poll.results_manager.get_users('poll-2')), [])
+        primary_poll = yield PollManager(self.primary).get('poll-2')
+        self.assertEqual(
+            (yield primary_poll.results_manager.get_users('poll-2')),
+            [('user-1', {'colour': 'red'})])
@@ -1,11 +1,25 @@
 # -*- coding: utf-8 -*-
+import json
 
-from twisted.internet.defer import inlineCallbacks
+from datetime import date
+
+from twisted.internet.defer import inlineCallbacks, fail
 
 from vumi.application.tests.utils import ApplicationTestCase
 
+from vxpolls import results
 from vxpolls.results import (
-    ResultManager, ResultManagerException, CollectionException)
+    ResultManager, ResultManagerException, CollectionException,
+    ChangeListeners, AnswerSegment, combine_segments)
+
+
+class FakeTime(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
 
 
 class PollResultsTestCase(ApplicationTestCase):
@@ -161,6 +175,66 @@ class PollResultsTestCase(ApplicationTestCase):
         })
 
 
+    @inlineCallbacks
+    def test_get_crosstab(self):
+        collection_id = 'unique-id'
+        yield self.mk_collection(collection_id)
+        yield self.manager.register_question(collection_id, 'colour',
+                                             ['red', 'blue'])
+        yield self.manager.register_question(collection_id, 'fruit',
+                                             ['apple', 'pear'])
+        answers = [
+            ('user-1', 'red', 'apple'),
+            ('user-2', 'red', 'apple'),
+            ('user-3', 'red', 'pear'),
+            ('user-4', 'blue', 'pear'),
+            ('user-5', 'blue', None),
+        ]
+        for user_id, colour, fruit in answers:
+            yield self.manager.add_result(collection_id, user_id, 'colour',
+                                          colour)
+            if fruit:
+                yield self.manager.add_result(collection_id, user_id,
+                                              'fruit', fruit)
+
+        crosstab = yield self.manager.get_crosstab(collection_id, 'colour',
+                                                   'fruit', chunk_size=2)
+        self.assertEqual(crosstab, {
+            'red': {'apple': 2, 'pear': 1},
+            'blue': {'apple': 0, 'pear': 1},
+        })
+
+        user_ids, coders, columns = yield self.manager.get_answer_matrix(
+            collection_id, ['colour', 'fruit'])
+        self.assertEqual(user_ids, [a[0] for a in answers])
+        self.assertEqual(list(columns['colour']), [2, 2, 2, 1, 1])
+        self.assertEqual(list(columns['fruit']), [1, 1, 2, 2, 0])
+        self.assertEqual(coders['fruit'].decode(0), None)
+
+    @inlineCallbacks
+    def test_get_answer_matrix_coded(self):
+        collection_id = 'unique-id'
+        yield self.mk_collection(collection_id)
+        yield self.manager.register_question(collection_id, 'colour',
+                                             ['red', 'blue'],
+                                             encode_answers=True)
+        yield self.manager.add_result(collection_id, 'user-1', 'colour',
+                                      'red')
+        yield self.manager.add_result(collection_id, 'user-2', 'colour',
+                                      'blue')
+        user_ids, coders, columns = yield self.manager.get_answer_matrix(
+            collection_id, ['colour'])
+        self.assertEqual(list(columns['colour']), [2, 1])
+
+        # a code handed out after the codes were loaded
+        yield self.manager.add_result(collection_id, 'user-3', 'colour',
+                                      'green')
+        user_ids, coders, columns = yield self.manager.get_answer_matrix(
+            collection_id, ['colour'], chunk_size=2)
+        self.assertEqual(user_ids, ['user-1', 'user-2', 'user-3'])
+        self.assertEqual(list(columns['colour']), [2, 1, 3])
+        self.assertEqual(coders['colour'].decode(3), 'green')
+
     @inlineCallbacks
     def test_context_manager_add_result(self):
         collection_id = 'unique-id'
@@ -217,6 +291,447 @@ class PollResultsTestCase(ApplicationTestCase):
             question: 'red',
         })])
 
+    @inlineCallbacks
+    def test_compact_question_ids(self):
+        collection_id = 'unique-id'
+        user_id = '27761234567'
+        question = u'What is your favourite colour? Reply with red or blue'
+        yield self.mk_collection(collection_id)
+        yield self.manager.register_question(collection_id, question,
+                                             ['red', 'blue'])
+        yield self.manager.register_question(collection_id, 'fruit')
+        yield self.manager.add_result(collection_id, user_id, question, 'red')
+
+        question_id = yield self.manager.get_question_id(collection_id,
+                                                         question)
+        self.assertEqual(question_id, '#1')
+        answers_key = self.manager.get_user_answers_key(collection_id,
+                                                        user_id)
+        self.assertEqual((yield self.redis.hgetall(answers_key)),
+                         {'#1': 'red'})
+        self.assertEqual(
+            (yield self.manager.get_question_names(collection_id)),
+            {'#1': question, '#2': 'fruit'})
+
+        user = yield self.manager.get_user(collection_id, user_id)
+        self.assertEqual(user, {question: 'red', 'fruit': None})
+        results = yield self.manager.get_results(collection_id)
+        self.assertEqual(results, {
+            question: {'red': 1, 'blue': 0},
+            'fruit': {},
+        })
+
+        # registering again keeps the same id
+        yield self.manager.register_question(collection_id, question)
+        self.manager.question_ids.clear()
+        self.assertEqual(
+            (yield self.manager.get_question_id(collection_id, question)),
+            '#1')
+
+    @inlineCallbacks
+    def test_encoded_answers(self):
+        collection_id = 'unique-id'
+        question = 'what is your favorite colour?'
+        yield self.mk_collection(collection_id)
+        yield self.manager.register_question(
+            collection_id, question, ['red', 'green', 'blue'],
+            encode_answers=True)
+        yield self.manager.add_result(collection_id, 'user-1', question,
+                                      'blue')
+        yield self.manager.add_result(collection_id, 'user-2', question,
+                                      'red')
+        yield self.manager.add_result(collection_id, 'user-2', question,
+                                      'blue')
+        yield self.manager.add_result(collection_id, 'user-3', question,
+                                      'purple')
+
+        question_id = yield self.manager.get_question_id(collection_id,
+                                                         question)
+        self.assertEqual(question_id, '%1')
+        answers_key = self.manager.get_user_answers_key(collection_id,
+                                                        'user-2')
+        self.assertEqual((yield self.redis.hgetall(answers_key)),
+                         {question_id: '3'})
+        results_key = self.manager.get_results_key(collection_id,
+                                                   question_id)
+        self.assertEqual((yield self.redis.hgetall(results_key)),
+                         {'1': '0', '3': '2', '4': '1'})
+
+        results = yield self.manager.get_results(collection_id)
+        self.assertEqual(results, {
+            question: {'red': 0, 'green': 0, 'blue': 2},
+        })
+        user = yield self.manager.get_user(collection_id, 'user-3')
+        self.assertEqual(user, {question: 'purple'})
+        counts = yield self.manager.count_answers(
+            collection_id, ['user-1', 'user-2', 'user-3'])
+        self.assertEqual(counts, {question: {'blue': 2, 'purple': 1}})
+
+        # a fresh manager reads the codes back from redis
+        manager = ResultManager(self.redis, self.r_prefix)
+        users = yield manager.get_users(collection_id)
+        self.assertEqual(sorted(users), [
+            ('user-1', {question: 'blue'}),
+            ('user-2', {question: 'blue'}),
+            ('user-3', {question: 'purple'}),
+        ])
+
+        # reading results never hands out codes
+        yield self.redis.sadd(
+            manager.get_answers_key(collection_id, question_id), 'orange')
+        results = yield manager.get_results(collection_id)
+        self.assertEqual(results[question]['orange'], 0)
+        codes = yield self.redis.hgetall(
+            manager.get_answer_codes_key(collection_id, question_id))
+        self.assertFalse('orange' in codes)
+
+    @inlineCallbacks
+    def test_cluster_keys(self):
+        manager = ResultManager(self.redis, self.r_prefix, cluster_keys=True)
+        yield manager.register_collection('cid')
+        yield manager.register_question('cid', 'colour', ['red', 'blue'])
+        yield manager.add_result('cid', 'user-1', 'colour', 'red')
+        keys = yield self.redis.keys('test_results:collections:*')
+        self.assertTrue(keys)
+        for key in keys:
+            self.assertTrue(
+                key.startswith('test_results:collections:{cid}:'), key)
+        results = yield manager.get_results('cid')
+        self.assertEqual(results, {'colour': {'red': 1, 'blue': 0}})
+
+    @inlineCallbacks
+    def test_buffered_counters(self):
+        manager = ResultManager(self.redis, self.r_prefix,
+                                counter_flush_interval=60)
+        self.addCleanup(manager.stop)
+        yield manager.register_collection('cid')
+        yield manager.register_question('cid', 'colour', ['red', 'blue'])
+        for user_id in ['user-1', 'user-2', 'user-3']:
+            yield manager.add_result('cid', user_id, 'colour', 'red')
+        yield manager.add_result('cid', 'user-3', 'colour', 'blue')
+        # answers are written immediately, counters once flushed
+        self.assertEqual((yield manager.get_user('cid', 'user-3')),
+                         {'colour': 'blue'})
+        self.assertEqual((yield manager.get_results('cid')),
+                         {'colour': {'red': 0, 'blue': 0}})
+        self.assertEqual(len(manager.counter_buffer), 2)
+        self.assertTrue(manager.counter_flusher.running)
+        yield manager.flush_counters()
+        self.assertEqual((yield manager.get_results('cid')),
+                         {'colour': {'red': 2, 'blue': 1}})
+        self.assertEqual(len(manager.counter_buffer), 0)
+
+        yield manager.add_result('cid', 'user-4', 'colour', 'blue')
+        yield manager.stop()
+        self.assertFalse(manager.counter_flusher.running)
+        self.assertEqual((yield manager.get_results('cid')),
+                         {'colour': {'red': 2, 'blue': 2}})
+
+    @inlineCallbacks
+    def test_buffered_counters_failed_flush(self):
+        manager = ResultManager(self.redis, self.r_prefix,
+                                counter_flush_interval=60)
+        self.addCleanup(manager.stop)
+        yield manager.register_collection('cid')
+        yield manager.register_question('cid', 'colour', ['red', 'blue'])
+        yield manager.add_result('cid', 'user-1', 'colour', 'red')
+        yield manager.add_result('cid', 'user-2', 'colour', 'blue')
+
+        hincrby = self.redis.hincrby
+
+        def failing_hincrby(key, field, amount=1):
+            if field == 'blue':
+                return fail(Exception('Connection lost'))
+            return hincrby(key, field, amount)
+
+        self.patch(self.redis, 'hincrby', failing_hincrby)
+        yield self.assertFailure(manager.flush_counters(), Exception)
+        # only the failed increment is buffered again
+        self.assertEqual((yield manager.get_results('cid')),
+                         {'colour': {'red': 1, 'blue': 0}})
+        self.assertEqual(len(manager.counter_buffer), 1)
+
+        self.patch(self.redis, 'hincrby', hincrby)
+        yield manager.flush_counters()
+        self.assertEqual((yield manager.get_results('cid')),
+                         {'colour': {'red': 1, 'blue': 1}})
+
+    @inlineCallbacks
+    def test_buffered_counters_max_fields(self):
+        manager = ResultManager(self.redis, self.r_prefix,
+                                counter_flush_interval=60,
+                                max_buffered_counters=2)
+        self.addCleanup(manager.stop)
+        yield manager.register_collection('cid')
+        yield manager.register_question('cid', 'colour', ['red', 'blue'])
+        yield manager.add_result('cid', 'user-1', 'colour', 'red')
+        yield manager.add_result('cid', 'user-2', 'colour', 'red')
+        self.assertEqual((yield manager.get_results('cid')),
+                         {'colour': {'red': 0, 'blue': 0}})
+        # the second field fills the buffer
+        yield manager.add_result('cid', 'user-3', 'colour', 'blue')
+        self.assertEqual((yield manager.get_results('cid')),
+                         {'colour': {'red': 2, 'blue': 1}})
+
+    @inlineCallbacks
+    def test_count_respondents(self):
+        fake_time = FakeTime(86400 * 365)
+        self.patch(results, 'time', fake_time)
+        manager = ResultManager(self.redis, self.r_prefix,
+                                count_respondents=True,
+                                daily_respondents_ttl=86400 * 30)
+        yield manager.register_collection('cid')
+        yield manager.register_question('cid', 'colour', ['red', 'blue'])
+        yield manager.register_question('cid', 'fruit')
+        yield manager.add_result('cid', 'user-1', 'colour', 'red')
+        yield manager.add_result('cid', 'user-1', 'fruit', 'apple')
+        yield manager.add_result('cid', 'user-2', 'colour', 'blue')
+        fake_time.now += 86400
+        yield manager.add_result('cid', 'user-2', 'fruit', 'apple')
+        yield manager.add_result('cid', 'user-3', 'colour', 'red')
+
+        first_day = date(1971, 1, 1)
+        second_day = date(1971, 1, 2)
+        self.assertEqual((yield manager.count_respondents('cid')), 3)
+        self.assertEqual(
+            (yield manager.count_respondents('cid', [first_day])), 2)
+        self.assertEqual(
+            (yield manager.count_respondents('cid', [second_day])), 2)
+        self.assertEqual(
+            (yield manager.count_respondents('cid',
+                                             [first_day, second_day])), 3)
+        self.assertEqual(
+            (yield manager.count_respondents('cid', [date(1971, 1, 3)])), 0)
+        day_key = manager.get_respondent_count_key('cid', second_day)
+        self.assertTrue(0 < (yield self.redis.ttl(day_key)) <= 86400 * 30)
+        # not counted unless enabled
+        yield self.manager.add_result('cid', 'user-4', 'colour', 'red')
+        self.assertEqual((yield manager.count_respondents('cid')), 3)
+
+    @inlineCallbacks
+    def test_time_series(self):
+        fake_time = FakeTime(7200)
+        self.patch(results, 'time', fake_time)
+        manager = ResultManager(self.redis, self.r_prefix,
+                                rollup_interval=3600, rollup_retention=86400)
+        yield manager.register_collection('cid')
+        yield manager.register_question('cid', 'colour', ['red', 'blue'])
+        yield manager.add_result('cid', 'user-1', 'colour', 'red')
+        fake_time.now = 7300
+        yield manager.add_result('cid', 'user-2', 'colour', 'red')
+        # answering the same again isn't another vote
+        yield manager.add_result('cid', 'user-2', 'colour', 'red')
+        fake_time.now = 14500
+        yield manager.add_result('cid', 'user-1', 'colour', 'blue')
+        yield manager.add_result('cid', 'user-3', 'colour', 'blue')
+
+        series = yield manager.get_time_series('cid', 'colour', 3600, 14400)
+        self.assertEqual(series, [
+            (3600, {'red': 0, 'blue': 0}),
+            (7200, {'red': 2, 'blue': 0}),
+            (10800, {'red': 0, 'blue': 0}),
+            (14400, {'red': 0, 'blue': 2}),
+        ])
+        # the totals are kept as before
+        self.assertEqual((yield manager.get_results('cid')),
+                         {'colour': {'red': 1, 'blue': 2}})
+        rollup_key = manager.get_rollup_key(
+            'cid', (yield manager.get_question_id('cid', 'colour')), 7200)
+        self.assertTrue(0 < (yield self.redis.ttl(rollup_key)) <= 86400)
+        yield self.assertFailure(
+            self.manager.get_time_series('cid', 'colour', 3600, 14400),
+            ResultManagerException)
+
+    @inlineCallbacks
+    def test_buffered_time_series(self):
+        self.patch(results, 'time', FakeTime(7200))
+        manager = ResultManager(self.redis, self.r_prefix,
+                                counter_flush_interval=60,
+                                rollup_interval=3600, rollup_retention=86400)
+        self.addCleanup(manager.stop)
+        yield manager.register_collection('cid')
+        yield manager.register_question('cid', 'colour', ['red', 'blue'])
+        yield manager.add_result('cid', 'user-1', 'colour', 'red')
+        yield manager.flush_counters()
+        self.assertEqual(
+            (yield manager.get_time_series('cid', 'colour', 7200, 7200)),
+            [(7200, {'red': 1, 'blue': 0})])
+        rollup_key = manager.get_rollup_key(
+            'cid', (yield manager.get_question_id('cid', 'colour')), 7200)
+        self.assertTrue(0 < (yield self.redis.ttl(rollup_key)) <= 86400)
+
+    @inlineCallbacks
+    def test_change_listeners(self):
+        change_listeners = ChangeListeners()
+        manager = ResultManager(self.redis, self.r_prefix,
+                                change_listeners=change_listeners)
+        yield manager.register_collection('cid')
+        yield manager.register_question('cid', 'colour', ['red', 'blue'],
+                                        encode_answers=True)
+        changes = []
+        listener = lambda collection_id, change: changes.append(
+            (collection_id, change))
+        manager.add_change_listener('cid', listener)
+        # managers that share the listeners tell them about their changes
+        other_manager = ResultManager(self.redis, self.r_prefix,
+                                      change_listeners=change_listeners)
+        yield other_manager.add_result('cid', 'user-1', 'colour', 'red')
+        # answering the same again doesn't change anything
+        yield manager.add_result('cid', 'user-1', 'colour', 'red')
+        yield manager.add_result('cid', 'user-1', 'colour', 'blue')
+        self.assertEqual(changes, [
+            ('cid', {'question': 'colour', 'answer': 'red',
+                     'previous': None, 'seq': 1}),
+            ('cid', {'question': 'colour', 'answer': 'blue',
+                     'previous': 'red', 'seq': 2}),
+        ])
+        self.assertEqual((yield manager.get_change_seq('cid')), 2)
+        # the others don't
+        unrelated_manager = ResultManager(self.redis, self.r_prefix)
+        self.assertEqual(unrelated_manager.get_change_listeners('cid'), [])
+
+        manager.remove_change_listener('cid', listener)
+        self.assertEqual(manager.get_change_listeners('cid'), [])
+        yield manager.add_result('cid', 'user-2', 'colour', 'red')
+        self.assertEqual(len(changes), 2)
+
+    @inlineCallbacks
+    def test_publish_changes(self):
+        manager = ResultManager(self.redis, self.r_prefix,
+                                publish_changes=True)
+        yield manager.register_collection('cid')
+        yield manager.register_question('cid', 'colour', ['red', 'blue'])
+        messages = []
+        # the fake redis can't publish
+        self.redis._client.publish = lambda channel, message: (
+            messages.append((channel, json.loads(message))))
+        self.addCleanup(delattr, self.redis._client, 'publish')
+        yield manager.add_result('cid', 'user-1', 'colour', 'red')
+        self.assertEqual(messages, [(
+            self.redis._key(manager.get_changes_channel('cid')),
+            {'question': 'colour', 'answer': 'red', 'previous': None,
+             'seq': 1})])
+
+    def test_combine_segments(self):
+        a, b = set([1, 2]), set([2, 3])
+        self.assertEqual(combine_segments('&', (a, False), (b, False)),
+                         (set([2]), False))
+        self.assertEqual(combine_segments('&', (a, False), (b, True)),
+                         (set([1]), False))
+        self.assertEqual(combine_segments('&', (a, True), (b, True)),
+                         (set([1, 2, 3]), True))
+        self.assertEqual(combine_segments('|', (a, False), (b, False)),
+                         (set([1, 2, 3]), False))
+        self.assertEqual(combine_segments('|', (a, False), (b, True)),
+                         (set([3]), True))
+        self.assertEqual(combine_segments('|', (a, True), (b, True)),
+                         (set([2]), True))
+
+    @inlineCallbacks
+    def test_segments(self):
+        manager = ResultManager(self.redis, self.r_prefix,
+                                index_respondents=True)
+        collection_id = 'unique-id'
+        yield self.mk_collection(collection_id)
+        yield manager.register_question(collection_id, 'colour',
+                                        ['red', 'blue'], encode_answers=True)
+        yield manager.register_question(collection_id, 'fruit')
+        answers = [
+            ('user-0', 'red', 'apple'),
+            ('user-1', 'blue', 'apple'),
+            ('user-2', 'red', 'pear'),
+            ('user-3', 'red', 'apple'),
+            ('user-4', 'blue', None),
+        ]
+        for user_id, colour, fruit in answers:
+            yield manager.add_result(collection_id, user_id, 'colour',
+                                     colour)
+            if fruit:
+                yield manager.add_result(collection_id, user_id, 'fruit',
+                                         fruit)
+        # changing an answer moves the user to the new answer's segment
+        yield manager.add_result(collection_id, 'user-3', 'colour', 'blue')
+
+        red = AnswerSegment('colour', 'red')
+        blue = AnswerSegment('colour', 'blue')
+        apple = AnswerSegment('fruit', 'apple')
+
+        self.assertEqual((yield manager.count_segment(collection_id, red)), 2)
+        self.assertEqual(
+            (yield manager.count_segment(collection_id, blue & apple)), 2)
+        self.assertEqual(
+            (yield manager.count_segment(collection_id, red | apple)), 4)
+        self.assertEqual(
+            (yield manager.count_segment(collection_id, ~apple)), 2)
+        self.assertEqual((yield manager.count_segment(
+            collection_id, AnswerSegment('colour', 'green'))), 0)
+        self.assertEqual(
+            (yield manager.get_segment_users(collection_id, ~red)),
+            ['user-1', 'user-3', 'user-4'])
+        self.assertEqual((yield manager.get_segment_users(
+            collection_id, ~red, offset=1, limit=1)), ['user-3'])
+
+        keys, program = [], []
+        yield manager.compile_segment(
+            collection_id, (red & ~apple) | AnswerSegment('colour', 'green'),
+            keys, program)
+        self.assertEqual(keys, [
+            manager.get_respondents_key(collection_id, '%1', '1'),
+            manager.get_respondents_key(collection_id, '#2', 'apple'),
+        ])
+        self.assertEqual(program, ['1', '2', '~', '&', '0', '|'])
+
+    @inlineCallbacks
+    def test_legacy_question_ids(self):
+        collection_id = 'unique-id'
+        user_id = '27761234567'
+        question = 'what is your favorite colour?'
+        yield self.mk_collection(collection_id)
+        # questions registered before ids existed store answers under
+        # the question's full text
+        yield self.redis.sadd(self.manager.get_questions_key(collection_id),
+                              question)
+        yield self.manager.register_question(collection_id, question,
+                                             ['red', 'blue'])
+        yield self.manager.add_result(collection_id, user_id, question, 'red')
+
+        answers_key = self.manager.get_user_answers_key(collection_id,
+                                                        user_id)
+        self.assertEqual((yield self.redis.hgetall(answers_key)),
+                         {question: 'red'})
+        user = yield self.manager.get_user(collection_id, user_id)
+        self.assertEqual(user, {question: 'red'})
+
+    @inlineCallbacks
+    def test_get_users_since(self):
+        collection_id = 'unique-id'
+        question = 'what is your favorite colour?'
+        fake_time = FakeTime(1000)
+        self.patch(results, 'time', fake_time)
+
+        yield self.mk_collection(collection_id)
+        yield self.manager.register_question(collection_id, question)
+        yield self.manager.add_result(collection_id, 'user-1', question,
+                                      'red')
+        fake_time.now = 2000
+        yield self.manager.add_result(collection_id, 'user-2', question,
+                                      'blue')
+
+        user_ids = yield self.manager.get_updated_user_ids(collection_id,
+                                                           1000)
+        self.assertEqual(user_ids, ['user-2'])
+        users = yield self.manager.get_users(collection_id, since=500)
+        self.assertEqual(sorted(users), [
+            ('user-1', {question: 'red'}),
+            ('user-2', {question: 'blue'}),
+        ])
+
+        fake_time.now = 3000
+        yield self.manager.add_result(collection_id, 'user-1', question,
+                                      'green')
+        users = yield self.manager.get_users(collection_id, since=2000)
+        self.assertEqual(users, [('user-1', {question: 'green'})])
+
     @inlineCallbacks
     def test_get_users_as_csv(self):
         collection_id = 'unique-id'
@@ -0,0 +1,171 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+
+from vumi.tests.utils import PersistenceMixin
+
+from vxpolls.manager import PollManager
+from vxpolls.sharding import HashRing, ShardedResultManager
+
+
+class HashRingTestCase(TestCase):
+
+    def test_get_node(self):
+        ring = HashRing(['a', 'b', 'c'])
+        node = ring.get_node('poll-1')
+        self.assertTrue(node in ['a', 'b', 'c'])
+        self.assertEqual(ring.get_node('poll-1'), node)
+        self.assertEqual(ring.get_node(u'poll-1'), node)
+
+    def test_distribution(self):
+        ring = HashRing(['a', 'b', 'c'])
+        counts = dict.fromkeys(['a', 'b', 'c'], 0)
+        for index in range(3000):
+            counts[ring.get_node('poll-%s' % (index,))] += 1
+        for count in counts.values():
+            self.assertTrue(700 < count < 1300, counts)
+
+    def test_adding_a_node(self):
+        keys = ['poll-%s' % (index,) for index in range(1000)]
+        ring = HashRing(['a', 'b', 'c'])
+        bigger_ring = HashRing(['a', 'b', 'c', 'd'])
+        # only the keys that move to the new node change nodes
+        for key in keys:
+            node = bigger_ring.get_node(key)
+            if node != 'd':
+                self.assertEqual(node, ring.get_node(key))
+
+    def test_no_nodes(self):
+        self.assertRaises(ValueError, HashRing([]).get_node, 'poll-1')
+
+
+class ShardedResultManagerTestCase(PersistenceMixin, TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.shards = {}
+        for name in ['a', 'b', 'c']:
+            self.shards[name] = yield self.redis.sub_manager(name)
+        self.manager = ShardedResultManager(self.shards, 'test_results')
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def find_collection(self, shard_name):
+        for index in range(100):
+            collection_id = 'poll-%s' % (index,)
+            if self.manager.get_shard_name(collection_id) == shard_name:
+                return collection_id
+
+    @inlineCallbacks
+    def test_routing(self):
+        collection_a = self.find_collection('a')
+        collection_b = self.find_collection('b')
+        for collection_id in [collection_a, collection_b]:
+            yield self.manager.register_collection(collection_id)
+            yield self.manager.register_question(
+                collection_id, 'what is your favorite colour?',
+                ['red', 'green', 'blue'])
+        yield self.manager.add_result(
+            collection_a, 'user-1', 'what is your favorite colour?', 'red')
+
+        self.assertEqual((yield self.manager.get_results(collection_a)), {
+            'what is your favorite colour?': {
+                'red': 1, 'green': 0, 'blue': 0},
+        })
+        self.assertEqual(
+            (yield self.manager.get_users(collection_a)),
+            [('user-1', {'what is your favorite colour?': 'red'})])
+        self.assertEqual((yield self.manager.get_users(collection_b)), [])
+        self.assertTrue(
+            self.manager.get_r_server(collection_a) is self.shards['a'])
+
+        # the answers are only stored on the collection's shard
+        users_key = self.manager.get_users_key(collection_a)
+        self.assertEqual(
+            (yield self.shards['a'].smembers(users_key)), set(['user-1']))
+        self.assertEqual((yield self.shards['b'].smembers(users_key)), set())
+
+    @inlineCallbacks
+    def test_get_collections(self):
+        collection_ids = set('poll-%s' % (index,) for index in range(10))
+        for collection_id in collection_ids:
+            yield self.manager.register_collection(collection_id)
+        self.assertEqual((yield self.manager.get_collections()),
+                         collection_ids)
+        # spread across the shards
+        shard_collections = []
+        for shard in self.shards.values():
+            shard_collections.extend((yield shard.smembers(
+                'test_results:collections')))
+        self.assertEqual(sorted(shard_collections), sorted(collection_ids))
+
+    @inlineCallbacks
+    def test_defaults(self):
+        collection_id = self.find_collection('c')
+        yield self.manager.register_collection(collection_id)
+        yield self.manager.register_question(collection_id, 'colour',
+                                             ['red', 'green'])
+        context = self.manager.defaults(collection_id, 'user-1')
+        yield context.add_result('colour', 'green')
+        self.assertEqual((yield context.get_user()), {'colour': 'green'})
+        self.assertEqual(
+            (yield self.shards['c'].smembers(
+                self.manager.get_users_key(collection_id))),
+            set(['user-1']))
+
+    @inlineCallbacks
+    def test_poll_manager(self):
+        poll_manager = PollManager(self.redis, result_shards=self.shards)
+        self.addCleanup(poll_manager.stop)
+        yield poll_manager.set('poll-1', {'questions': [{
+            'copy': 'What is your favorite colour?',
+            'label': 'colour',
+            'valid_responses': ['red', 'green', 'blue'],
+        }]})
+        poll = yield poll_manager.get('poll-1')
+        participant = yield poll_manager.get_participant('poll-1', 'user-1')
+        poll.set_last_question(participant,
+                               poll.get_next_question(participant))
+        yield poll.submit_answer(participant, 'red')
+
+        results_manager = poll.results_manager
+        self.assertEqual((yield results_manager.get_collections()),
+                         set(['poll-1']))
+        shard = results_manager.get_r_server('poll-1')
+        self.assertTrue(shard is
+                        self.shards[results_manager.get_shard_name('poll-1')])
+        self.assertEqual(
+            (yield shard.smembers(results_manager.get_users_key('poll-1'))),
+            set(['user-1']))
+        # the poll itself is stored on the primary
+        self.assertEqual((yield poll_manager.polls()), set(['poll-1']))
+
+    def test_settings(self):
+        manager = ShardedResultManager(self.shards, 'test_results',
+                                       rollup_interval=3600,
+                                       count_respondents=True)
+        self.assertEqual(manager.rollup_interval, 3600)
+        self.assertEqual(manager.count_respondents_enabled, True)
+        self.assertEqual(manager.publish_changes, False)
+        self.assertEqual(manager.r_prefix, 'test_results')
+
+    @inlineCallbacks
+    def test_replicas(self):
+        replica = yield self.redis.sub_manager('replica')
+        poll_manager = PollManager(self.redis, result_shards=self.shards,
+                                   result_shard_replicas={'a': replica})
+        self.addCleanup(poll_manager.stop)
+        yield poll_manager.set('poll-1', {'questions': []})
+        poll = yield poll_manager.get('poll-1')
+        result_managers = poll.results_manager.result_managers
+        self.assertTrue(result_managers['a'].router.read_server is replica)
+        self.assertEqual(result_managers['b'].router.read_server, None)
+        self.assertRaises(ValueError, ShardedResultManager, self.shards,
+                          router=poll_manager.router)
+
+        yield poll_manager.beat_replicas()
+        for shard in self.shards.values():
+            self.assertNotEqual(
+                (yield shard.get('poll_manager:replica_heartbeat')), None)
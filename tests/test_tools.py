@@ -1,15 +1,23 @@
+import time
 import yaml
 import iso8601
 from StringIO import StringIO
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.python import usage
+from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.tests.utils import PersistenceMixin
 
 from vxpolls.tools.exporter import (
-    PollExporter, ParticipantExporter, ArchivedParticipantExporter)
+    PollExporter, ParticipantExporter, ArchivedParticipantExporter,
+    parse_since, read_checkpoint, write_checkpoint)
 from vxpolls.tools.importer import PollImporter
+from vxpolls.tools.benchmark import CodecBenchmark, ImportBenchmark
+from vxpolls.tools.snapshot import PollSnapshotter, Snapshot
+from vxpolls.tools.reconcile import ResultReconciler, ReconcileError
+from vxpolls.tools.migrate_keys import KeyMigrator, escape_pattern
+from vxpolls.results import ResultManager
 from vxpolls.manager import PollManager
 
 
@@ -171,6 +179,48 @@ class ParticipantExportTestCase(PersistenceMixin, TestCase):
         self.assertTrue(
             iso8601.parse_date(exported_data['user-2']['user_timestamp']))
 
+    def test_export_since_checkpoint(self):
+        checkpoint = self.mktemp()
+        options = FakeOptions(
+            options={'poll-id': self.poll_id},
+            subOptions={'include-archived': False, 'checkpoint': checkpoint})
+
+        p1 = self.manager.get_participant(self.poll_id, 'user-1')
+        self.poll.set_last_question(p1, self.poll.get_next_question(p1))
+        self.poll.submit_answer(p1, 'one')
+
+        # without a checkpoint everything is exported
+        self.exporter.export(options)
+        exported_data = dict(yaml.safe_load(self.exporter.stdout.getvalue()))
+        self.assertEqual(exported_data.keys(), ['user-1'])
+        since = read_checkpoint(checkpoint)
+        self.assertTrue(since)
+
+        # move the checkpoint back so user-2 is newer and user-1 older
+        write_checkpoint(checkpoint, since - 1)
+        results_manager = self.poll.results_manager
+        results_manager.r_server.zadd(
+            results_manager.get_updated_key(self.poll_id),
+            **{'user-1': since - 2})
+        p2 = self.manager.get_participant(self.poll_id, 'user-2')
+        self.poll.set_last_question(p2, self.poll.get_next_question(p2))
+        self.poll.submit_answer(p2, 'two')
+
+        self.exporter.stdout = StringIO()
+        self.exporter.export(options)
+        exported_data = dict(yaml.safe_load(self.exporter.stdout.getvalue()))
+        self.assertEqual(exported_data.keys(), ['user-2'])
+        self.assertEqual(exported_data['user-2']['the-question'], 'two')
+        self.assertTrue(read_checkpoint(checkpoint) >= since)
+
+    def test_parse_since(self):
+        self.assertEqual(parse_since('1234.5'), 1234.5)
+        self.assertEqual(parse_since('2013-01-02T03:04:05'), time.mktime(
+            (2013, 1, 2, 3, 4, 5, 0, 0, -1)))
+        self.assertEqual(parse_since('2013-01-02'), time.mktime(
+            (2013, 1, 2, 0, 0, 0, 0, 0, -1)))
+        self.assertRaises(ValueError, parse_since, 'yesterday')
+
     def test_export_with_archives(self):
         p1 = self.manager.get_participant(self.poll_id, 'user-1')
         question = self.poll.get_next_question(p1)
@@ -396,3 +446,317 @@ class ArchivedParticipantExportTestCase(PersistenceMixin, TestCase):
             iso8601.parse_date(exported_data['user1']['user_timestamp']))
         self.assertTrue(
             iso8601.parse_date(exported_data['user2']['user_timestamp']))
+
+
+class PollSnapshotTestCase(PersistenceMixin, TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield self._persist_setUp()
+        self.poll_prefix = 'poll_prefix'
+        self.snapshotter = PollSnapshotter(self.mk_config({
+            'vxpolls': {
+                'prefix': self.poll_prefix,
+            },
+        }))
+        self.manager = PollManager(self.snapshotter.r_server,
+                                   self.poll_prefix)
+        self.poll_id = 'poll-id-1'
+        self.manager.set(self.poll_id, {
+            'batch_size': None,
+            'questions': [{
+                'copy': 'one or two?',
+                'label': 'the-question',
+                'valid_responses': ['one', 'two']
+            }, {
+                'copy': 'yes or no?',
+                'label': 'other-question',
+                'valid_responses': ['yes', 'no']
+            }],
+        })
+        self.poll = self.manager.get(self.poll_id)
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self.snapshotter.pm.stop()
+        yield self.manager.stop()
+        yield self._persist_tearDown()
+
+    def answer(self, user_id, *answers):
+        participant = self.manager.get_participant(self.poll_id, user_id)
+        for answer in answers:
+            question = self.poll.get_next_question(participant)
+            self.poll.set_last_question(participant, question)
+            self.poll.submit_answer(participant, answer)
+
+    def test_snapshot(self):
+        self.answer(u'user-\u1234', 'one', 'yes')
+        self.answer('user-2', 'two', 'yes')
+        self.answer('user-3', 'one')
+
+        path = self.mktemp()
+        self.assertEqual(
+            self.snapshotter.snapshot(self.poll_id, path, chunk_size=2), 3)
+
+        snapshot = Snapshot(path)
+        self.assertEqual(snapshot.rows, 3)
+        self.assertEqual(sorted(snapshot.questions),
+                         ['other-question', 'the-question'])
+        self.assertEqual(list(snapshot.iter_user_ids()),
+                         ['user-2', 'user-3', u'user-\u1234'])
+        self.assertEqual(list(snapshot.iter_answers('the-question')),
+                         ['two', 'one', 'one'])
+        self.assertEqual(list(snapshot.iter_answers('other-question')),
+                         ['yes', None, 'yes'])
+        self.assertEqual(
+            snapshot.get_crosstab('the-question', 'other-question'), {
+                'one': {'yes': 1, 'no': 0},
+                'two': {'yes': 1, 'no': 0},
+            })
+
+    def test_empty_snapshot(self):
+        path = self.mktemp()
+        self.snapshotter.snapshot(self.poll_id, path)
+        snapshot = Snapshot(path)
+        self.assertEqual(snapshot.rows, 0)
+        self.assertEqual(list(snapshot.iter_user_ids()), [])
+        self.assertEqual(list(snapshot.iter_answers('the-question')), [])
+
+    def test_snapshot_writes_nothing(self):
+        self.manager.set('poll-id-2', {
+            'batch_size': None,
+            'questions': [{
+                'copy': 'one or two?',
+                'label': 'the-question',
+                'valid_responses': ['one', 'two']
+            }],
+        })
+        r_server = self.snapshotter.r_server
+        keys = sorted(r_server.keys())
+        self.assertEqual(
+            self.snapshotter.snapshot('poll-id-2', self.mktemp()), 0)
+        self.assertEqual(sorted(r_server.keys()), keys)
+
+    def test_unknown_poll(self):
+        self.assertRaises(usage.UsageError, self.snapshotter.snapshot,
+                          'unknown-poll', self.mktemp())
+
+
+class KeyMigratorTestCase(PersistenceMixin, TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield self._persist_setUp()
+        self.poll_prefix = 'poll_prefix'
+        self.migrator = KeyMigrator(self.mk_config({
+            'vxpolls': {
+                'prefix': self.poll_prefix,
+            },
+        }))
+        self.migrator.stdout = StringIO()
+        self.r_server = self.migrator.r_server
+        self.manager = PollManager(self.r_server, self.poll_prefix,
+                                   indexed_labels=['colour'])
+        self.poll_id = 'poll-id-1'
+        self.manager.set(self.poll_id, {
+            'questions': [{
+                'copy': 'one or two?',
+                'label': 'the-question',
+                'valid_responses': ['one', 'two']
+            }],
+        })
+        poll = self.manager.get(self.poll_id)
+        for user_id, answer in [('user-1', 'one'), ('user-2', 'two')]:
+            participant = self.manager.get_participant(self.poll_id, user_id)
+            participant.set_label('colour', 'red')
+            poll.set_last_question(participant,
+                                   poll.get_next_question(participant))
+            poll.submit_answer(participant, answer)
+            self.manager.save_participant(self.poll_id, participant)
+
+    @inlineCallbacks
+    def tearDown(self):
+        self.migrator.stop()
+        yield self.manager.stop()
+        yield self._persist_tearDown()
+
+    def get_cluster_manager(self):
+        manager = PollManager(self.r_server, self.poll_prefix,
+                              indexed_labels=['colour'], cluster_keys=True)
+        self.addCleanup(manager.stop)
+        return manager
+
+    def test_escape_pattern(self):
+        self.assertEqual(escape_pattern('a*b?c[d]'), 'a[*]b[?]c[[]d]')
+
+    def test_migrate(self):
+        copied = self.migrator.migrate()
+        self.assertTrue(copied > 0)
+        keys = self.r_server.keys()
+        self.assertTrue(
+            'poll_prefix:versions:{poll-id-1}' in keys)
+        self.assertTrue(
+            'poll_prefix:poll:results:collections:{poll-id-1}:users:'
+            'results:user-1' in keys)
+
+        manager = self.get_cluster_manager()
+        poll = manager.get(self.poll_id)
+        self.assertEqual(poll.questions[0]['label'], 'the-question')
+        self.assertEqual(
+            poll.results_manager.get_results(self.poll_id), {
+                'the-question': {'one': 1, 'two': 1},
+            })
+        self.assertEqual(
+            sorted(manager.find_participants(self.poll_id, [
+                ['equal', 'colour', 'red']])),
+            ['user-1', 'user-2'])
+
+    def test_migrate_dry_run(self):
+        keys = self.r_server.keys()
+        copied = self.migrator.migrate(dry_run=True)
+        self.assertEqual(len(self.migrator.stdout.getvalue().splitlines()),
+                         copied)
+        self.assertEqual(sorted(self.r_server.keys()), sorted(keys))
+
+    def test_migrate_delete(self):
+        self.migrator.migrate(delete=True)
+        self.assertEqual(self.r_server.keys('poll_prefix:versions:poll*'),
+                         [])
+        self.assertEqual(self.migrator.migrate(), 0)
+
+
+class ResultReconcilerTestCase(PersistenceMixin, TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield self._persist_setUp()
+        self.redis = yield self.get_redis_manager()
+        self.results_manager = ResultManager(self.redis, 'poll_prefix')
+        self.reconciler = ResultReconciler(self.results_manager,
+                                           chunk_size=2, concurrency=2,
+                                           clock_skew=0)
+        self.reconciler.stdout = StringIO()
+        self.collection_id = 'poll-id-1'
+        yield self.results_manager.register_collection(self.collection_id)
+        yield self.results_manager.register_question(
+            self.collection_id, 'colour', ['red', 'blue'])
+        for index, answer in enumerate(['red', 'red', 'blue', 'red', 'blue']):
+            yield self.results_manager.add_result(
+                self.collection_id, 'user-%s' % (index,), 'colour', answer)
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    @inlineCallbacks
+    def test_reconcile(self):
+        question_id = yield self.results_manager.get_question_id(
+            self.collection_id, 'colour')
+        results_key = self.results_manager.get_results_key(
+            self.collection_id, question_id)
+        yield self.redis.hincrby(results_key, 'red', 2)
+        yield self.redis.hincrby(results_key, 'blue', -1)
+        yield self.redis.hincrby(results_key, 'green', 1)
+
+        expected_diff = {
+            u'colour': {
+                u'red': (5, 3),
+                u'blue': (1, 2),
+                u'green': (1, 0),
+            },
+        }
+        diff = yield self.reconciler.reconcile(self.collection_id,
+                                               dry_run=True)
+        self.assertEqual(diff, expected_diff)
+        results = yield self.results_manager.get_results(self.collection_id)
+        self.assertEqual(results['colour'], {'red': 5, 'blue': 1})
+
+        diff = yield self.reconciler.reconcile(self.collection_id)
+        self.assertEqual(diff, expected_diff)
+        results = yield self.results_manager.get_results(self.collection_id)
+        self.assertEqual(results['colour'], {'red': 3, 'blue': 2})
+        diff = yield self.reconciler.diff(self.collection_id)
+        self.assertEqual(diff, {})
+        self.assertEqual(self.reconciler.stdout.getvalue(), ''.join([
+            'colour: blue: 1 -> 2\n',
+            'colour: green: 1 -> 0\n',
+            'colour: red: 5 -> 3\n',
+        ] * 2))
+
+    @inlineCallbacks
+    def test_reconcile_while_answering(self):
+        question_id = yield self.results_manager.get_question_id(
+            self.collection_id, 'colour')
+        results_key = self.results_manager.get_results_key(
+            self.collection_id, question_id)
+        yield self.redis.hincrby(results_key, 'red', 2)
+        count = self.reconciler.count
+        answers = [('user-0', 'blue'), ('user-5', 'red')]
+
+        @inlineCallbacks
+        def count_while_answering(collection_id):
+            totals = yield count(collection_id)
+            # a user changes their answer and a new one answers after
+            # being counted
+            if answers:
+                user_id, answer = answers.pop(0)
+                yield self.results_manager.add_result(
+                    collection_id, user_id, 'colour', answer)
+            returnValue(totals)
+
+        self.patch(self.reconciler, 'count', count_while_answering)
+        yield self.reconciler.reconcile(self.collection_id)
+        # the count was retried and no answers were lost
+        results = yield self.results_manager.get_results(self.collection_id)
+        self.assertEqual(results['colour'], {'red': 3, 'blue': 3})
+        self.assertEqual((yield self.reconciler.diff(self.collection_id)),
+                         {})
+
+        # answers that keep coming in are never counted over
+        self.reconciler.attempts = 2
+        answers.extend([('user-0', 'red'), ('user-1', 'blue')])
+        yield self.assertFailure(self.reconciler.reconcile(self.collection_id),
+                                 ReconcileError)
+
+
+class CodecBenchmarkTestCase(TestCase):
+
+    def test_run(self):
+        benchmark = CodecBenchmark(questions=20, messages=5, rounds=2)
+        benchmark.stdout = StringIO()
+        results = benchmark.run()
+        self.assertEqual([r[0] for r in results], [
+            'poll version', 'message history', 'archived participant'])
+        for name, plain, stored, encode_time, decode_time in results:
+            self.assertTrue(stored < plain)
+        lines = benchmark.stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].startswith('poll version'))
+
+
+class ImportBenchmarkTestCase(TestCase):
+
+    # trial changes the working directory before running the tests, the
+    # path is resolved here while relative entries still point at the
+    # right place
+    path = ImportBenchmark().path
+
+    def test_run(self):
+        benchmark = ImportBenchmark(
+            modules=['vxpolls', 'vxpolls.manager'], rounds=1)
+        benchmark.path = self.path
+        benchmark.stdout = StringIO()
+        results = benchmark.run()
+        self.assertEqual([r[0] for r in results],
+                         ['vxpolls', 'vxpolls.manager'])
+        lines = benchmark.stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[1].startswith('vxpolls '))
+
+    def test_lazy_package(self):
+        benchmark = ImportBenchmark(rounds=1)
+        benchmark.path = self.path
+        _, package_loaded = benchmark.time_import('vxpolls')
+        _, manager_loaded = benchmark.time_import('vxpolls.manager')
+        # importing the package on its own doesn't import the manager
+        self.assertTrue(package_loaded < 10)
+        self.assertTrue(manager_loaded > package_loaded)
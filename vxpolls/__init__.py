@@ -1,4 +1,36 @@
-from vxpolls.manager import PollManager, Poll
-from vxpolls.participant import PollParticipant
+import sys
+from types import ModuleType
 
-__all__ = ['PollManager', 'PollParticipant', 'Poll']
\ No newline at end of file
+__all__ = ['PollManager', 'PollParticipant', 'Poll']
+
+# The package attributes are imported the first time they're used so that
+# importing a submodule, `vxpolls.participant` from Django or a tool's
+# `--help`, doesn't pull in Twisted and vumi's persistence layer.
+_lazy_attributes = {
+    'PollManager': 'vxpolls.manager',
+    'Poll': 'vxpolls.manager',
+    'PollParticipant': 'vxpolls.participant',
+}
+
+
+class _LazyModule(ModuleType):
+
+    def __getattr__(self, name):
+        module_name = _lazy_attributes.get(name)
+        if module_name is None:
+            raise AttributeError("'module' object has no attribute %r" % (
+                name,))
+        value = getattr(__import__(module_name, fromlist=[name]), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(self.__dict__) | set(_lazy_attributes))
+
+
+_module = _LazyModule(__name__)
+_module.__dict__.update(sys.modules[__name__].__dict__)
+# Python 2 clears the globals of a module once it's garbage collected,
+# keep the original around since `_LazyModule` relies on them.
+_module._original_module = sys.modules[__name__]
+sys.modules[__name__] = _module
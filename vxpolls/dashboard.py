@@ -1,12 +1,31 @@
 # -*- test-case-name: tests.test_dashboard -*-
 import json
+import time
+from datetime import datetime
 
 from twisted.application.service import Service
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.web import http
 from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import log
+
+from txredis.client import RedisSubscriber, RedisSubscriberFactory
+
+from vxpolls.scripts import get_channel
+
+
+class DashboardError(Exception):
+    """
+    Raised by `get_data` to answer with an HTTP error `code` instead.
+    """
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+        self.message = message
 
 
 class GeckoboardResourceBase(Resource):
@@ -20,8 +39,13 @@ class GeckoboardResourceBase(Resource):
 
     @inlineCallbacks
     def do_render_GET(self, request):
-        json_data = yield self.get_data(request)
-        request.setResponseCode(http.OK)
+        try:
+            json_data = yield self.get_data(request)
+        except DashboardError, e:
+            request.setResponseCode(e.code)
+            json_data = {"error": e.message}
+        else:
+            request.setResponseCode(http.OK)
         request.setHeader("content-type", "application/json")
         request.write(json.dumps(json_data))
         request.finish()
@@ -33,6 +57,18 @@ class GeckoboardResourceBase(Resource):
     def get_data(self, request):
         raise NotImplementedError("Sub-classes should implement get_data")
 
+    @inlineCallbacks
+    def get_poll(self, collection_id):
+        """
+        Return the latest version of the poll behind `collection_id`,
+        whose results manager has that version's settings.
+        """
+        poll = yield self.poll_manager.get(collection_id)
+        if poll is None:
+            raise DashboardError(http.NOT_FOUND,
+                                 'Unknown poll %s.' % (collection_id,))
+        returnValue(poll)
+
 
 class PollResultsResource(GeckoboardResourceBase):
 
@@ -55,6 +91,22 @@ class PollResultsResource(GeckoboardResourceBase):
         })
 
 
+class PollCrosstabResource(GeckoboardResourceBase):
+
+    @inlineCallbacks
+    def get_data(self, request):
+        collection_id = request.args['collection_id'][0]
+        row_question = request.args['row'][0].decode('utf8')
+        column_question = request.args['column'][0].decode('utf8')
+        results = yield self.results_manager.get_crosstab(
+            collection_id, row_question, column_question)
+        returnValue({
+            "row": row_question,
+            "column": column_question,
+            "results": results,
+        })
+
+
 class PollActiveResource(GeckoboardResourceBase):
 
     @inlineCallbacks
@@ -82,6 +134,85 @@ class PollActiveResource(GeckoboardResourceBase):
         })
 
 
+class PollRespondentsResource(GeckoboardResourceBase):
+    """
+    The number of unique respondents, along with today's, as a Geckoboard
+    number widget. Needs a poll with `count_respondents`.
+    """
+
+    @inlineCallbacks
+    def get_data(self, request):
+        collection_id = request.args['collection_id'][0]
+        poll = yield self.get_poll(collection_id)
+        results_manager = poll.results_manager
+        if not results_manager.count_respondents_enabled:
+            raise DashboardError(http.BAD_REQUEST,
+                'Respondents are not counted for poll %s.' % (collection_id,))
+        total = yield results_manager.count_respondents(collection_id)
+        today = yield results_manager.count_respondents(
+            collection_id, [datetime.utcnow().date()])
+        returnValue({
+            "item": [
+                {"value": total, "text": "Respondents"},
+                {"value": today, "text": "Today"},
+            ]
+        })
+
+
+class PollTimeSeriesResource(GeckoboardResourceBase):
+    """
+    The answers given to a question per rollup bucket as a Geckoboard
+    line chart, either of one `answer` or of all of them. Shows the last
+    `buckets` buckets, 24 by default and at most `max_buckets`. Needs a
+    poll with a `rollup_interval`.
+    """
+
+    max_buckets = 1000
+
+    def get_buckets(self, request):
+        buckets = request.args.get('buckets', ['24'])[0]
+        try:
+            buckets = int(buckets)
+        except ValueError:
+            buckets = 0
+        if buckets <= 0:
+            raise DashboardError(http.BAD_REQUEST,
+                'buckets must be a positive integer, not %r.' % (
+                    request.args['buckets'][0],))
+        return min(buckets, self.max_buckets)
+
+    @inlineCallbacks
+    def get_data(self, request):
+        collection_id = request.args['collection_id'][0]
+        question = request.args['question'][0].decode('utf8')
+        answer = request.args.get('answer', [None])[0]
+        buckets = self.get_buckets(request)
+        poll = yield self.get_poll(collection_id)
+        results_manager = poll.results_manager
+        interval = results_manager.rollup_interval
+        if not interval:
+            raise DashboardError(http.BAD_REQUEST,
+                'Rollups are not enabled for poll %s.' % (collection_id,))
+        end = time.time()
+        series = yield results_manager.get_time_series(
+            collection_id, question, end - (buckets - 1) * interval, end)
+        if answer is None:
+            values = [sum(counts.values()) for bucket, counts in series]
+        else:
+            answer = answer.decode('utf8')
+            values = [counts.get(answer, 0) for bucket, counts in series]
+        label_format = '%H:%M' if interval < 86400 else '%Y-%m-%d'
+        returnValue({
+            "item": values,
+            "settings": {
+                "axisx": [time.strftime(label_format, time.gmtime(bucket))
+                          for bucket, counts in series],
+                "axisy": [min(values or [0]), max(values or [0])],
+                "colour": "4F993C",
+            },
+        })
+
+
 class PollCompletedResource(GeckoboardResourceBase):
 
     def get_completed(self, collection_id):
@@ -152,13 +283,231 @@ class PollUsersCSVResource(Resource):
         return NOT_DONE_YET
 
 
+class ChangeSubscriber(RedisSubscriber):
+
+    def connectionMade(self):
+        d = RedisSubscriber.connectionMade(self)
+        d.addCallback(lambda _: self.factory.stream.subscriber_connected(self))
+        return d
+
+    def connectionLost(self, reason):
+        self.factory.stream.subscriber_disconnected(self)
+        RedisSubscriber.connectionLost(self, reason)
+
+    def messageReceived(self, channel, message):
+        self.factory.stream.channel_message(channel, message)
+
+
+class ChangeSubscriberFactory(RedisSubscriberFactory):
+    protocol = ChangeSubscriber
+
+    def __init__(self, stream, db=None, password=None):
+        RedisSubscriberFactory.__init__(self, db=db, password=password)
+        self.stream = stream
+
+
+class ResultStream(object):
+    """
+    Sends the changes to the results of collections to the requests of
+    `PollLiveResultsResource` as Server-Sent Events.
+
+    Changes come from the results manager's change listeners, which see
+    the answers submitted in this process. With a `subscriber`, the
+    `redis_subscriber` of the dashboard's config, a redis config with the
+    `host`, `port`, `db` and `password` like the `redis_manager` of the
+    poll applications, changes are received over a single Redis
+    subscription instead, for polls that run elsewhere with
+    `publish_result_changes`. Either way every collection is listened to
+    once however many requests are streaming it.
+
+    Every `keepalive_interval` seconds a comment is sent so that proxies
+    don't close quiet streams.
+    """
+
+    keepalive_interval = 15
+
+    def __init__(self, results_manager, subscriber=None):
+        self.results_manager = results_manager
+        self.subscriber_config = subscriber
+        self.subscriber_connector = None
+        self.subscriber = None
+        self.clients = {}
+        self.channels = {}
+        self.keepalive = LoopingCall(self.send_keepalive)
+
+    def start(self):
+        if self.subscriber_config is not None:
+            config = self.subscriber_config
+            self.subscriber_connector = reactor.connectTCP(
+                config.get('host', 'localhost'), config.get('port', 6379),
+                ChangeSubscriberFactory(self, config.get('db'),
+                                        config.get('password')))
+        self.keepalive.start(self.keepalive_interval, now=False)
+
+    def stop(self):
+        if self.keepalive.running:
+            self.keepalive.stop()
+        for collection_id in self.clients.keys():
+            for request in list(self.clients.get(collection_id, {})):
+                request.finish()
+        if self.subscriber_connector is not None:
+            self.subscriber_connector.factory.stopTrying()
+            self.subscriber_connector.disconnect()
+
+    def get_channel(self, collection_id):
+        results_manager = self.results_manager
+        r_server = results_manager.get_r_server(collection_id)
+        return get_channel(r_server,
+                           results_manager.get_changes_channel(collection_id))
+
+    def subscriber_connected(self, subscriber):
+        self.subscriber = subscriber
+        if self.channels:
+            subscriber.subscribe(*self.channels.keys())
+
+    def subscriber_disconnected(self, subscriber):
+        if self.subscriber is subscriber:
+            self.subscriber = None
+
+    def channel_message(self, channel, message):
+        collection_id = self.channels.get(channel)
+        if collection_id is not None:
+            self.publish(collection_id, json.loads(message))
+
+    def is_streaming(self, collection_id, request):
+        return request in self.clients.get(collection_id, {})
+
+    def add(self, collection_id, request):
+        """
+        Start streaming the changes to `collection_id` to `request`,
+        changes are queued until `ready` is called.
+        """
+        if collection_id not in self.clients:
+            self.clients[collection_id] = {}
+            if self.subscriber_config is None:
+                self.results_manager.add_change_listener(collection_id,
+                                                         self.publish)
+            else:
+                channel = self.get_channel(collection_id)
+                self.channels[channel] = collection_id
+                if self.subscriber is not None:
+                    self.subscriber.subscribe(channel)
+        self.clients[collection_id][request] = []
+
+    def ready(self, collection_id, request, seq):
+        """
+        Send the changes queued for `request` and any that follow, except
+        for those numbered up to `seq` which the snapshot already counts.
+        Those are dropped even when they arrive after the snapshot, as
+        changes published by other processes can.
+        """
+        clients = self.clients.get(collection_id, {})
+        queue = clients.get(request)
+        if isinstance(queue, list):
+            for change in queue:
+                if change['seq'] > seq:
+                    self.send_change(request, change)
+            # once sent, the snapshot's seq is kept instead of a queue
+            clients[request] = seq
+
+    def remove(self, collection_id, request):
+        clients = self.clients.get(collection_id, {})
+        clients.pop(request, None)
+        if not clients and collection_id in self.clients:
+            del self.clients[collection_id]
+            if self.subscriber_config is None:
+                self.results_manager.remove_change_listener(collection_id,
+                                                            self.publish)
+            else:
+                channel = self.get_channel(collection_id)
+                self.channels.pop(channel, None)
+                if self.subscriber is not None:
+                    self.subscriber.unsubscribe(channel)
+
+    def publish(self, collection_id, change):
+        for request, queue in self.clients.get(collection_id, {}).items():
+            if isinstance(queue, list):
+                queue.append(change)
+            elif change['seq'] > queue:
+                self.send_change(request, change)
+
+    def send_change(self, request, change):
+        data = dict(change)
+        self.send(request, 'change', data, data.pop('seq'))
+
+    def send(self, request, event, data, seq):
+        request.write('id: %s\nevent: %s\ndata: %s\n\n' % (
+            seq, event, json.dumps(data)))
+
+    def send_keepalive(self):
+        for clients in self.clients.values():
+            for request in clients:
+                request.write(': keepalive\n\n')
+
+
+class PollLiveResultsResource(Resource):
+    """
+    Streams a collection's results as Server-Sent Events. A `snapshot`
+    event with all the results is followed by a `change` event, with the
+    `question`, the new `answer` and the `previous` answer, whenever a
+    participant's answer changes the counts. The id of every event is
+    the number of the collection's last change it includes.
+    """
+
+    isLeaf = True
+
+    def __init__(self, results_manager, stream):
+        Resource.__init__(self)
+        self.results_manager = results_manager
+        self.stream = stream
+
+    @inlineCallbacks
+    def do_render_GET(self, request, collection_id):
+        # the changes numbered up to `seq` are counted in the results,
+        # the ones queued meanwhile are only sent if they're newer
+        seq = yield self.results_manager.get_change_seq(collection_id)
+        results = yield self.results_manager.get_results(collection_id)
+        self.stream.send(request, 'snapshot', results, seq)
+        self.stream.ready(collection_id, request, seq)
+
+    def render_error(self, failure, collection_id, request):
+        log.err(failure)
+        # unless the request went away while the snapshot was read
+        if self.stream.is_streaming(collection_id, request):
+            request.finish()
+
+    def render_GET(self, request):
+        collection_id = request.args['collection_id'][0]
+        request.setResponseCode(http.OK)
+        request.setHeader("content-type", "text/event-stream")
+        request.setHeader("cache-control", "no-cache")
+        # changes made while the snapshot is read are queued until it's
+        # sent
+        self.stream.add(collection_id, request)
+        request.notifyFinish().addBoth(
+            lambda _: self.stream.remove(collection_id, request))
+        d = self.do_render_GET(request, collection_id)
+        d.addErrback(self.render_error, collection_id, request)
+        return NOT_DONE_YET
+
+
 class InstructionsResource(Resource):
 
+    crosstab_link = (
+        '                <li><a target="_blank" href="crosstab?'
+        'collection_id=%(collection_id)s&amp;row=%(question)s&amp;'
+        'column=%(column_question)s">Answers to \'%(question)s\' broken '
+        'down by \'%(column_question)s\'</a></li>\n')
+
     def __init__(self, config):
         Resource.__init__(self)
         self.config = config
 
     def render_GET(self, request):
+        params = dict(self.config, crosstab_link='')
+        # crosstabs need a second question to break the first down by
+        if 'column_question' in self.config:
+            params['crosstab_link'] = self.crosstab_link % self.config
         request.write("""
 <!DOCTYPE html PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN"
    "http://www.w3.org/TR/html4/loose.dtd">
@@ -203,8 +552,11 @@ class InstructionsResource(Resource):
             <ul>
                 <li><a target="_blank" href="active">Active Participants</a></li>
                 <li><a target="_blank" href="completed?collection_id=%(collection_id)s">Completed Surveys</a></li>
+                <li><a target="_blank" href="respondents?collection_id=%(collection_id)s">Unique Respondents</a></li>
+                <li><a target="_blank" href="timeseries?collection_id=%(collection_id)s&amp;question=%(question)s">Answers to '%(question)s' over time</a></li>
+                <li><a target="_blank" href="live?collection_id=%(collection_id)s">Live results (Server-Sent Events)</a></li>
                 <li><a target="_blank" href="results?collection_id=%(collection_id)s&amp;question=%(question)s">Results for question '%(question)s'</a></li>
-            </ul>
+%(crosstab_link)s            </ul>
             <strong>Data export</strong>
             <ul>
                 <li><a href="users.csv?collection_id=%(collection_id)s">User data</a></li>
@@ -233,13 +585,13 @@ class InstructionsResource(Resource):
         </div>
     </div>
 </body>
-</html>""" % self.config)
+</html>""" % params)
         request.finish()
         return NOT_DONE_YET
 
 class PollResource(Resource):
 
-    def __init__(self, poll_manager, results_manager, config):
+    def __init__(self, poll_manager, results_manager, config, stream=None):
         Resource.__init__(self)
         path_prefix = config['path']
         request_path_bits = filter(None, path_prefix.split('/'))
@@ -255,10 +607,19 @@ class PollResource(Resource):
         parent = reduce(create_node, request_path_bits, self)
         parent.putChild('results',
             PollResultsResource(poll_manager, results_manager))
+        parent.putChild('crosstab',
+            PollCrosstabResource(poll_manager, results_manager))
         parent.putChild('active',
             PollActiveResource(poll_manager, results_manager))
         parent.putChild('completed',
             PollCompletedResource(poll_manager, results_manager))
+        parent.putChild('respondents',
+            PollRespondentsResource(poll_manager, results_manager))
+        parent.putChild('timeseries',
+            PollTimeSeriesResource(poll_manager, results_manager))
+        parent.putChild('live',
+            PollLiveResultsResource(results_manager,
+                stream or ResultStream(results_manager)))
         parent.putChild('results.csv',
             PollResultsCSVResource(results_manager))
         parent.putChild('users.csv',
@@ -270,15 +631,19 @@ class PollDashboardServer(Service):
     def __init__(self, poll_manager, results_manager, config):
         self.webserver = None
         self.port = config['port']
+        self.stream = ResultStream(results_manager,
+                                   config.get('redis_subscriber'))
         self.site_factory = Site(PollResource(poll_manager, results_manager,
-            config))
+            config, self.stream))
 
     @inlineCallbacks
     def startService(self):
+        self.stream.start()
         self.webserver = yield reactor.listenTCP(self.port,
                                                  self.site_factory)
 
     @inlineCallbacks
     def stopService(self):
+        self.stream.stop()
         if self.webserver is not None:
             yield self.webserver.loseConnection()
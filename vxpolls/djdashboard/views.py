@@ -9,8 +9,20 @@ from vumi.persist.redis_manager import RedisManager
 
 
 redis = RedisManager.from_config(settings.VXPOLLS_REDIS_CONFIG)
-
-poll_manager = PollManager(redis, settings.VXPOLLS_PREFIX)
+replica = None
+replica_config = getattr(settings, 'VXPOLLS_REPLICA_REDIS_CONFIG', None)
+if replica_config is not None:
+    replica = RedisManager.from_config(replica_config)
+result_shards = dict(
+    (name, RedisManager.from_config(shard_config))
+    for name, shard_config in getattr(
+        settings, 'VXPOLLS_RESULT_SHARDS', {}).items())
+
+poll_manager = PollManager(
+    redis, settings.VXPOLLS_PREFIX, read_server=replica,
+    max_replica_staleness=getattr(
+        settings, 'VXPOLLS_MAX_REPLICA_STALENESS', None),
+    result_shards=result_shards or None)
 
 def json_response(obj):
     return HttpResponse(json.dumps(obj), content_type='application/javascript')
@@ -4,11 +4,13 @@ import hashlib
 import json
 
 from twisted.internet.defer import inlineCallbacks, maybeDeferred, returnValue
+from twisted.internet.task import LoopingCall
 
 from vumi.persist.txredis_manager import TxRedisManager
 from vumi.application.base import ApplicationWorker
 
 from vxpolls.manager import PollManager, PollQuestion
+from vxpolls.invitations import PollInviter
 
 
 class PollApplication(ApplicationWorker):
@@ -22,12 +24,103 @@ class PollApplication(ApplicationWorker):
         self.questions = self.config.get('questions', [])
         self.survey_completed_responses = self.config.get(
             'survey_completed_responses', [])
-        self.r_config = self.config.get('redis_manager', {})
         self.batch_size = self.config.get('batch_size', 5)
+        self.validate_common_config()
+        self.poll_id = self.config.get('poll_id') or self.generate_unique_id()
+
+    def validate_common_config(self):
+        """
+        Read the settings shared with `MultiPollApplication`.
+        """
+        self.r_config = self.config.get('redis_manager', {})
         self.dashboard_port = int(self.config.get('dashboard_port', 8000))
         self.dashboard_prefix = self.config.get('dashboard_path_prefix', '/')
         self.poll_prefix = self.config.get('poll_prefix', 'poll_manager')
-        self.poll_id = self.config.get('poll_id') or self.generate_unique_id()
+        self.compress_threshold = self.config.get('compress_threshold')
+        self.indexed_labels = self.config.get('indexed_labels', [])
+        self.cluster_keys = self.config.get('cluster_keys', False)
+        self.result_shards_config = self.config.get('result_shards', {})
+        self.counter_flush_interval = self.config.get(
+            'counter_flush_interval')
+        self.atomic_answers = self.config.get('atomic_answers', False)
+        self.publish_result_changes = self.config.get(
+            'publish_result_changes', False)
+        self.invite_rate = self.config.get('invite_rate')
+        self.invite_concurrency = self.config.get('invite_concurrency', 10)
+        self.invite_batch_size = self.config.get('invite_batch_size', 1000)
+        self.validate_session_config()
+
+    def validate_session_config(self):
+        self.session_idle_ttl = self.config.get('session_idle_ttl')
+        self.session_idle_action = self.config.get('session_idle_action',
+                                                   'offload')
+        self.session_sweep_interval = self.config.get(
+            'session_sweep_interval', 300)
+        self.session_sweep_limit = self.config.get('session_sweep_limit',
+                                                   1000)
+
+    def get_poll_manager(self):
+        return PollManager(self.redis, self.poll_prefix,
+                           compress_threshold=self.compress_threshold,
+                           indexed_labels=self.indexed_labels,
+                           session_idle_ttl=self.session_idle_ttl,
+                           session_idle_action=self.session_idle_action,
+                           cluster_keys=self.cluster_keys,
+                           result_shards=self.result_shards,
+                           counter_flush_interval=self.counter_flush_interval,
+                           atomic_answers=self.atomic_answers,
+                           publish_result_changes=self.publish_result_changes)
+
+    @inlineCallbacks
+    def setup_result_shards(self):
+        """
+        Connect to the Redis nodes that poll results are sharded across
+        when `result_shards`, a redis config per shard name, is
+        configured.
+        """
+        self.result_shards = None
+        if self.result_shards_config:
+            self.result_shards = {}
+            for name, r_config in self.result_shards_config.items():
+                self.result_shards[name] = yield TxRedisManager.from_config(
+                    r_config)
+
+    @inlineCallbacks
+    def close_result_shards(self):
+        for r_server in (self.result_shards or {}).values():
+            yield r_server.close_manager()
+
+    def start_session_sweeper(self):
+        """
+        Periodically offload or expire idle sessions when a
+        `session_idle_ttl` is configured.
+        """
+        self.session_sweeper = None
+        if self.session_idle_ttl:
+            self.session_sweeper = LoopingCall(
+                self.pm.sweep_idle_sessions, limit=self.session_sweep_limit)
+            self.session_sweeper.start(self.session_sweep_interval,
+                                       now=False)
+
+    def stop_session_sweeper(self):
+        if self.session_sweeper and self.session_sweeper.running:
+            self.session_sweeper.stop()
+
+    def start_replica_heartbeat(self):
+        """
+        Periodically write the heartbeats that readers with a
+        `max_replica_staleness` measure the replicas' lag with, when a
+        `replica_heartbeat_interval` is configured.
+        """
+        self.replica_heartbeat = None
+        interval = self.config.get('replica_heartbeat_interval')
+        if interval:
+            self.replica_heartbeat = LoopingCall(self.pm.beat_replicas)
+            self.replica_heartbeat.start(interval)
+
+    def stop_replica_heartbeat(self):
+        if self.replica_heartbeat and self.replica_heartbeat.running:
+            self.replica_heartbeat.stop()
 
     def generate_unique_id(self):
         return hashlib.md5(json.dumps(self.config)).hexdigest()
@@ -35,7 +128,10 @@ class PollApplication(ApplicationWorker):
     @inlineCallbacks
     def setup_application(self):
         self.redis = yield TxRedisManager.from_config(self.r_config)
-        self.pm = PollManager(self.redis, self.poll_prefix)
+        yield self.setup_result_shards()
+        self.pm = self.get_poll_manager()
+        self.start_session_sweeper()
+        self.start_replica_heartbeat()
         exists = yield self.pm.exists(self.poll_id)
         if not exists:
             yield self.pm.register(self.poll_id, {
@@ -43,9 +139,42 @@ class PollApplication(ApplicationWorker):
                 'survey_completed_responses': self.survey_completed_responses,
                 'batch_size': self.batch_size,
             })
+        else:
+            yield self.pm.warm_up([self.poll_id])
 
+    @inlineCallbacks
     def teardown_application(self):
-        return self.pm.stop()
+        self.stop_session_sweeper()
+        self.stop_replica_heartbeat()
+        yield self.pm.stop()
+        yield self.close_result_shards()
+
+    def get_inviter(self, poll_id):
+        return PollInviter(self, poll_id, rate=self.invite_rate,
+                           concurrency=self.invite_concurrency,
+                           batch_size=self.invite_batch_size)
+
+    @inlineCallbacks
+    def load_invitee(self, poll_id, msisdn):
+        """
+        Return the `(session_poll_id, participant, poll)` an invitation
+        to `poll_id` asks the next question of. The participant's session
+        is saved under `session_poll_id`, which replies carry as their
+        `poll_id` helper metadata.
+        """
+        participant = yield self.pm.get_participant(poll_id, msisdn)
+        poll = yield self.pm.get_poll_for_participant(poll_id, participant)
+        participant.set_poll_uid(poll.uid)
+        participant.questions_per_session = poll.batch_size
+        returnValue((poll_id, participant, poll))
+
+    def invite(self, poll_id, msisdns):
+        """
+        Send the first question of `poll_id` to every MSISDN in
+        `msisdns`, limited by the `invite_rate` (messages per second) and
+        `invite_concurrency` config values. See `PollInviter`.
+        """
+        return self.get_inviter(poll_id).invite(msisdns)
 
     @inlineCallbacks
     def consume_user_message(self, message):
@@ -82,7 +211,8 @@ class PollApplication(ApplicationWorker):
     @inlineCallbacks
     def on_message(self, participant, poll, message):
         content = message['content']
-        error_message = yield poll.submit_answer(participant, content)
+        error_message = yield self.pm.submit_answer(poll, participant,
+                                                    content)
         if error_message:
             yield self.reply_to(message, error_message)
         else:
@@ -96,16 +226,15 @@ class PollApplication(ApplicationWorker):
     @inlineCallbacks
     def end_session(self, participant, poll, message):
         next_question = poll.get_next_question(participant)
-        config = yield self.pm.get_config(poll.poll_id)
         if next_question:
-            response = config.get('batch_completed_response',
-                                    self.batch_completed_response)
+            response = (poll.batch_completed_response or
+                        self.batch_completed_response)
             participant.batch_completed()
             yield self.reply_to(message, response, continue_session=False)
         else:
-            default_response = config.get('survey_completed_response',
-                self.survey_completed_response)
-            response = yield self.pm.get_completed_response(participant, poll,
+            default_response = (poll.survey_completed_response or
+                                self.survey_completed_response)
+            response = poll.get_completed_response(participant,
                 default_response)
             yield self.reply_to(message, response,
                 continue_session=False)
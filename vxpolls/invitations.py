@@ -0,0 +1,145 @@
+# -*- test-case-name: tests.test_invitations -*-
+import copy
+from itertools import islice
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, gatherResults, succeed,
+    DeferredSemaphore)
+from twisted.internet.task import deferLater
+
+from vumi import log
+
+
+class RateLimiter(object):
+    """
+    Hands out slots no faster than `rate` per second. A `rate` of `None`
+    doesn't limit anything.
+    """
+
+    def __init__(self, rate=None, clock=reactor):
+        self.rate = rate
+        self.clock = clock
+        self.next_slot = None
+
+    def acquire(self):
+        if not self.rate:
+            return succeed(None)
+        now = self.clock.seconds()
+        slot = max(now, self.next_slot or now)
+        self.next_slot = slot + 1.0 / self.rate
+        if slot <= now:
+            return succeed(None)
+        return deferLater(self.clock, slot - now, lambda: None)
+
+
+class PollInviter(object):
+    """
+    Sends the first question of a poll to a list of MSISDNs through the
+    outbound path of a `PollApplication`, starting a session for each.
+
+    Progress is kept in a Redis hash so an interrupted run can be
+    restarted with the same MSISDNs and picks up after the last completed
+    batch. Participants who already have a question waiting for an
+    answer are skipped, which makes re-inviting a partially completed
+    batch harmless.
+
+    :param PollApplication app:
+        The application whose poll manager and outbound path to use,
+        participants are loaded with its `load_invitee`.
+    :param str poll_id:
+        The poll to invite participants to, the scope id for a
+        `MultiPollApplication`.
+    :param float rate:
+        The maximum number of invitations to send per second.
+    :param int concurrency:
+        The maximum number of invitations in flight at any one time.
+    :param int batch_size:
+        How many MSISDNs to read from the stream at a time, progress is
+        recorded after every batch.
+    """
+
+    OUTCOMES = ('sent', 'skipped', 'failed')
+
+    def __init__(self, app, poll_id, rate=None, concurrency=10,
+                 batch_size=1000, clock=reactor):
+        self.app = app
+        self.pm = app.pm
+        self.poll_id = poll_id
+        self.limiter = RateLimiter(rate, clock)
+        self.semaphore = DeferredSemaphore(concurrency)
+        self.batch_size = batch_size
+
+    def get_progress_key(self):
+        return self.pm.get_poll_key('invitations', self.poll_id)
+
+    @inlineCallbacks
+    def get_progress(self):
+        """
+        Return the number of MSISDNs read so far as `position` along with
+        the number of invitations `sent`, `skipped` and `failed`.
+        """
+        progress = yield self.pm.r_server.hgetall(self.get_progress_key())
+        returnValue(dict((field, int(progress.get(field, 0)))
+                         for field in ('position',) + self.OUTCOMES))
+
+    def reset_progress(self):
+        return self.pm.r_server.delete(self.get_progress_key())
+
+    @inlineCallbacks
+    def invite(self, msisdns):
+        """
+        Invite every MSISDN in the iterable `msisdns` that hasn't been
+        read by a previous run and return the progress.
+        """
+        progress = yield self.get_progress()
+        msisdns = islice(iter(msisdns), progress['position'], None)
+        progress_key = self.get_progress_key()
+        while True:
+            batch = list(islice(msisdns, self.batch_size))
+            if not batch:
+                break
+            outcomes = yield gatherResults([
+                self.semaphore.run(self.invite_participant, msisdn)
+                for msisdn in batch])
+            for outcome in self.OUTCOMES:
+                count = outcomes.count(outcome)
+                if count:
+                    yield self.pm.r_server.hincrby(progress_key, outcome,
+                                                   count)
+            yield self.pm.r_server.hincrby(progress_key, 'position',
+                                           len(batch))
+        progress = yield self.get_progress()
+        returnValue(progress)
+
+    @inlineCallbacks
+    def invite_participant(self, msisdn):
+        try:
+            session_poll_id, participant, poll = yield self.app.load_invitee(
+                self.poll_id, msisdn)
+            if (participant.has_unanswered_question or
+                    not poll.has_more_questions_for(participant)):
+                returnValue('skipped')
+            unsent = (participant.has_unanswered_question,
+                      copy.deepcopy(participant.polls))
+            next_question = poll.get_next_question(participant)
+            content = yield maybeDeferred(self.app.ask_question, participant,
+                                          poll, next_question)
+            yield self.limiter.acquire()
+            try:
+                yield self.app.send_to(msisdn, content, helper_metadata={
+                    'poll_id': session_poll_id,
+                })
+            except Exception:
+                # ask_question may have saved the participant already,
+                # undo it so a resumed run invites them again.
+                participant.has_unanswered_question, participant.polls = (
+                    unsent)
+                yield self.pm.save_participant(session_poll_id, participant)
+                raise
+            yield self.pm.save_participant(session_poll_id, participant)
+        except Exception:
+            log.err(None, 'Unable to invite %s to %s' % (msisdn,
+                                                        self.poll_id))
+            returnValue('failed')
+        returnValue('sent')
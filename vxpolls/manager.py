@@ -1,41 +1,217 @@
 # -*- test-case-name: tests.test_manager -*-
+import copy
 import time
 import json
 import hashlib
 import csv
+from collections import OrderedDict
 from datetime import datetime
 from StringIO import StringIO
 
-from twisted.internet.defer import returnValue
+from twisted.internet.defer import returnValue, maybeDeferred
 
-from vumi.components.session import SessionManager
+from vumi import log
 from vumi.persist.redis_base import Manager
 
-from vxpolls.participant import PollParticipant
-from vxpolls.results import ResultManager
+from vxpolls.participant import PollParticipant, compress, decompress
+from vxpolls.results import (
+    ResultManager, ResultManagerException, CollectionException,
+    ChangeListeners, gather, hash_tag)
+from vxpolls.scripts import RECORD_ANSWER, SWEEP_SESSION
+from vxpolls.replica import ReplicaRouter
+from vxpolls.sharding import ShardedResultManager
+
+
+class PollManagerException(Exception):
+    pass
+
+
+class LRUCache(object):
+    """
+    A dict like cache that holds at most `max_size` items, the least
+    recently used are dropped first and passed to `on_evict` if given.
+    """
+
+    def __init__(self, max_size, on_evict=None):
+        self.max_size = max_size
+        self.on_evict = on_evict
+        self.items = OrderedDict()
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        value = self.items.pop(key)
+        self.items[key] = value
+        return value
+
+    def values(self):
+        return self.items.values()
+
+    def __setitem__(self, key, value):
+        self.items.pop(key, None)
+        self.items[key] = value
+        while len(self.items) > self.max_size:
+            _, evicted = self.items.popitem(last=False)
+            if self.on_evict is not None:
+                self.on_evict(evicted)
 
 
 class PollManager(object):
-    def __init__(self, r_server, r_prefix='poll_manager'):
+    """
+    :param int compress_threshold:
+        Poll versions, archived participants and message histories that
+        serialise to at least this many bytes are stored zlib compressed.
+        Defaults to `None` which never compresses. Compressed and plain
+        values can be read regardless of this setting.
+    :param list indexed_labels:
+        Participant labels to maintain secondary indexes for when
+        participants are saved, see `find_participants`.
+    :param int session_idle_ttl:
+        Seconds after which `sweep_idle_sessions` removes sessions that
+        haven't been saved. Defaults to `None` which keeps them forever.
+    :param str session_idle_action:
+        Either `offload`, which moves idle sessions to compressed storage
+        from where they're restored on the participant's next contact, or
+        `expire`, which deletes them.
+    :param bool cluster_keys:
+        If true, the keys of a poll's versions, label indexes and results
+        are hash tagged by poll id so they're stored in the same Redis
+        Cluster slot. Existing data has to be migrated with
+        `vxpolls.tools.migrate_keys` before enabling this.
+    :param read_server:
+        A redis manager for a read-only replica. Listing polls and
+        archived participants and reading results for reports and
+        exports use it, everything else uses `r_server`.
+    :param float max_replica_staleness:
+        How many seconds the replica may lag behind before reads fall
+        back to `r_server`, see `ReplicaRouter`. Defaults to `None`
+        which always reads from the replica.
+    :param dict result_shards:
+        Redis managers keyed by shard name to store the results of polls
+        on, see `ShardedResultManager`. Polls, sessions and everything
+        else stay on `r_server`. Results are read from the shards, not
+        from `read_server`. Defaults to `None` which stores results on
+        `r_server`.
+    :param dict result_shard_replicas:
+        Redis managers for read-only replicas of `result_shards`, keyed
+        by the name of the shard they replicate. Reports read the
+        results of those shards from them, subject to
+        `max_replica_staleness`.
+    :param float counter_flush_interval:
+        If set, the answer counters of polls are buffered in memory and
+        written every this many seconds, see `ResultManager`. `stop`
+        writes what's still buffered.
+    :param bool publish_result_changes:
+        If true, changes to the results of polls are published on Redis
+        channels for live dashboards in other processes, see
+        `ResultManager`.
+    :param bool atomic_answers:
+        If true, `submit_answer` records the answer, adjusts the counters
+        and saves the participant's session with a single Lua script so
+        that an answer is never half applied. Polls with sharded or
+        buffered results, rollups, indexed respondents or hash tagged
+        keys, and connections that can't run scripts, fall back to
+        writing them one by one. After an atomic answer
+        `save_participant` only writes the session fields that changed.
+    :param int cache_size:
+        How many question records, stored versions and polls to keep
+        cached locally, the least recently used are dropped first.
+    """
+    def __init__(self, r_server, r_prefix='poll_manager',
+                 compress_threshold=None, indexed_labels=None,
+                 session_idle_ttl=None, session_idle_action='offload',
+                 cluster_keys=False, read_server=None,
+                 max_replica_staleness=None, result_shards=None,
+                 result_shard_replicas=None, counter_flush_interval=None,
+                 atomic_answers=False, publish_result_changes=False,
+                 cache_size=1000):
         # create a manager attribute so the @calls_manager works
         self.r_server = self.manager = r_server
         self.r_prefix = r_prefix
+        self.compress_threshold = compress_threshold
+        self.indexed_labels = indexed_labels or []
+        if session_idle_action not in ('offload', 'expire'):
+            raise ValueError('Unknown session_idle_action %r.' % (
+                session_idle_action,))
+        self.session_idle_ttl = session_idle_ttl
+        self.session_idle_action = session_idle_action
+        self.cluster_keys = cluster_keys
+        self.result_shards = result_shards
+        self.counter_flush_interval = counter_flush_interval
+        self.atomic_answers = atomic_answers
+        self.publish_result_changes = publish_result_changes
+        # shared by the results managers of every poll so listeners hear
+        # about the changes made through any version of a poll
+        self.change_listeners = ChangeListeners()
+        self.router = ReplicaRouter(
+            self.r_server, read_server, max_replica_staleness,
+            heartbeat_key=self.r_key('replica_heartbeat'))
+        result_shard_replicas = result_shard_replicas or {}
+        self.result_routers = dict(
+            (name, ReplicaRouter(
+                shard, result_shard_replicas.get(name),
+                max_replica_staleness,
+                heartbeat_key=self.r_key('replica_heartbeat')))
+            for name, shard in (result_shards or {}).items())
+        # Imported here, it's only needed once there's a connection.
+        from vumi.components.session import SessionManager
         self.sr_server = self.r_server.sub_manager(self.r_key())
         self.session_manager = SessionManager(self.sr_server)
+        # Local caches of content addressed question records and of the
+        # stored versions, both are immutable once written.
+        self.question_records = LRUCache(cache_size)
+        self.stored_versions = LRUCache(cache_size)
+        # Polls built from those versions, set up with their results
+        # manager, keyed by poll_id and uid.
+        self.compiled_polls = LRUCache(cache_size, self.evict_poll)
+        # Bumped by every `sweep_idle_sessions` run that finds idle
+        # sessions, see `save_participant`.
+        self.sweeps = 0
+
+    def evict_poll(self, poll):
+        # Nothing else stops the results manager of a poll that's no
+        # longer cached, write its buffered counters now.
+        d = maybeDeferred(poll.results_manager.stop)
+        d.addErrback(log.err, 'Unable to stop the results of %s' % (
+            poll.poll_id,))
+
+    @Manager.calls_manager
+    def beat_replicas(self):
+        """
+        Write the heartbeat of `r_server` and of every result shard, see
+        `ReplicaRouter`.
+        """
+        yield self.router.beat()
+        for name in sorted(self.result_routers):
+            yield self.result_routers[name].beat()
 
     def r_key(self, *args):
         parts = [self.r_prefix]
         parts.extend(args)
         return ':'.join(map(unicode, parts))
 
+    def get_poll_key(self, name, poll_id, *args):
+        if self.cluster_keys:
+            poll_id = hash_tag(poll_id)
+        return self.r_key(name, poll_id, *args)
+
     def generate_unique_id(self, version):
         return hashlib.md5(json.dumps(version)).hexdigest()
 
     def exists(self, poll_id):
         return self.r_server.sismember(self.r_key('polls'), poll_id)
 
+    @Manager.calls_manager
     def polls(self):
-        return self.r_server.smembers(self.r_key('polls'))
+        r_server = yield self.router.get_read_server()
+        polls = yield r_server.smembers(self.r_key('polls'))
+        returnValue(polls)
 
     @Manager.calls_manager
     def set(self, poll_id, version):
@@ -46,14 +222,67 @@ class PollManager(object):
         # string conversion (which rounds/truncates to 10ms precision).
         uid = self.generate_unique_id(version)
         yield self.r_server.sadd(self.r_key('polls'), poll_id)
-        yield self.r_server.hset(self.r_key('versions', poll_id), uid,
-                                    json.dumps(version))
-        key = self.r_key('version_timestamps', poll_id)
+        stored_version = yield self.store_questions(version)
+        yield self.r_server.hset(self.get_poll_key('versions', poll_id), uid,
+                                    compress(json.dumps(stored_version),
+                                             self.compress_threshold))
+        key = self.get_poll_key('version_timestamps', poll_id)
         yield self.r_server.zadd(key, **{
             uid: repr(time.time()),
         })
         returnValue(uid)
 
+    @Manager.calls_manager
+    def store_questions(self, version):
+        """
+        Store the questions of a version as content addressed records
+        shared by all versions of all polls and return a copy of the version
+        that references them by `question_refs` instead of embedding them.
+        """
+        stored_version = version.copy()
+        questions = stored_version.pop('questions', None)
+        if questions is None:
+            returnValue(version)
+        records_key = self.r_key('question_records')
+        refs = []
+        new_records = OrderedDict()
+        for question in questions:
+            record = json.dumps(question, sort_keys=True)
+            ref = hashlib.md5(record).hexdigest()
+            if ref not in self.question_records:
+                new_records[ref] = record
+            refs.append(ref)
+        yield gather([self.r_server.hsetnx(records_key, ref, record)
+                      for ref, record in new_records.items()])
+        for ref, record in new_records.items():
+            self.question_records[ref] = record
+        stored_version['question_refs'] = refs
+        returnValue(stored_version)
+
+    @Manager.calls_manager
+    def load_questions(self, stored_version):
+        """
+        Reassemble a version stored by `store_questions`. Versions stored
+        with their questions embedded are returned as is.
+        """
+        refs = stored_version.pop('question_refs', None)
+        if refs is None:
+            returnValue(stored_version)
+        records_key = self.r_key('question_records')
+        records = []
+        for ref in refs:
+            record = self.question_records.get(ref)
+            if record is None:
+                record = yield self.r_server.hget(records_key, ref)
+                if record is None:
+                    raise PollManagerException(
+                        'Question record %s is missing.' % (ref,))
+                self.question_records[ref] = record
+            records.append(record)
+        stored_version['questions'] = json.loads('[%s]' % (
+            ','.join(records),))
+        returnValue(stored_version)
+
     @Manager.calls_manager
     def register(self, poll_id, version):
         uid = yield self.set(poll_id, version)
@@ -62,7 +291,7 @@ class PollManager(object):
 
     @Manager.calls_manager
     def get_latest_uid(self, poll_id):
-        timestamps_key = self.r_key('version_timestamps', poll_id)
+        timestamps_key = self.get_poll_key('version_timestamps', poll_id)
         uids = yield self.r_server.zrange(timestamps_key, 0, -1, desc=True)
         if uids:
             returnValue(uids[0])
@@ -75,22 +304,35 @@ class PollManager(object):
         if uid is None:
             uid = yield self.get_latest_uid(poll_id)
         if uid:
-            versions_key = self.r_key('versions', poll_id)
-            json_data = yield self.r_server.hget(versions_key, uid)
-            returnValue(json.loads(json_data))
+            json_data = self.stored_versions.get((poll_id, uid))
+            if json_data is None:
+                versions_key = self.get_poll_key('versions', poll_id)
+                json_data = yield self.r_server.hget(versions_key, uid)
+                if json_data is not None:
+                    json_data = decompress(json_data)
+                    self.stored_versions[(poll_id, uid)] = json_data
+            version = yield self.load_questions(json.loads(json_data))
+            returnValue(version)
 
         returnValue({})
 
     @Manager.calls_manager
     def uid_exists(self, poll_id, uid):
-        versions_key = self.r_key('versions', poll_id)
+        versions_key = self.get_poll_key('versions', poll_id)
         exists = yield self.r_server.hexists(versions_key, uid)
         returnValue(exists)
 
     @Manager.calls_manager
     def get(self, poll_id, uid=None):
-        if not (yield self.uid_exists(poll_id, uid)):
+        # versions are never changed, a cached poll's uid exists
+        poll = self.compiled_polls.get((poll_id, uid))
+        if poll is not None:
+            returnValue(poll)
+        if uid is None or not (yield self.uid_exists(poll_id, uid)):
             uid = yield self.get_latest_uid(poll_id)
+            poll = self.compiled_polls.get((poll_id, uid))
+            if poll is not None:
+                returnValue(poll)
         version = yield self.get_config(poll_id, uid)
         if version:
             repeatable = version.get('repeatable', True)
@@ -98,14 +340,49 @@ class PollManager(object):
             poll = yield Poll.mkpoll(
                 self.r_server, poll_id, uid, version['questions'],
                 version.get('batch_size'), r_prefix=self.r_key('poll'),
-                repeatable=repeatable, case_sensitive=case_sensitive)
+                repeatable=repeatable, case_sensitive=case_sensitive,
+                encode_answers=version.get('encode_answers', False),
+                index_respondents=version.get('index_respondents', False),
+                count_respondents=version.get('count_respondents', False),
+                daily_respondents_ttl=version.get('daily_respondents_ttl'),
+                rollup_interval=version.get('rollup_interval'),
+                rollup_retention=version.get('rollup_retention'),
+                cluster_keys=self.cluster_keys, router=self.router,
+                result_shards=self.result_shards,
+                result_routers=self.result_routers,
+                counter_flush_interval=self.counter_flush_interval,
+                publish_changes=self.publish_result_changes,
+                change_listeners=self.change_listeners,
+                survey_completed_responses=version.get(
+                    'survey_completed_responses'),
+                batch_completed_response=version.get(
+                    'batch_completed_response'),
+                survey_completed_response=version.get(
+                    'survey_completed_response'))
+            self.compiled_polls[(poll_id, uid)] = poll
             returnValue(poll)
 
+    @Manager.calls_manager
+    def warm_up(self, poll_ids):
+        """
+        Load the latest version of each of `poll_ids` into the local
+        caches so the first message for a poll doesn't pay for it.
+        Returns the polls that exist.
+        """
+        polls = []
+        for poll_id in poll_ids:
+            poll = yield self.get(poll_id)
+            if poll is not None:
+                polls.append(poll)
+        returnValue(polls)
+
     @Manager.calls_manager
     def get_participant(self, poll_id, user_id):
         # TODO
         session_key = self.get_session_key(poll_id, user_id)
         session_data = yield self.session_manager.load_session(session_key)
+        if not session_data and self.offloads_sessions():
+            session_data = yield self.restore_session(session_key)
         participant = PollParticipant(user_id, session_data)
         returnValue(participant)
 
@@ -114,20 +391,317 @@ class PollManager(object):
 
     @Manager.calls_manager
     def save_participant(self, poll_id, participant):
-        participant.updated_at = time.time()
         session_key = self.get_session_key(poll_id, participant.user_id)
-        yield self.session_manager.save_session(session_key,
-                                    participant.clean_dump())
+        session = participant.clean_dump(self.compress_threshold)
+        written_key, written, sweeps = (participant.written_session or
+                                        (None, {}, None))
+        if written_key == session_key and sweeps == self.sweeps:
+            # An atomic `submit_answer` has written the session already
+            # and it hasn't been swept since, only the fields that
+            # changed need writing.
+            changed = dict((key, value) for key, value in session.items()
+                           if written.get(key) != value)
+            if not changed:
+                returnValue(None)
+            participant.updated_at = session['updated_at'] = time.time()
+            changed['updated_at'] = participant.updated_at
+            participant.written_session = (session_key, session, sweeps)
+            session = changed
+        else:
+            participant.updated_at = session['updated_at'] = time.time()
+        yield self.session_manager.save_session(session_key, session)
+        yield self.touch_session(session_key, participant.updated_at)
+        yield self.index_labels(poll_id, participant.user_id,
+                                participant.labels)
+
+    def can_submit_atomically(self, poll):
+        results_manager = poll.results_manager
+        return (self.atomic_answers and
+                isinstance(results_manager, ResultManager) and
+                results_manager.counter_buffer is None and
+                not results_manager.rollup_interval and
+                not results_manager.index_respondents and
+                not self.cluster_keys and
+                RECORD_ANSWER.is_supported(self.r_server))
+
+    @Manager.calls_manager
+    def submit_answer(self, poll, participant, answer,
+                      custom_answer_logic=None, session_poll_id=None):
+        """
+        Submit `answer` to the participant's last question of `poll`,
+        returns the question's copy if the answer isn't valid. See
+        `Poll.submit_answer`.
+
+        With `atomic_answers` the result and the participant's session
+        are written in one round trip, see `vxpolls.scripts`.
+
+        :param str session_poll_id:
+            The poll id the participant's session is saved under, if it
+            isn't `poll`'s.
+        """
+        if not self.can_submit_atomically(poll):
+            error_message = yield poll.submit_answer(
+                participant, answer, custom_answer_logic)
+            returnValue(error_message)
+        poll_question = poll.get_last_question(participant)
+        assert poll_question, 'Need a question to submit an answer for'
+        if not (answer and poll_question.answer(answer)):
+            returnValue(poll_question.copy)
+        if poll_question.label is not None:
+            participant.set_label(poll_question.label, answer)
+        participant.interactions += 1
+        participant.updated_at = time.time()
+
+        results_manager = poll.results_manager
+        poll_id = poll.poll_id
+        user_id = participant.user_id
+        question = poll_question.label_or_copy()
+        question_id = yield results_manager.get_question_id(poll_id,
+                                                            question)
+        field = yield results_manager.encode_answer(poll_id, question_id,
+                                                    answer)
+        session_poll_id = session_poll_id or poll_id
+        session_key = self.get_session_key(session_poll_id, user_id)
+        keys = [
+            results_manager.get_collections_key(),
+            results_manager.get_questions_key(poll_id),
+            results_manager.get_users_key(poll_id),
+            results_manager.get_updated_key(poll_id),
+            results_manager.get_user_answers_key(poll_id, user_id),
+            results_manager.get_results_key(poll_id, question_id),
+            self.r_key('session', session_key),
+            results_manager.get_change_counter_key(poll_id),
+        ]
+        args = [poll_id, question, user_id, repr(participant.updated_at),
+                question_id, field]
+        session = participant.clean_dump(self.compress_threshold)
+        for item in sorted(session.items()):
+            args.extend(item)
+        reply = yield RECORD_ANSWER(self.r_server, keys, args)
+        status = int(reply[0])
+        if status == 1:
+            raise CollectionException('%s is an unknown collection.' % (
+                poll_id,))
+        elif status == 2:
+            raise ResultManagerException(
+                '%s is an unknown question.' % (question.encode('utf-8'),))
+        participant.written_session = (session_key, session, self.sweeps)
+        previous, seq = reply[1], int(reply[2])
+        publish = (results_manager.publish_changes or
+                   results_manager.get_change_listeners(poll_id))
+        if publish and seq:
+            if previous:
+                previous = yield results_manager.decode_answer(
+                    poll_id, question_id, previous)
+            yield results_manager.publish_change(poll_id, {
+                'question': question,
+                'answer': answer,
+                'previous': previous or None,
+            }, seq)
+        if results_manager.count_respondents_enabled:
+            yield results_manager.add_respondent(poll_id, user_id)
+        # Like `Poll.submit_answer` the custom logic runs once the answer
+        # is recorded, what it changes is written by `save_participant`.
+        if poll_question.label is not None and custom_answer_logic:
+            yield custom_answer_logic(participant, answer, poll_question)
+        yield self.touch_session(session_key, participant.updated_at)
+        yield self.index_labels(session_poll_id, user_id, participant.labels)
 
     @Manager.calls_manager
     def clone_participant(self, participant, poll_id, new_id):
         participant.updated_at = time.time()
         session_key = self.get_session_key(poll_id, new_id)
         yield self.session_manager.save_session(session_key,
-                                    participant.clean_dump())
+            participant.clean_dump(self.compress_threshold))
+        yield self.touch_session(session_key, participant.updated_at)
+        yield self.index_labels(poll_id, new_id, participant.labels)
         clone = yield self.get_participant(poll_id, new_id)
         returnValue(clone)
 
+    def touch_session(self, session_key, timestamp):
+        if not self.session_idle_ttl:
+            return
+        return self.r_server.zadd(self.r_key('session_activity'), **{
+            session_key.encode('utf-8') if isinstance(session_key, unicode)
+            else session_key: timestamp,
+        })
+
+    def offloads_sessions(self):
+        return bool(self.session_idle_ttl and
+                    self.session_idle_action == 'offload')
+
+    @Manager.calls_manager
+    def sweep_idle_sessions(self, limit=1000, now=None):
+        """
+        Offload or expire, depending on `session_idle_action`, at most
+        `limit` of the sessions that haven't been saved for
+        `session_idle_ttl` seconds, oldest first. Returns the number of
+        sessions swept. Meant to be called periodically.
+
+        Sessions saved while they're being swept are left alone, with
+        `SWEEP_SESSION` the check and the sweep are atomic.
+        """
+        if not self.session_idle_ttl:
+            returnValue(0)
+        now = time.time() if now is None else now
+        idle_before = now - self.session_idle_ttl
+        activity_key = self.r_key('session_activity')
+        session_keys = yield self.r_server.zrangebyscore(
+            activity_key, '-inf', idle_before, start=0, num=limit)
+        offloaded_key = self.r_key('offloaded_sessions')
+        if session_keys:
+            # sessions written by an atomic submit may be about to go
+            self.sweeps += 1
+        swept = 0
+        for session_key in session_keys:
+            offloaded = ''
+            if self.session_idle_action == 'offload':
+                session_data = yield self.session_manager.load_session(
+                    session_key)
+                if session_data:
+                    offloaded = compress(json.dumps(session_data), 0)
+            if SWEEP_SESSION.is_supported(self.r_server):
+                result = yield SWEEP_SESSION(
+                    self.r_server,
+                    [activity_key, self.r_key('session', session_key),
+                     offloaded_key],
+                    [session_key, repr(idle_before), offloaded])
+                swept += int(result)
+                continue
+            score = yield self.r_server.zscore(activity_key, session_key)
+            if score is None or float(score) > idle_before:
+                continue
+            if offloaded:
+                yield self.r_server.hset(offloaded_key, session_key,
+                                         offloaded)
+            yield self.session_manager.clear_session(session_key)
+            yield self.r_server.zrem(activity_key, session_key)
+            swept += 1
+        returnValue(swept)
+
+    @Manager.calls_manager
+    def restore_session(self, session_key):
+        """
+        Move a session offloaded by `sweep_idle_sessions` back into the
+        session store and return its data, or an empty dict if there is
+        none.
+        """
+        offloaded_key = self.r_key('offloaded_sessions')
+        data = yield self.r_server.hget(offloaded_key, session_key)
+        if data is None:
+            returnValue({})
+        session_data = json.loads(decompress(data))
+        yield self.session_manager.save_session(session_key, session_data)
+        yield self.touch_session(session_key, time.time())
+        yield self.r_server.hdel(offloaded_key, session_key)
+        session_data = yield self.session_manager.load_session(session_key)
+        returnValue(session_data)
+
+    def get_label_users_key(self, poll_id):
+        return self.get_poll_key('label_users', poll_id)
+
+    def get_label_index_key(self, poll_id, label):
+        return self.get_poll_key('label_index', poll_id, label)
+
+    def get_label_value_key(self, poll_id, label, value):
+        return self.get_poll_key('label_value', poll_id, label, value)
+
+    @Manager.calls_manager
+    def index_labels(self, poll_id, user_id, labels):
+        """
+        Update the indexes of the `indexed_labels` for a participant.
+        Every indexed label has a hash of each participant's JSON encoded
+        value and a set of participants per value.
+        """
+        if not self.indexed_labels:
+            return
+        yield self.r_server.sadd(self.get_label_users_key(poll_id), user_id)
+        for label in self.indexed_labels:
+            index_key = self.get_label_index_key(poll_id, label)
+            value = labels.get(label)
+            stored = yield self.r_server.hget(index_key, user_id)
+            previous = None if stored is None else json.loads(stored)
+            if stored is not None and previous == value:
+                continue
+            if stored is not None:
+                yield self.r_server.srem(self.get_label_value_key(
+                    poll_id, label, unicode(previous)), user_id)
+            if value is None:
+                yield self.r_server.hdel(index_key, user_id)
+            else:
+                yield self.r_server.hset(index_key, user_id,
+                                         json.dumps(value))
+                yield self.r_server.sadd(self.get_label_value_key(
+                    poll_id, label, unicode(value)), user_id)
+
+    @Manager.calls_manager
+    def reindex_labels(self, poll_id):
+        """
+        Index the `indexed_labels` of the participants with a session for
+        `poll_id`, for sessions saved before the labels were indexed.
+        Offloaded and archived participants aren't indexed. This reads
+        every session so it's meant to be run once after changing
+        `indexed_labels`. Returns the number of participants indexed.
+        """
+        prefix = self.get_session_key(poll_id, '')
+        sessions = yield self.session_manager.active_sessions()
+        indexed = 0
+        for session_key, session_data in sessions:
+            if not session_key.startswith(prefix):
+                continue
+            user_id = session_key[len(prefix):]
+            participant = PollParticipant(user_id, session_data)
+            if participant.get_poll_id() not in (None, poll_id):
+                # the session of another poll whose id starts the same
+                continue
+            yield self.index_labels(poll_id, user_id, participant.labels)
+            indexed += 1
+        returnValue(indexed)
+
+    @Manager.calls_manager
+    def find_participants(self, poll_id, checks, case_sensitive=True):
+        """
+        Find the participants whose labels pass all of `checks`, given as
+        `[operation, label, value]` like the checks of a poll question.
+        Only `indexed_labels` can be checked and sessions are never
+        loaded. Returns a set of user ids.
+
+        Only participants saved since their labels were indexed are
+        found, `reindex_labels` indexes the ones saved before. Case
+        insensitive checks other than `exists` and `not exists` read the
+        label's whole index.
+        """
+        def load(stored):
+            value = json.loads(stored)
+            if not case_sensitive and isinstance(value, basestring):
+                value = value.lower()
+            return value
+
+        cohort = None
+        for handler, label, value in compile_checks(checks, case_sensitive):
+            if label not in self.indexed_labels:
+                raise ValueError('%s is not an indexed label.' % (label,))
+            if handler is check_equal and case_sensitive:
+                matches = set((yield self.r_server.smembers(
+                    self.get_label_value_key(poll_id, label,
+                                             unicode(value)))))
+            else:
+                index = yield self.r_server.hgetall(
+                    self.get_label_index_key(poll_id, label))
+                matches = set(
+                    user_id for user_id, stored in index.items()
+                    if handler({label: load(stored)}, label, value))
+                if handler({}, label, value):
+                    # the check passes for participants without the label
+                    users = yield self.r_server.smembers(
+                        self.get_label_users_key(poll_id))
+                    matches.update(set(users) - set(index))
+            cohort = matches if cohort is None else cohort & matches
+        if cohort is None:
+            cohort = set((yield self.r_server.smembers(
+                self.get_label_users_key(poll_id))))
+        returnValue(cohort)
+
     @Manager.calls_manager
     def active_participants(self, poll_id):
         active_sessions = yield self.session_manager.active_sessions()
@@ -137,9 +711,12 @@ class PollManager(object):
                     if participant.get_poll_id() == poll_id]
         returnValue(active_participants)
 
+    @Manager.calls_manager
     def inactive_participant_session_keys(self):
+        r_server = yield self.router.get_read_server()
         archive_key = self.r_key('archive')
-        return self.r_server.smembers(archive_key)
+        session_keys = yield r_server.smembers(archive_key)
+        returnValue(session_keys)
 
     @Manager.calls_manager
     def archive(self, poll_id, participant):
@@ -149,11 +726,33 @@ class PollManager(object):
         yield self.r_server.sadd(archive_key, session_key)
 
         session_archive_key = self.r_key('session_archive', session_key)
+        archived_data = compress(json.dumps(participant.clean_dump()),
+                                 self.compress_threshold)
         yield self.r_server.zadd(session_archive_key, **{
-            json.dumps(participant.clean_dump()): participant.updated_at,
+            archived_data: participant.updated_at,
         })
         # TODO
         yield self.session_manager.clear_session(session_key)
+        participant.written_session = None
+        if self.session_idle_ttl:
+            yield self.r_server.zrem(self.r_key('session_activity'),
+                                     session_key)
+        if self.offloads_sessions():
+            # a copy offloaded while the participant was still active
+            # mustn't be restored
+            yield self.r_server.hdel(self.r_key('offloaded_sessions'),
+                                     session_key)
+        yield self.unindex_labels(poll_id, user_id)
+
+    @Manager.calls_manager
+    def unindex_labels(self, poll_id, user_id):
+        """
+        Remove a participant from the `indexed_labels` indexes.
+        """
+        if not self.indexed_labels:
+            return
+        yield self.index_labels(poll_id, user_id, {})
+        yield self.r_server.srem(self.get_label_users_key(poll_id), user_id)
 
     @Manager.calls_manager
     def get_all_archives(self):
@@ -181,7 +780,7 @@ class PollManager(object):
         # would when loaded from Redis.
         archives = []
         for data in archived_sessions:
-            typed_json = json.loads(data)
+            typed_json = json.loads(decompress(data))
             unicode_json = dict([(key, unicode(value)) for key, value
                                     in typed_json.items()])
             participant = PollParticipant(user_id, unicode_json)
@@ -189,30 +788,18 @@ class PollManager(object):
 
         returnValue(archives)
 
-    @Manager.calls_manager
     def get_completed_response(self, participant, poll, default_response):
-        config = yield self.get_config(poll.poll_id)
-        # Get the known survey completed responses (which might not exist)
-        # but always tag the default response on the end, since it doesn't
-        # have any checks it will always pass and so we're guaranteed
-        # to have a response if even whoever wrote the survey description
-        # manages to create a situation where all other checks fail.
-        possible_responses = config.get('survey_completed_responses', [])
-        possible_responses.append({'copy': default_response})
-        survey_completed_responses = enumerate(possible_responses)
-
-        for index, response in survey_completed_responses:
-            pq = PollQuestion(index, **response)
-            if poll.is_suitable_question(participant, pq):
-                returnValue(pq.copy)
-        returnValue(self.survey_completed_response)
+        return poll.get_completed_response(participant, default_response)
 
+    @Manager.calls_manager
     def stop(self):
-        return self.session_manager.stop(stop_redis=False)
+        for poll in self.compiled_polls.values():
+            yield poll.results_manager.stop()
+        yield self.session_manager.stop(stop_redis=False)
 
     @Manager.calls_manager
     def export_user_data(self, poll, include_timestamp=True,
-                         include_old_questions=False):
+                         include_old_questions=False, since=None):
         """
         Export the user data for a poll, returns
             [(user_id, user_data_dict), ...]
@@ -226,12 +813,17 @@ class PollManager(object):
         :param bool include_old_questions:
             If true, responses to questions from older versions of the poll
             are included.
+
+        :param float since:
+            If given, only users who answered a question after this UNIX
+            timestamp are exported.
         """
         if include_old_questions:
             questions = None
         else:
             questions = [q['label'] for q in poll.questions]
-        users = yield poll.results_manager.get_users(poll.poll_id, questions)
+        users = yield poll.results_manager.get_users(poll.poll_id, questions,
+                                                     since=since)
         if not include_timestamp:
             returnValue(users)
         for user_id, user_data in users:
@@ -242,7 +834,7 @@ class PollManager(object):
 
     @Manager.calls_manager
     def export_user_data_as_csv(self, poll, include_timestamp=True,
-                                include_old_questions=False):
+                                include_old_questions=False, since=None):
         """
         See `export_user_data`
 
@@ -250,7 +842,7 @@ class PollManager(object):
         """
         users = yield self.export_user_data(
             poll, include_timestamp=include_timestamp,
-            include_old_questions=include_old_questions)
+            include_old_questions=include_old_questions, since=since)
         sio = StringIO()
         field_names = ['user_id']
         if include_timestamp:
@@ -279,9 +871,82 @@ class PollManager(object):
         returnValue(datetime.fromtimestamp(participant.updated_at))
 
 
+def check_equal(state, key, value):
+    return unicode(state.get(key)) == unicode(value)
+
+
+def check_not_equal(state, key, value):
+    return unicode(state.get(key)) != unicode(value)
+
+
+def check_exists(state, key, value=None):
+    return state.get(key)
+
+
+def check_not_exists(state, key, value=None):
+    return not check_exists(state, key, value)
+
+
+def check_less(state, key, value):
+    return state.get(key) < unicode(value)
+
+
+def check_less_equal(state, key, value):
+    return state.get(key) <= unicode(value)
+
+
+def check_greater(state, key, value):
+    return state.get(key) > unicode(value)
+
+
+def check_greater_equal(state, key, value):
+    return state.get(key) >= unicode(value)
+
+
+def check_unknown(state, key, value=None):
+    return True
+
+
+CHECK_OPERATIONS = {
+    'equal': check_equal,
+    'not equal': check_not_equal,
+    'exists': check_exists,
+    'not exists': check_not_exists,
+    'less': check_less,
+    'less or equal': check_less_equal,
+    'greater': check_greater,
+    'greater or equal': check_greater_equal,
+}
+
+
+def compile_checks(checks, case_sensitive=True):
+    """
+    Turn `[operation, key, value]` checks into a list of
+    `(handler, key, value)` tuples ready to be evaluated against a
+    participant's labels. Checks without a key always pass and are dropped.
+    """
+    compiled = []
+    for operation, key, value in checks:
+        if not key:
+            continue
+        if not case_sensitive:
+            value = value.lower()
+        handler = CHECK_OPERATIONS.get(operation, check_unknown)
+        compiled.append((handler, key, value))
+    return compiled
+
+
 class Poll(object):
     def __init__(self, r_server, poll_id, uid, questions, batch_size=None,
-        r_prefix='poll', repeatable=True, case_sensitive=True):
+        r_prefix='poll', repeatable=True, case_sensitive=True,
+        survey_completed_responses=None, batch_completed_response=None,
+        survey_completed_response=None, encode_answers=False,
+        index_respondents=False, cluster_keys=False, router=None,
+        result_shards=None, result_routers=None,
+        counter_flush_interval=None, count_respondents=False,
+        daily_respondents_ttl=None, rollup_interval=None,
+        rollup_retention=None, publish_changes=False,
+        change_listeners=None):
         self.r_server = self.manager = r_server
         self.poll_id = poll_id
         self.uid = uid
@@ -290,23 +955,62 @@ class Poll(object):
         self.batch_size = batch_size
         self.repeatable = repeatable
         self.case_sensitive = case_sensitive
+        self.encode_answers = encode_answers
+        self.survey_completed_responses = survey_completed_responses or []
+        self.batch_completed_response = batch_completed_response
+        self.survey_completed_response = survey_completed_response
+        # Compile the questions and the survey completed responses once,
+        # they're checked for every message.
+        self.poll_questions = [
+            PollQuestion(index, case_sensitive=case_sensitive,
+                         **dict((k.encode('utf8'), v)
+                                for k, v in question.items()))
+            for index, question in enumerate(self.questions or [])]
+        self.completed_responses = [
+            PollQuestion(index, case_sensitive=case_sensitive,
+                         **dict((k.encode('utf8'), v)
+                                for k, v in response.items()))
+            for index, response in enumerate(
+                self.survey_completed_responses)]
         # Result Manager keeps track of what was answered
         # to which question. We need to tell it about the options
         # before hand.
-        self.results_manager = ResultManager(self.r_server,
-                                                self.r_key('results'))
+        if result_shards:
+            self.results_manager = ShardedResultManager(
+                result_shards, self.r_key('results'),
+                routers=result_routers,
+                index_respondents=index_respondents,
+                cluster_keys=cluster_keys,
+                counter_flush_interval=counter_flush_interval,
+                count_respondents=count_respondents,
+                daily_respondents_ttl=daily_respondents_ttl,
+                rollup_interval=rollup_interval,
+                rollup_retention=rollup_retention,
+                publish_changes=publish_changes,
+                change_listeners=change_listeners)
+        else:
+            self.results_manager = ResultManager(
+                self.r_server, self.r_key('results'),
+                index_respondents=index_respondents,
+                cluster_keys=cluster_keys, router=router,
+                counter_flush_interval=counter_flush_interval,
+                count_respondents=count_respondents,
+                daily_respondents_ttl=daily_respondents_ttl,
+                rollup_interval=rollup_interval,
+                rollup_retention=rollup_retention,
+                publish_changes=publish_changes,
+                change_listeners=change_listeners)
         self._setup_d = self._setup_results()
 
     @Manager.calls_manager
     def _setup_results(self):
         yield self.results_manager.register_collection(self.poll_id)
-        for index, question_data in enumerate(self.questions):
-            question_data = dict((k.encode('utf8'), v)
-                                 for k, v in question_data.items())
-            question = PollQuestion(index, case_sensitive=self.case_sensitive,
-                                    **question_data)
-            yield self.results_manager.register_question(self.poll_id,
-                question.label_or_copy(), question.valid_responses)
+        # Question ids are allocated from a counter so the questions
+        # can be registered concurrently.
+        yield gather([self.results_manager.register_question(self.poll_id,
+                          question.label_or_copy(), question.valid_responses,
+                          encode_answers=self.encode_answers)
+                      for question in self.poll_questions])
         returnValue(self)
 
     @classmethod
@@ -349,51 +1053,21 @@ class Poll(object):
         if not self.case_sensitive:
             state = dict((k, v.lower()) for k, v in state.items())
 
-        def equals(key, value):
-            return unicode(state.get(key)) == unicode(value)
-
-        def not_equals(key, value):
-            return unicode(state.get(key)) != unicode(value)
-
-        def exists(key, value=None):
-            return state.get(key)
-
-        def not_exists(key, value=None):
-            return not exists(key, value)
-
-        def less(key, value):
-            return state.get(key) < unicode(value)
-
-        def less_equal(key, value):
-            return state.get(key) <= unicode(value)
-
-        def greater(key, value):
-            return state.get(key) > unicode(value)
-
-        def greater_equal(key, value):
-            return state.get(key) >= unicode(value)
-
-        operations_dispatcher = {
-            'equal': equals,
-            'not equal': not_equals,
-            'exists': exists,
-            'not exists': not_exists,
-            'less': less,
-            'less or equal': less_equal,
-            'greater': greater,
-            'greater or equal': greater_equal,
-        }
-
-        for operation, key, value in question.checks:
-            handler = operations_dispatcher.get(operation, lambda *a: True)
-            if key:
-                if not self.case_sensitive:
-                    value = value.lower()
-                if not handler(key, value):
-                    return False
+        for handler, key, value in question.compiled_checks:
+            if not handler(state, key, value):
+                return False
 
         return True
 
+    def get_completed_response(self, participant, default_response):
+        # Get the known survey completed responses (which might not exist)
+        # and fall back to the default response if whoever wrote the survey
+        # description manages to create a situation where all checks fail.
+        for response in self.completed_responses:
+            if self.is_suitable_question(participant, response):
+                return response.copy
+        return default_response
+
     @Manager.calls_manager
     def submit_answer(self, participant, answer, custom_answer_logic=None):
         poll_question = self.get_last_question(participant)
@@ -419,10 +1093,9 @@ class Poll(object):
 
     def get_question(self, index):
         if self.has_question(index):
-            questions = dict((k.encode('utf8'), v)
-                             for k, v in self.questions[index].items())
-            return PollQuestion(index, case_sensitive=self.case_sensitive,
-                **questions)
+            # `PollQuestion.answer` keeps the answer on the question so
+            # every caller gets its own copy of the compiled question.
+            return copy.copy(self.poll_questions[index])
         return None
 
 
@@ -439,6 +1112,7 @@ class PollQuestion(object):
                         for operation, params in checks.items()]
         self.checks = checks or []
         self.case_sensitive = case_sensitive
+        self.compiled_checks = compile_checks(self.checks, case_sensitive)
         self.answered = False
 
     def label_or_copy(self):
@@ -1,28 +1,123 @@
 # -*- test-case-name: tests.test_multipoll_example -*-
 # -*- coding: utf8 -*-
 
+import time
 from datetime import date, timedelta, datetime
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, succeed, Deferred,
+    DeferredList, DeferredSemaphore, gatherResults)
+from twisted.internet.task import LoopingCall
 from vumi.persist.txredis_manager import TxRedisManager
+from vumi import log
 
 from vxpolls.example import PollApplication
-from vxpolls import PollManager
 
 
 class EventPublisher(object):
-
-    def __init__(self):
+    """
+    Dispatches events to their subscribers.
+
+    Each subscriber is called in its own slot of a bounded pool so a slow
+    subscriber doesn't hold up the others. At most `max_pending` deliveries
+    are kept in flight, once that limit is reached `send` returns a
+    Deferred that only fires when there is room again so callers that
+    yield on it are slowed down rather than piling up Deferreds.
+
+    :param int concurrency:
+        The maximum number of subscribers running at the same time.
+    :param int max_pending:
+        The maximum number of deliveries queued or running before `send`
+        starts applying backpressure.
+    """
+
+    def __init__(self, concurrency=10, max_pending=100):
         self.subscribers = {}
+        self.semaphore = DeferredSemaphore(concurrency)
+        self.max_pending = max_pending
+        self.in_flight = set()
+        self.waiting = []
+        self.batches = {}
+        self.max_queue_depth = 0
+        self.handler_latency = {}
 
-    @inlineCallbacks
     def send(self, event):
-        for subscriber in self.subscribers.get(event.event_type, []):
-            yield subscriber(event)
+        subscribers = self.subscribers.get(event.event_type, [])
+        for index, (subscriber, batch_size) in enumerate(subscribers):
+            if batch_size:
+                batch_key = (event.event_type, index)
+                batch = self.batches.setdefault(batch_key, [])
+                batch.append(event)
+                if len(batch) >= batch_size:
+                    self.dispatch(event.event_type, subscriber,
+                                  self.batches.pop(batch_key))
+            else:
+                self.dispatch(event.event_type, subscriber, event)
+        return self.wait_for_room()
 
-    def subscribe(self, event_type, handler):
+    def subscribe(self, event_type, handler, batch_size=None):
+        """
+        Subscribe `handler` to events of `event_type`. If `batch_size` is
+        given the handler is called with a list of that many events
+        instead of being called once per event. Partial batches are
+        delivered when `flush` is called.
+        """
         s = self.subscribers.setdefault(event_type, [])
-        s.append(handler)
+        s.append((handler, batch_size))
+
+    def dispatch(self, event_type, subscriber, payload):
+        d = self.semaphore.run(self.deliver, event_type, subscriber, payload)
+        self.in_flight.add(d)
+        d.addErrback(log.err)
+        d.addBoth(self.delivered, d)
+        self.max_queue_depth = max(self.max_queue_depth, len(self.in_flight))
+
+    def deliver(self, event_type, subscriber, payload):
+        start = time.time()
+
+        def record_latency(result):
+            count, total, slowest = self.handler_latency.get(
+                event_type, (0, 0.0, 0.0))
+            latency = time.time() - start
+            self.handler_latency[event_type] = (
+                count + 1, total + latency, max(slowest, latency))
+            return result
+
+        return maybeDeferred(subscriber, payload).addBoth(record_latency)
+
+    def delivered(self, _, d):
+        self.in_flight.discard(d)
+        while self.waiting and len(self.in_flight) < self.max_pending:
+            self.waiting.pop(0).callback(None)
+
+    def wait_for_room(self):
+        if len(self.in_flight) < self.max_pending:
+            return succeed(None)
+        d = Deferred()
+        self.waiting.append(d)
+        return d
+
+    def flush(self):
+        """
+        Deliver any partially filled batches and return a Deferred that
+        fires once everything in flight has been handled.
+        """
+        for (event_type, index), events in self.batches.items():
+            subscriber, _ = self.subscribers[event_type][index]
+            self.dispatch(event_type, subscriber, events)
+        self.batches = {}
+        return DeferredList(list(self.in_flight))
+
+    def get_metrics(self):
+        """
+        Return the current and maximum queue depth along with
+        `(count, total, max)` handler latencies in seconds per event type.
+        """
+        return {
+            'queue_depth': len(self.in_flight),
+            'max_queue_depth': self.max_queue_depth,
+            'handler_latency': self.handler_latency.copy(),
+        }
 
 
 class Event(object):
@@ -42,6 +137,77 @@ class Event(object):
                 self.data == other.data)
 
 
+class PollSchedule(object):
+    """
+    Routes participants to their weekly poll without touching Redis.
+
+    Poll numbers for birth dates are computed once per week and poll ids
+    once per prefix and number. Whether a poll exists is answered from a
+    table of the configured poll ids that exist, loaded by `refresh`.
+
+    :param callable get_current_date:
+        Returns today's date, the week starts on the Monday before it.
+    :param int weeks:
+        The poll number of the week a participant's birth date falls in.
+    :param list poll_ids:
+        The configured poll ids, participants are only routed to these.
+    """
+
+    def __init__(self, get_current_date, weeks=36, poll_ids=()):
+        self.get_current_date = get_current_date
+        self.weeks = weeks
+        self.monday = None
+        self.poll_numbers = {}
+        self.poll_ids = {}
+        self.configured_poll_ids = set(poll_ids)
+        self.known_poll_ids = set()
+
+    @inlineCallbacks
+    def refresh(self, poll_manager):
+        polls = yield poll_manager.polls()
+        self.known_poll_ids = self.configured_poll_ids & set(polls)
+
+    def exists(self, poll_id):
+        return poll_id in self.known_poll_ids
+
+    @inlineCallbacks
+    def poll_exists(self, poll_manager, poll_id):
+        """
+        Whether `poll_id` is a configured poll that exists. A configured
+        poll that isn't known yet is looked up so a poll imported since
+        the last `refresh` is found straight away.
+        """
+        if (poll_id not in self.known_poll_ids and
+                poll_id in self.configured_poll_ids and
+                (yield poll_manager.exists(poll_id))):
+            self.known_poll_ids.add(poll_id)
+        returnValue(self.exists(poll_id))
+
+    def get_last_monday(self):
+        current_date = self.get_current_date()
+        return current_date - timedelta(days=current_date.weekday())
+
+    def get_poll_number(self, birth_date):
+        """
+        Return the poll number for a `YYYY-MM-DD` birth date this week.
+        """
+        monday = self.get_last_monday()
+        if monday != self.monday:
+            self.monday = monday
+            self.poll_numbers = {}
+        if birth_date not in self.poll_numbers:
+            days = (datetime.strptime(birth_date, "%Y-%m-%d").date() -
+                    monday).days
+            self.poll_numbers[birth_date] = self.weeks - days / 7
+        return self.poll_numbers[birth_date]
+
+    def get_poll_id(self, poll_id_prefix, number):
+        key = (poll_id_prefix, number)
+        if key not in self.poll_ids:
+            self.poll_ids[key] = "%s%s" % key
+        return self.poll_ids[key]
+
+
 class MultiPollApplication(PollApplication):
 
     registration_partial_response = 'You have done part of the registration '\
@@ -58,32 +224,74 @@ class MultiPollApplication(PollApplication):
     custom_answer_logic = None
     is_demo = False
     current_date = None
+    schedule_refresher = None
 
     def validate_config(self):
         self.questions_dict = self.config.get('questions_dict', {})
         self.poll_id_list = self.config.get('poll_id_list',
                                             [self.generate_unique_id()])
-        self.r_config = self.config.get('redis_manager', {})
         self.batch_size = self.config.get('batch_size', 9)
-        self.dashboard_port = int(self.config.get('dashboard_port', 8000))
-        self.dashboard_prefix = self.config.get('dashboard_path_prefix', '/')
-        self.poll_prefix = self.config.get('poll_prefix', 'poll_manager')
+        self.validate_common_config()
+        self.poll_schedule_refresh_interval = self.config.get(
+            'poll_schedule_refresh_interval', 300)
+        self.poll_setup_concurrency = self.config.get(
+            'poll_setup_concurrency', 10)
         self.poll_name_list = self.config.get('poll_name_list', [])
         self.is_demo = self.config.get('is_demo', False)
+        self.event_concurrency = self.config.get('event_concurrency', 10)
+        self.event_max_pending = self.config.get('event_max_pending', 100)
 
     @inlineCallbacks
     def setup_application(self):
-        self.event_publisher = EventPublisher()
+        self.event_publisher = EventPublisher(
+            concurrency=self.event_concurrency,
+            max_pending=self.event_max_pending)
 
         self.redis = yield TxRedisManager.from_config(self.r_config)
-        self.pm = PollManager(self.redis, self.poll_prefix)
-        for poll_id in self.poll_id_list:
-            exists = yield self.pm.exists(poll_id)
-            if not exists:
-                yield self.pm.register(poll_id, {
-                    'questions': self.questions_dict.get(poll_id, []),
-                    'batch_size': self.batch_size,
-                })
+        yield self.setup_result_shards()
+        self.pm = self.get_poll_manager()
+        self.start_session_sweeper()
+        self.start_replica_heartbeat()
+        yield self.setup_polls()
+        # Polls imported while we're running are picked up by the
+        # periodic refresh.
+        self.schedule = PollSchedule(self.get_current_date,
+                                     poll_ids=self.poll_id_list)
+        yield self.schedule.refresh(self.pm)
+        self.schedule_refresher = LoopingCall(self.schedule.refresh, self.pm)
+        self.schedule_refresher.start(self.poll_schedule_refresh_interval,
+                                      now=False)
+
+    @inlineCallbacks
+    def setup_polls(self):
+        """
+        Register the polls in `poll_id_list` that don't exist yet and load
+        the others into the poll manager's caches, up to
+        `poll_setup_concurrency` polls at a time.
+        """
+        start = time.time()
+        existing = set((yield self.pm.polls()))
+        missing = [poll_id for poll_id in self.poll_id_list
+                   if poll_id not in existing]
+        semaphore = DeferredSemaphore(self.poll_setup_concurrency)
+        yield gatherResults([
+            semaphore.run(self.pm.register, poll_id, {
+                'questions': self.questions_dict.get(poll_id, []),
+                'batch_size': self.batch_size,
+            }) for poll_id in missing])
+        yield gatherResults([
+            semaphore.run(self.pm.get, poll_id)
+            for poll_id in self.poll_id_list if poll_id in existing])
+        log.msg('Set up %s polls (%s registered) in %.3f seconds.' % (
+            len(self.poll_id_list), len(missing), time.time() - start))
+
+    @inlineCallbacks
+    def teardown_application(self):
+        # not set if the application failed to set up
+        if self.schedule_refresher and self.schedule_refresher.running:
+            self.schedule_refresher.stop()
+        yield self.event_publisher.flush()
+        yield super(MultiPollApplication, self).teardown_application()
 
     @classmethod
     def poll_id_generator(cls, poll_id_prefix, last_id=None):
@@ -151,10 +359,23 @@ class MultiPollApplication(PollApplication):
     def make_poll_prefix(cls, other_id):
         return "%s_" % other_id
 
+    @inlineCallbacks
+    def load_invitee(self, scope_id, msisdn):
+        participant = yield self.pm.get_participant(scope_id, msisdn)
+        participant.scope_id = scope_id
+        poll_id = participant.get_poll_id()
+        if poll_id is None:
+            poll_id = self.get_first_poll_id(self.make_poll_prefix(scope_id))
+        poll = yield self.pm.get_poll_for_participant(poll_id, participant)
+        participant.set_poll_id(poll.poll_id)
+        participant.set_poll_uid(poll.uid)
+        participant.questions_per_session = poll.batch_size
+        returnValue((scope_id, participant, poll))
+
     @inlineCallbacks
     def reply_to(self, message, response, **kwargs):
-        self.event_publisher.send(Event('outbound_message',
-                                        message=message))
+        yield self.event_publisher.send(Event('outbound_message',
+                                              message=message))
         yield super(MultiPollApplication, self).reply_to(message,
                                                         response,
                                                         **kwargs)
@@ -164,8 +385,8 @@ class MultiPollApplication(PollApplication):
         scope_id = message['helper_metadata'].get('poll_id', '')
         participant = yield self.pm.get_participant(scope_id, message.user())
 
-        self.event_publisher.send(Event('inbound_message',
-                                        message=message))
+        yield self.event_publisher.send(Event('inbound_message',
+                                              message=message))
 
         # Even if this is a new user, the Participant record will be
         # initialised on get, so the best check for a new_user is whether
@@ -173,9 +394,9 @@ class MultiPollApplication(PollApplication):
         current_uid = participant.polls[0].get('uid')
         if current_uid is None:
             # We have a new user
-            self.event_publisher.send(Event('new_user',
-                                            message=message,
-                                            participant=participant))
+            yield self.event_publisher.send(Event('new_user',
+                                                  message=message,
+                                                  participant=participant))
 
         # Check whether participant is registered at the start
         is_registered_before = self.is_registered(participant)
@@ -202,16 +423,17 @@ class MultiPollApplication(PollApplication):
         # and if it has we fire a 'new_registrant' event if needed.
         is_registered_after = self.is_registered(participant)
         if not is_registered_before and is_registered_after:
-            self.event_publisher.send(Event('new_registrant',
-                                            message=message,
-                                            participant=participant))
+            yield self.event_publisher.send(Event('new_registrant',
+                                                  message=message,
+                                                  participant=participant))
 
     @inlineCallbacks
     def on_message(self, participant, poll, message):
         # receive a message as part of a live session
         content = message['content']
-        error_message = yield poll.submit_answer(participant, content,
-                                            self.custom_answer_logic)
+        error_message = yield self.pm.submit_answer(
+            poll, participant, content, self.custom_answer_logic,
+            session_poll_id=participant.scope_id)
         if error_message:
             yield self.reply_to(message, error_message)
         else:
@@ -263,8 +485,7 @@ class MultiPollApplication(PollApplication):
         next_poll_id = self.get_next_poll_id(self.make_poll_prefix(
                                                 participant.scope_id),
                                                     current_poll_id)
-        next_poll = yield self.pm.get(next_poll_id)
-        if next_poll:
+        if (yield self.schedule.poll_exists(self.pm, next_poll_id)):
             participant.set_poll_id(next_poll_id)
             yield self.pm.save_participant(participant.scope_id, participant)
             returnValue(True)
@@ -273,7 +494,8 @@ class MultiPollApplication(PollApplication):
     @inlineCallbacks
     def try_go_to_specific_poll(self, participant, poll_id):
         current_poll_id = participant.get_poll_id()
-        if poll_id != current_poll_id and self.pm.get(poll_id):
+        if (poll_id != current_poll_id and
+                (yield self.schedule.poll_exists(self.pm, poll_id))):
             participant.set_poll_id(poll_id)
             yield self.pm.save_participant(participant.scope_id, participant)
             returnValue(True)
@@ -296,25 +518,22 @@ class MultiPollApplication(PollApplication):
 
         current_poll_id = participant.get_poll_id()
         bdate = participant.get_label("BIRTH_DATE")
-        if bdate and current_poll_id != self.get_first_poll_id(
-                                                    self.make_poll_prefix(
-                                                    participant.scope_id)):
-            birth_date = datetime.strptime(bdate, "%Y-%m-%d").date()
-            new_poll_number = self.get_poll_number(birth_date)
-            current_poll_number = self.get_poll_index(
-                            self.make_poll_prefix(participant.scope_id),
-                            current_poll_id)
-            new_poll_id = self.get_poll_id_for_number(
-                            self.make_poll_prefix(participant.scope_id),
-                            new_poll_number)
+        poll_id_prefix = self.make_poll_prefix(participant.scope_id)
+        if bdate and current_poll_id != self.schedule.get_poll_id(
+                                                    poll_id_prefix, 0):
+            new_poll_number = self.schedule.get_poll_number(bdate)
+            current_poll_number = self.get_poll_index(poll_id_prefix,
+                                                      current_poll_id)
+            new_poll_id = self.schedule.get_poll_id(poll_id_prefix,
+                                                    new_poll_number)
             if new_poll_id != current_poll_id \
                 and new_poll_number > current_poll_number:
                 yield self.try_go_to_specific_poll(participant, new_poll_id)
                 # Fire an event to indicate the user is starting a new poll
-                self.event_publisher.send(Event('new_poll',
-                                                message=message,
-                                                participant=participant,
-                                                new_poll_id=new_poll_id))
+                yield self.event_publisher.send(Event('new_poll',
+                                                      message=message,
+                                                      participant=participant,
+                                                      new_poll_id=new_poll_id))
                 participant.has_unanswered_question = False
 
     def get_current_date(self):
@@ -324,13 +543,10 @@ class MultiPollApplication(PollApplication):
             return date.today()
 
     def get_last_monday(self):
-        current_date = self.get_current_date()
-        offset = current_date.weekday()
-        monday = current_date - timedelta(days=offset)
-        return monday
+        return self.schedule.get_last_monday()
 
     def get_poll_number(self, birth_date):
-        return 36 - (birth_date - self.get_last_monday()).days / 7
+        return self.schedule.get_poll_number(str(birth_date))
 
     def custom_answer_logic_function(self, participant, answer, poll_question):
         # Override  custom logic to be called during answer handling here
@@ -348,7 +564,6 @@ class MultiPollApplication(PollApplication):
             m = int(month)
             week = (m - 1) * 4 + 1
             current_date = self.get_current_date()
-            last_monday = self.get_last_monday()
             birth_date = current_date - timedelta(weeks=week)
             poll_number = self.get_poll_number(birth_date)
             return (poll_number, birth_date)
@@ -358,7 +573,6 @@ class MultiPollApplication(PollApplication):
             current_date = self.get_current_date()
             present_year = current_date.year
             present_month = current_date.month
-            last_monday = self.get_last_monday()
             year_offset = 0
             if m < present_month:
                 year_offset = 1
@@ -1,6 +1,12 @@
 import time
 import json
-from vumi.message import TransportUserMessage
+import zlib
+import base64
+
+
+# Prefix identifying values written by `compress`. Plain JSON never starts
+# with it so compressed and legacy values can be stored side by side.
+COMPRESSED_MARKER = 'z1:'
 
 
 def typed(dictionary, key, formatter, default=None):
@@ -10,21 +16,42 @@ def typed(dictionary, key, formatter, default=None):
     return default
 
 
+def compress(json_data, threshold=None):
+    """
+    Compress `json_data` if it is at least `threshold` bytes long.
+    Smaller values and a `threshold` of `None` leave the data untouched
+    since compressing them would cost CPU without saving memory.
+    """
+    if threshold is None or len(json_data) < threshold:
+        return json_data
+    return COMPRESSED_MARKER + base64.b64encode(zlib.compress(json_data))
+
+
+def decompress(data):
+    if data.startswith(COMPRESSED_MARKER):
+        return zlib.decompress(base64.b64decode(data[len(COMPRESSED_MARKER):]))
+    return data
+
+
 def deserialize_messages(json_data):
-    message_json_data = json.loads(json_data)
+    # vumi.message pulls in most of vumi, only import it once there are
+    # messages to load.
+    from vumi.message import TransportUserMessage
+    message_json_data = json.loads(decompress(json_data))
     return [TransportUserMessage.from_json(data) for data in message_json_data]
 
 
-def serialize_messages(messages):
-    return json.dumps([message.to_json() for message in messages])
+def serialize_messages(messages, compress_threshold=None):
+    return compress(json.dumps([message.to_json() for message in messages]),
+                    compress_threshold)
 
 
 def deserialize(json_data):
-    return json.loads(json_data)
+    return json.loads(decompress(json_data))
 
 
-def serialize(data):
-    return json.dumps(data)
+def serialize(data, compress_threshold=None):
+    return compress(json.dumps(data), compress_threshold)
 
 
 class PollParticipant(object):
@@ -44,6 +71,10 @@ class PollParticipant(object):
         self.polls = [{"poll_id":None, "uid":None, "last_question_index":None}]
         self.labels = {}
         self.force_archive = False
+        # the key and the fields of the session as last written after an
+        # atomic submit and the sweep they were written after, see
+        # `PollManager.save_participant`
+        self.written_session = None
         if session_data:
             self.load(session_data)
 
@@ -134,7 +165,12 @@ class PollParticipant(object):
         self.force_archive = typed(session_data,
             'force_archive', lambda v: v == 'True')
 
-    def dump(self):
+    def dump(self, compress_threshold=None):
+        """
+        Return the participant's state as a dict of values suitable for
+        storing in a Redis hash. Message histories serialised to at least
+        `compress_threshold` bytes are stored compressed.
+        """
         return {
             'questions_per_session': self.questions_per_session,
             'interactions': self.interactions,
@@ -142,16 +178,18 @@ class PollParticipant(object):
             'age': self.age,
             'has_unanswered_question': self.has_unanswered_question,
             'updated_at': self.updated_at,
-            'sent_messages': serialize_messages(self.sent_messages),
-            'received_messages': serialize_messages(self.received_messages),
+            'sent_messages': serialize_messages(self.sent_messages,
+                                                compress_threshold),
+            'received_messages': serialize_messages(self.received_messages,
+                                                    compress_threshold),
             'retries': self.retries,
             'polls': serialize(self.polls),
             'labels': serialize(self.labels),
             'force_archive': self.force_archive,
         }
 
-    def clean_dump(self):
-        raw_data = self.dump().items()
+    def clean_dump(self, compress_threshold=None):
+        raw_data = self.dump(compress_threshold).items()
         return dict([(key, value) for key, value in raw_data
                             if value is not None])
 
@@ -0,0 +1,76 @@
+# -*- test-case-name: tests.test_replica -*-
+import time
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+
+
+class ReplicaRouter(object):
+    """
+    Picks the connection to read from. Reads go to a read-only replica
+    while it's fresh enough and to the primary otherwise, writes always
+    go to the primary.
+
+    Replication lag is measured with a heartbeat that `beat` writes to the
+    primary, something has to call it regularly for the replica to be
+    considered fresh. The poll applications do so every
+    `replica_heartbeat_interval` seconds.
+
+    :param r_server:
+        The redis manager for the primary.
+    :param read_server:
+        The redis manager for the replica, in the same sync or async mode
+        as `r_server`. Defaults to `None` which reads from the primary.
+    :param float max_staleness:
+        How many seconds the replica's heartbeat may lag behind before
+        reads fall back to the primary. Defaults to `None` which always
+        reads from the replica.
+    :param float check_interval:
+        How many seconds a measurement of the lag is trusted for.
+    :param str heartbeat_key:
+        The key to write the heartbeat to.
+    """
+
+    def __init__(self, r_server, read_server=None, max_staleness=None,
+                 check_interval=1.0, heartbeat_key='replica_heartbeat',
+                 clock=time.time):
+        # create a manager attribute so the @calls_manager works
+        self.r_server = self.manager = r_server
+        self.read_server = read_server
+        self.max_staleness = max_staleness
+        self.check_interval = check_interval
+        self.heartbeat_key = heartbeat_key
+        self.clock = clock
+        self.checked_at = None
+        self.replica_fresh = False
+
+    def beat(self):
+        return self.r_server.set(self.heartbeat_key, repr(self.clock()))
+
+    @Manager.calls_manager
+    def get_lag(self):
+        """
+        Return how many seconds the replica lags behind or `None` if it
+        hasn't seen a heartbeat yet.
+        """
+        heartbeat = yield self.read_server.get(self.heartbeat_key)
+        if heartbeat is None:
+            returnValue(None)
+        returnValue(max(self.clock() - float(heartbeat), 0))
+
+    @Manager.calls_manager
+    def get_read_server(self):
+        if self.read_server is None:
+            returnValue(self.r_server)
+        if self.max_staleness is None:
+            returnValue(self.read_server)
+        now = self.clock()
+        if (self.checked_at is None or
+                now - self.checked_at >= self.check_interval):
+            lag = yield self.get_lag()
+            self.replica_fresh = lag is not None and lag <= self.max_staleness
+            self.checked_at = now
+        if self.replica_fresh:
+            returnValue(self.read_server)
+        returnValue(self.r_server)
@@ -1,13 +1,25 @@
 # -*- test-case-name: tests.test_results -*-
 import csv
+import json
+import time
 
+from array import array
+from datetime import datetime
+from collections import Counter
 from functools import partial
+from itertools import izip
 from StringIO import StringIO
 
-from twisted.internet.defer import returnValue
+from twisted.internet.defer import returnValue, Deferred, gatherResults
+from twisted.internet.task import LoopingCall
 
+from vumi import log
 from vumi.persist.redis_base import Manager
 
+from vxpolls.replica import ReplicaRouter
+from vxpolls.scripts import (
+    ADD_RESPONDENT, COUNT_RESPONDENTS, SEGMENT, can_publish, publish)
+
 
 class ResultManagerException(Exception):
     pass
@@ -17,53 +29,485 @@ class CollectionException(ResultManagerException):
     pass
 
 
+def hash_tag(key):
+    """
+    Wrap `key` in a Redis Cluster hash tag, keys containing the same tag
+    are stored in the same slot.
+    """
+    return '{%s}' % (key,)
+
+
+def gather(replies):
+    """
+    Wait for the replies of Redis calls that were all sent before waiting
+    for any of them. Asynchronous managers reply with deferreds,
+    synchronous ones with the values themselves.
+    """
+    if any(isinstance(reply, Deferred) for reply in replies):
+        return gatherResults(replies, consumeErrors=True)
+    return replies
+
+
+def to_unicode(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    return value
+
+
+class AnswerCoder(object):
+    """
+    Maps the answers given to a question to small integer codes. Code `0`
+    means no answer was given, the registered answers are coded in sorted
+    order starting at `1` and answers that weren't registered are coded
+    in the order they're first seen after that.
+    """
+
+    def __init__(self, answers=()):
+        self.answers = [None]
+        self.codes = {None: 0}
+        for answer in sorted(answers):
+            self.encode(answer)
+
+    def __len__(self):
+        return len(self.answers)
+
+    def encode(self, answer):
+        code = self.codes.get(answer)
+        if code is None:
+            code = self.codes[answer] = len(self.answers)
+            self.answers.append(answer)
+        return code
+
+    def decode(self, code):
+        return self.answers[code]
+
+
+def count_crosstab(row_coder, row_codes, column_coder, column_codes):
+    """
+    Count the pairs of answer codes in `row_codes` and `column_codes` and
+    return them as `{row_answer: {column_answer: count}}`. Pairs where
+    either answer is missing are left out.
+    """
+    cells = Counter(izip(row_codes, column_codes))
+    return dict((row_coder.decode(row), dict(
+        (column_coder.decode(column), cells.get((row, column), 0))
+        for column in range(1, len(column_coder))))
+        for row in range(1, len(row_coder)))
+
+
+def combine_segments(operator, a, b):
+    """
+    Combine two `(members, negated)` pairs with `&` or `|` the way the
+    SEGMENT script does. A negated pair stands for everyone but its
+    members.
+    """
+    if operator == '|':
+        members, negated = combine_segments(
+            '&', (a[0], not a[1]), (b[0], not b[1]))
+        return members, not negated
+    (a_members, a_negated), (b_members, b_negated) = a, b
+    if a_negated and b_negated:
+        return a_members | b_members, True
+    if a_negated:
+        return b_members - a_members, False
+    if b_negated:
+        return a_members - b_members, False
+    return a_members & b_members, False
+
+
+class Segment(object):
+    """
+    A set of respondents to query for with
+    `ResultManager.count_segment` and `ResultManager.get_segment_users`.
+    Segments combine with `&`, `|` and `~`.
+    """
+
+    def __and__(self, other):
+        return AndSegment(self, other)
+
+    def __or__(self, other):
+        return OrSegment(self, other)
+
+    def __invert__(self):
+        return NotSegment(self)
+
+
+class AnswerSegment(Segment):
+    """
+    The respondents who gave `answer` to `question`.
+    """
+
+    def __init__(self, question, answer):
+        self.question = question
+        self.answer = answer
+
+
+class AndSegment(Segment):
+
+    def __init__(self, *segments):
+        self.segments = segments
+
+
+class OrSegment(Segment):
+
+    def __init__(self, *segments):
+        self.segments = segments
+
+
+class NotSegment(Segment):
+
+    def __init__(self, segment):
+        self.segment = segment
+
+
+class CounterBuffer(object):
+    """
+    Sums hash counter increments in memory so that many increments of the
+    same field are written with a single `HINCRBY` by `flush`.
+
+    :param int max_fields:
+        How many distinct fields to buffer before `incr` flushes.
+    """
+
+    def __init__(self, r_server, max_fields=1000):
+        # create a manager attribute so the @calls_manager works
+        self.r_server = self.manager = r_server
+        self.max_fields = max_fields
+        self.deltas = {}
+        self.ttls = {}
+        self.field_count = 0
+
+    def __len__(self):
+        return self.field_count
+
+    def incr(self, key, field, amount=1, ttl=None):
+        """
+        Buffer an increment, returns the result of `flush` once
+        `max_fields` fields are buffered and `None` otherwise. With `ttl`
+        the key is set to expire that many seconds after it's written.
+        """
+        self.add(key, field, amount)
+        if ttl:
+            self.ttls[key] = ttl
+        if self.field_count >= self.max_fields:
+            return self.flush()
+
+    def add(self, key, field, amount):
+        fields = self.deltas.setdefault(key, {})
+        if field not in fields:
+            fields[field] = 0
+            self.field_count += 1
+        fields[field] += amount
+
+    @Manager.calls_manager
+    def flush(self):
+        """
+        Write the buffered increments. Increments that couldn't be
+        written are buffered again.
+        """
+        deltas, ttls = self.deltas, self.ttls
+        self.deltas = {}
+        self.ttls = {}
+        self.field_count = 0
+        errors = yield gather([
+            self.write_increment(key, field, amount)
+            for key, fields in sorted(deltas.items())
+            for field, amount in sorted(fields.items()) if amount])
+        errors = [error for error in errors if error is not None]
+        if errors:
+            self.ttls.update(ttls)
+            raise errors[0]
+        yield gather([self.r_server.expire(key, ttl)
+                      for key, ttl in sorted(ttls.items())])
+
+    @Manager.calls_manager
+    def write_increment(self, key, field, amount):
+        """
+        Write one buffered increment, buffering it again if that fails.
+        Returns the error or `None` once written.
+        """
+        try:
+            yield self.r_server.hincrby(key, field, amount)
+        except Exception, e:
+            self.add(key, field, amount)
+            returnValue(e)
+
+
+class ChangeListeners(object):
+    """
+    The listeners of the changes to the results of collections, keyed by
+    the collection's changes channel. Result managers that share one tell
+    the same listeners about changes, see `add_change_listener`.
+    """
+
+    def __init__(self):
+        self.listeners = {}
+
+    def get(self, channel):
+        return self.listeners.get(channel, [])
+
+    def add(self, channel, listener):
+        self.listeners.setdefault(channel, []).append(listener)
+
+    def remove(self, channel, listener):
+        listeners = self.listeners.get(channel, [])
+        if listener in listeners:
+            listeners.remove(listener)
+        if not listeners:
+            self.listeners.pop(channel, None)
+
+
 class ResultManager(object):
 
-    def __init__(self, r_server, r_prefix='results'):
+    def __init__(self, r_server, r_prefix='results', index_respondents=False,
+                 cluster_keys=False, router=None, counter_flush_interval=None,
+                 max_buffered_counters=1000, count_respondents=False,
+                 daily_respondents_ttl=None, rollup_interval=None,
+                 rollup_retention=None, publish_changes=False,
+                 change_listeners=None):
+        """
+        :param bool index_respondents:
+            If true, `add_result` also maintains the respondents of every
+            answer for use with `count_segment` and `get_segment_users`.
+        :param bool cluster_keys:
+            If true, the collection id in every key of a collection is
+            wrapped in a Redis Cluster hash tag so all of them are stored
+            in the same slot. Data stored without it has to be migrated
+            with `vxpolls.tools.migrate_keys`.
+        :param ReplicaRouter router:
+            Picks the connection reports such as `get_results`,
+            `get_users` and `get_crosstab` read answers and counts from.
+            Collections, questions and answer codes are always read from
+            `r_server` since writes depend on them. Defaults to reading
+            everything from `r_server`.
+        :param float counter_flush_interval:
+            If set, `add_result` buffers the increments of the answer
+            counters and writes them every this many seconds, see
+            `CounterBuffer`. The users' answers are still written
+            immediately. Counters lag behind by up to the interval and
+            increments buffered when the process dies are lost, `stop`
+            writes them on shutdown. Defaults to `None` which increments
+            the counters immediately.
+        :param int max_buffered_counters:
+            How many counter fields are buffered at most before they're
+            written early.
+        :param bool count_respondents:
+            If true, `add_result` also adds the user to a HyperLogLog of
+            the collection's respondents and one of the day's, for cheap
+            approximate counts with `count_respondents`. Connections that
+            can't run scripts count exactly with sets instead.
+        :param int daily_respondents_ttl:
+            Seconds to keep the daily respondent counts for. Defaults to
+            `None` which keeps them forever.
+        :param int rollup_interval:
+            If set, `add_result` also counts the answers given per time
+            bucket of this many seconds for `get_time_series`. Defaults
+            to `None` which only keeps the totals.
+        :param int rollup_retention:
+            Seconds to keep each bucket for. Defaults to `None` which
+            keeps them forever.
+        :param bool publish_changes:
+            If true, `add_result` publishes every change to the counters
+            on the collection's Redis channel, see `get_changes_channel`,
+            for dashboards in other processes. Listeners added with
+            `add_change_listener` are told about changes either way.
+        :param ChangeListeners change_listeners:
+            The listeners to tell about changes, shared with the other
+            managers of the same collections in this process. Defaults
+            to listeners of this manager's own.
+        """
         # create a manager instances so the @calls_manager works
         self.r_server = self.manager = r_server
         self.r_prefix = r_prefix
+        self.index_respondents = index_respondents
+        self.cluster_keys = cluster_keys
+        self.router = router or ReplicaRouter(r_server)
+        self.count_respondents_enabled = count_respondents
+        self.daily_respondents_ttl = daily_respondents_ttl
+        self.publish_changes = publish_changes
+        self.change_listeners = change_listeners or ChangeListeners()
+        self.rollup_interval = rollup_interval
+        self.rollup_retention = rollup_retention
+        self.counter_flush_interval = counter_flush_interval
+        self.counter_buffer = None
+        self.counter_flusher = None
+        if counter_flush_interval is not None:
+            self.counter_buffer = CounterBuffer(r_server,
+                                                max_buffered_counters)
+            self.counter_flusher = LoopingCall(self.flush_counters)
         self.collections_prefix = 'collections'
         self.questions_prefix = 'questions'
         self.answers_prefix = 'answers'
         self.results_prefix = 'results'
         self.users_prefix = 'users'
+        self.updated_prefix = 'updated'
+        self.question_ids_prefix = 'question_ids'
+        self.question_names_prefix = 'question_names'
+        self.question_counter_prefix = 'question_counter'
+        self.answer_codes_prefix = 'answer_codes'
+        self.answer_counter_prefix = 'answer_counter'
+        self.respondents_prefix = 'respondents'
+        self.user_ordinals_prefix = 'user_ordinals'
+        self.ordinal_users_prefix = 'ordinal_users'
+        self.ordinal_counter_prefix = 'ordinal_counter'
+        self.respondent_count_prefix = 'respondent_count'
+        self.rollups_prefix = 'rollups'
+        self.changes_prefix = 'changes'
+        # question ids and answer codes never change once assigned so
+        # are safe to cache
+        self.question_ids = {}
+        self.coded_question_ids = set()
+        self.answer_codes = {}
+        self.answer_names = {}
+        self.user_ordinals = {}
 
     def defaults(self, collection_id, user_id):
         return ContextResultManager(collection_id, user_id, self)
 
+    @Manager.calls_manager
+    def incr_counter(self, results_key, field, amount, ttl=None):
+        if self.counter_buffer is None:
+            yield self.r_server.hincrby(results_key, field, amount)
+            if ttl:
+                yield self.r_server.expire(results_key, ttl)
+        else:
+            if not self.counter_flusher.running:
+                # started on first use so managers that never buffer
+                # anything don't schedule calls.
+                d = self.counter_flusher.start(self.counter_flush_interval,
+                                               now=False)
+                d.addErrback(log.err)
+            yield self.counter_buffer.incr(results_key, field, amount, ttl)
+
+    def flush_counters(self):
+        """
+        Write the buffered counter increments, if any.
+        """
+        if self.counter_buffer is not None:
+            return self.counter_buffer.flush()
+
+    def stop(self):
+        """
+        Stop the periodic writes of buffered counters and write what's
+        still buffered.
+        """
+        if self.counter_flusher is not None and self.counter_flusher.running:
+            self.counter_flusher.stop()
+        return self.flush_counters()
+
     def r_key(self, *args):
         return ':'.join([self.r_prefix] + list(args))
 
-    def get_collection_key(self, collection_id):
-        return self.r_key(self.collections_prefix, collection_id)
+    def get_collection_key(self, collection_id, *args):
+        if self.cluster_keys:
+            collection_id = hash_tag(collection_id)
+        return self.r_key(self.collections_prefix, collection_id, *args)
 
     def get_results_key(self, collection_id, key):
-        return self.r_key(self.collections_prefix, collection_id,
+        return self.get_collection_key(collection_id,
             self.results_prefix, key)
 
     def get_questions_key(self, collection_id):
-        return self.r_key(self.collections_prefix, collection_id,
+        return self.get_collection_key(collection_id,
             self.questions_prefix)
 
     def get_answers_key(self, collection_id, question):
-        return self.r_key(self.collections_prefix, collection_id,
+        return self.get_collection_key(collection_id,
             self.answers_prefix, question)
 
+    def get_question_ids_key(self, collection_id):
+        return self.get_collection_key(collection_id,
+            self.question_ids_prefix)
+
+    def get_question_names_key(self, collection_id):
+        return self.get_collection_key(collection_id,
+            self.question_names_prefix)
+
+    def get_question_counter_key(self, collection_id):
+        return self.get_collection_key(collection_id,
+            self.question_counter_prefix)
+
+    def get_answer_codes_key(self, collection_id, question_id):
+        return self.get_collection_key(collection_id,
+            self.answer_codes_prefix, question_id)
+
+    def get_answer_counter_key(self, collection_id, question_id):
+        return self.get_collection_key(collection_id,
+            self.answer_counter_prefix, question_id)
+
+    def get_respondents_key(self, collection_id, question_id, field):
+        return self.get_collection_key(collection_id,
+            self.respondents_prefix, question_id, field)
+
+    def get_user_ordinals_key(self, collection_id):
+        return self.get_collection_key(collection_id,
+            self.user_ordinals_prefix)
+
+    def get_ordinal_users_key(self, collection_id):
+        return self.get_collection_key(collection_id,
+            self.ordinal_users_prefix)
+
+    def get_ordinal_counter_key(self, collection_id):
+        return self.get_collection_key(collection_id,
+            self.ordinal_counter_prefix)
+
+    def get_respondent_count_key(self, collection_id, day=None):
+        if day is None:
+            return self.get_collection_key(collection_id,
+                self.respondent_count_prefix)
+        return self.get_collection_key(collection_id,
+            self.respondent_count_prefix, day.isoformat())
+
+    def get_rollup_key(self, collection_id, question_id, bucket):
+        return self.get_collection_key(collection_id,
+            self.rollups_prefix, question_id, str(bucket))
+
+    def get_changes_channel(self, collection_id):
+        return self.get_collection_key(collection_id, self.changes_prefix)
+
+    def get_change_counter_key(self, collection_id):
+        return self.get_collection_key(collection_id, self.changes_prefix,
+                                       'counter')
+
+    def get_bucket(self, timestamp):
+        """
+        Return the start of the rollup bucket `timestamp` falls in.
+        """
+        return int(timestamp // self.rollup_interval * self.rollup_interval)
+
     def get_users_key(self, collection_id):
-        return self.r_key(self.collections_prefix, collection_id,
+        return self.get_collection_key(collection_id,
             self.users_prefix)
 
+    def get_updated_key(self, collection_id):
+        return self.get_collection_key(collection_id,
+            self.updated_prefix)
+
     def get_user_answers_key(self, collection_id, user_id):
-        return self.r_key(self.collections_prefix, collection_id,
+        return self.get_collection_key(collection_id,
             self.users_prefix, self.results_prefix, user_id)
 
+    def get_r_server(self, collection_id):
+        """
+        Return the redis manager the keys of `collection_id` are stored on.
+        """
+        return self.r_server
+
+    def get_read_server(self, collection_id):
+        """
+        Return the redis manager reports on `collection_id` read from.
+        """
+        return self.router.get_read_server()
+
+    def get_collections_key(self):
+        return self.r_key(self.collections_prefix)
+
     def register_collection(self, collection_id):
-        collection_key = self.r_key(self.collections_prefix)
+        collection_key = self.get_collections_key()
         return self.r_server.sadd(collection_key, collection_id)
 
     def get_collections(self):
-        collection_key = self.r_key(self.collections_prefix)
+        collection_key = self.get_collections_key()
         return self.r_server.smembers(collection_key)
 
     @Manager.calls_manager
@@ -72,32 +516,153 @@ class ResultManager(object):
         questions = yield self.r_server.smembers(questions_key)
         returnValue(set([q.decode('utf-8') for q in questions]))
 
+    @Manager.calls_manager
+    def get_question_id(self, collection_id, question):
+        """
+        Return the short id answers to `question` are stored under in
+        the users' answer hashes and in key names. Questions registered
+        before ids were introduced keep using their full text.
+        """
+        cache_key = (collection_id, question)
+        if cache_key in self.question_ids:
+            returnValue(self.question_ids[cache_key])
+        ids_key = self.get_question_ids_key(collection_id)
+        question_id = yield self.r_server.hget(ids_key, question)
+        if question_id is None:
+            returnValue(question)
+        if question_id.startswith('%'):
+            self.coded_question_ids.add((collection_id, question_id))
+        self.question_ids[cache_key] = question_id
+        returnValue(question_id)
+
+    def is_coded(self, collection_id, question_id):
+        """
+        Whether answers to the question with id `question_id` are stored
+        as integer codes. Only questions registered with
+        `encode_answers` are.
+        """
+        return (collection_id, question_id) in self.coded_question_ids
+
+    @Manager.calls_manager
+    def load_answer_codes(self, collection_id, question_id):
+        codes_key = self.get_answer_codes_key(collection_id, question_id)
+        codes = yield self.r_server.hgetall(codes_key)
+        codes = dict((to_unicode(answer), code)
+                     for answer, code in codes.items())
+        cache_key = (collection_id, question_id)
+        self.answer_codes[cache_key] = codes
+        self.answer_names[cache_key] = dict(
+            (code, answer) for answer, code in codes.items())
+        returnValue(codes)
+
+    @Manager.calls_manager
+    def lookup_answer(self, collection_id, question_id, answer):
+        """
+        Return the value `answer` is stored as for the question with id
+        `question_id`, or `None` for coded questions if the answer hasn't
+        been given a code yet. Unlike `encode_answer` this never writes.
+        """
+        if not self.is_coded(collection_id, question_id):
+            returnValue(answer)
+        cache_key = (collection_id, question_id)
+        answer = to_unicode(answer)
+        code = self.answer_codes.get(cache_key, {}).get(answer)
+        if code is None:
+            codes = yield self.load_answer_codes(collection_id, question_id)
+            code = codes.get(answer)
+        returnValue(code)
+
+    @Manager.calls_manager
+    def encode_answer(self, collection_id, question_id, answer):
+        """
+        Return the value `answer` is stored as for the question with id
+        `question_id`. For coded questions answers are given the next
+        code the first time they're seen.
+        """
+        code = yield self.lookup_answer(collection_id, question_id, answer)
+        if code is None:
+            answer = to_unicode(answer)
+            counter_key = self.get_answer_counter_key(collection_id,
+                                                      question_id)
+            code = str((yield self.r_server.incr(counter_key)))
+            codes_key = self.get_answer_codes_key(collection_id, question_id)
+            yield self.r_server.hsetnx(codes_key, answer, code)
+            codes = yield self.load_answer_codes(collection_id, question_id)
+            code = codes[answer]
+        returnValue(code)
+
+    @Manager.calls_manager
+    def decode_answer(self, collection_id, question_id, value):
+        """
+        Return the answer stored as `value` for the question with id
+        `question_id`.
+        """
+        if value is None or not self.is_coded(collection_id, question_id):
+            returnValue(value)
+        cache_key = (collection_id, question_id)
+        answer = self.answer_names.get(cache_key, {}).get(value)
+        if answer is None:
+            yield self.load_answer_codes(collection_id, question_id)
+            answer = self.answer_names[cache_key].get(value, value)
+        returnValue(answer)
+
+    @Manager.calls_manager
+    def get_question_names(self, collection_id):
+        """
+        Return a dict mapping the question ids of a collection to the
+        questions they stand for.
+        """
+        names_key = self.get_question_names_key(collection_id)
+        names = yield self.r_server.hgetall(names_key)
+        returnValue(dict((question_id, question.decode('utf-8'))
+                         for question_id, question in names.items()))
+
     @Manager.calls_manager
     def get_answers(self, collection_id, question):
-        answers_key = self.get_answers_key(collection_id, question)
+        question_id = yield self.get_question_id(collection_id, question)
+        answers_key = self.get_answers_key(collection_id, question_id)
         answers = yield self.r_server.smembers(answers_key)
         returnValue(set([q.decode('utf-8') for q in answers]))
 
     @Manager.calls_manager
     def register_question(self, collection_id, question,
-        possible_answers=None):
+        possible_answers=None, encode_answers=False):
         """
         :param collection_id:       the unique id of the collection / survey
         :param question:            the unique id of the question asked
         :param possible_answers:    the list of possible answers this question
                                     can expect.
+        :param encode_answers:      store the answers to a new question with
+                                    possible answers as integer codes in
+                                    the order the answers are listed.
         """
         collection_ids = yield self.get_collections()
         if collection_id not in collection_ids:
             raise CollectionException('%s is an unknown collection' % (
                                         collection_id,))
-        questions_key = self.get_questions_key(collection_id)
-        yield self.r_server.sadd(questions_key, question)
-        answers_key = self.get_answers_key(collection_id, question)
+        questions = yield self.get_questions(collection_id)
+        if question not in questions:
+            # Allocate the question id before the question is visible
+            # so no answers are ever stored under its full text.
+            counter_key = self.get_question_counter_key(collection_id)
+            marker = '%' if encode_answers and possible_answers else '#'
+            question_id = None
+            while question_id is None or question_id in questions:
+                question_id = '%s%s' % (
+                    marker, (yield self.r_server.incr(counter_key)))
+            ids_key = self.get_question_ids_key(collection_id)
+            if (yield self.r_server.hsetnx(ids_key, question, question_id)):
+                names_key = self.get_question_names_key(collection_id)
+                yield self.r_server.hset(names_key, question_id, question)
+            questions_key = self.get_questions_key(collection_id)
+            yield self.r_server.sadd(questions_key, question)
+        question_id = yield self.get_question_id(collection_id, question)
+        answers_key = self.get_answers_key(collection_id, question_id)
         if possible_answers:
             for answer in possible_answers:
                 if not (yield self.r_server.sismember(answers_key, answer)):
                     yield self.r_server.sadd(answers_key, answer)
+                yield self.encode_answer(collection_id, question_id, answer)
         answers = yield self.get_answers(collection_id, question)
         returnValue(answers)
 
@@ -124,23 +689,278 @@ class ResultManager(object):
 
         users_key = self.get_users_key(collection_id)
         yield self.r_server.sadd(users_key, user_id)
+        updated_key = self.get_updated_key(collection_id)
+        timestamp = time.time()
+        yield self.r_server.zadd(updated_key, **{
+            user_id.encode('utf-8') if isinstance(user_id, unicode)
+            else user_id: timestamp,
+        })
+        if self.count_respondents_enabled:
+            yield self.add_respondent(collection_id, user_id)
+        question_id = yield self.get_question_id(collection_id, question)
         users_answers_key = self.get_user_answers_key(collection_id, user_id)
-        results_key = self.get_results_key(collection_id, question)
-        previous_answer = yield self.r_server.hget(users_answers_key, question)
+        results_key = self.get_results_key(collection_id, question_id)
+        raw_answer = answer
+        answer = yield self.encode_answer(collection_id, question_id, answer)
+        previous_answer = yield self.r_server.hget(users_answers_key,
+                                                   question_id)
         if previous_answer:
             # we've already seen an answer for this question before
             # so we need to shuffle things around instead of just
             # incrementing.
-            yield self.r_server.hincrby(results_key, answer, 1)
-            yield self.r_server.hincrby(results_key, previous_answer, -1)
+            yield self.incr_counter(results_key, answer, 1)
+            yield self.incr_counter(results_key, previous_answer, -1)
         elif previous_answer != answer:
             # we've not seen this entry for this user yet so just
             # simply increment a counter
-            yield self.r_server.hincrby(results_key, answer, 1)
+            yield self.incr_counter(results_key, answer, 1)
+
+        if self.rollup_interval and previous_answer != answer:
+            rollup_key = self.get_rollup_key(
+                collection_id, question_id, self.get_bucket(timestamp))
+            yield self.incr_counter(rollup_key, answer, 1,
+                                    self.rollup_retention)
 
-        yield self.r_server.hset(users_answers_key, question, answer)
+        if self.index_respondents and previous_answer != answer:
+            ordinal = str((yield self.get_user_ordinal(collection_id,
+                                                       user_id)))
+            if previous_answer:
+                yield self.r_server.srem(self.get_respondents_key(
+                    collection_id, question_id, previous_answer), ordinal)
+            yield self.r_server.sadd(self.get_respondents_key(
+                collection_id, question_id, answer), ordinal)
+
+        yield self.r_server.hset(users_answers_key, question_id, answer)
+
+        publish = (self.publish_changes or
+                   self.get_change_listeners(collection_id))
+        if publish and previous_answer != answer:
+            if previous_answer:
+                previous_answer = yield self.decode_answer(
+                    collection_id, question_id, previous_answer)
+            yield self.publish_change(collection_id, {
+                'question': question,
+                'answer': raw_answer,
+                'previous': previous_answer or None,
+            })
         returnValue(results_key)
 
+    def get_change_listeners(self, collection_id):
+        return self.change_listeners.get(
+            self.get_changes_channel(collection_id))
+
+    def add_change_listener(self, collection_id, listener):
+        """
+        Call `listener` with the collection id and the change, a dict with
+        the `question`, the new `answer`, the `previous` answer if any and
+        the collection's change number `seq`, whenever a counter of the
+        collection changes in this process.
+        """
+        self.change_listeners.add(self.get_changes_channel(collection_id),
+                                  listener)
+
+    def remove_change_listener(self, collection_id, listener):
+        self.change_listeners.remove(self.get_changes_channel(collection_id),
+                                     listener)
+
+    @Manager.calls_manager
+    def get_change_seq(self, collection_id):
+        """
+        Return the number of the collection's last change, the changes
+        counted in results read after it have numbers up to it.
+        """
+        seq = yield self.r_server.get(
+            self.get_change_counter_key(collection_id))
+        returnValue(int(seq or 0))
+
+    @Manager.calls_manager
+    def publish_change(self, collection_id, change, seq=None):
+        """
+        Number `change` once the counters are changed, unless it's been
+        numbered as `seq` along with them, and tell the listeners about
+        it, publishing it on the collection's channel with
+        `publish_changes`.
+        """
+        if seq is None:
+            seq = yield self.r_server.incr(
+                self.get_change_counter_key(collection_id))
+        change = dict(change, seq=seq)
+        for listener in list(self.get_change_listeners(collection_id)):
+            try:
+                listener(collection_id, change)
+            except Exception:
+                log.err()
+        if self.publish_changes and can_publish(self.r_server):
+            yield publish(self.r_server,
+                          self.get_changes_channel(collection_id),
+                          json.dumps(change))
+
+    @Manager.calls_manager
+    def add_respondent(self, collection_id, user_id):
+        """
+        Add `user_id` to the collection's and today's respondent counts.
+        """
+        total_key = self.get_respondent_count_key(collection_id)
+        day_key = self.get_respondent_count_key(
+            collection_id, datetime.utcfromtimestamp(time.time()).date())
+        if ADD_RESPONDENT.is_supported(self.r_server):
+            yield ADD_RESPONDENT(self.r_server, [total_key, day_key],
+                                 [user_id, self.daily_respondents_ttl or 0])
+        else:
+            yield self.r_server.sadd(total_key, user_id)
+            yield self.r_server.sadd(day_key, user_id)
+            if self.daily_respondents_ttl:
+                yield self.r_server.expire(day_key,
+                                           self.daily_respondents_ttl)
+
+    @Manager.calls_manager
+    def count_respondents(self, collection_id, days=None):
+        """
+        Return the approximate number of unique respondents, either of
+        the whole collection or of those who answered on any of `days`,
+        a list of `datetime.date` in UTC.
+        """
+        if days is None:
+            keys = [self.get_respondent_count_key(collection_id)]
+        else:
+            keys = [self.get_respondent_count_key(collection_id, day)
+                    for day in days]
+        # Counted on the primary, a replica won't run a script that may
+        # update the cached cardinality.
+        if COUNT_RESPONDENTS.is_supported(self.r_server):
+            count = yield COUNT_RESPONDENTS(self.r_server, keys, [])
+        else:
+            respondents = set()
+            for key in keys:
+                respondents.update((yield self.r_server.smembers(key)))
+            count = len(respondents)
+        returnValue(count)
+
+    @Manager.calls_manager
+    def get_user_ordinal(self, collection_id, user_id):
+        """
+        Return the dense per-collection number of `user_id`, allocating
+        the next one the first time a user is seen.
+        """
+        cache_key = (collection_id, user_id)
+        if cache_key in self.user_ordinals:
+            returnValue(self.user_ordinals[cache_key])
+        ordinals_key = self.get_user_ordinals_key(collection_id)
+        ordinal = yield self.r_server.hget(ordinals_key, user_id)
+        if ordinal is None:
+            counter_key = self.get_ordinal_counter_key(collection_id)
+            ordinal = (yield self.r_server.incr(counter_key)) - 1
+            if (yield self.r_server.hsetnx(ordinals_key, user_id, ordinal)):
+                yield self.r_server.hset(
+                    self.get_ordinal_users_key(collection_id), ordinal,
+                    user_id)
+            else:
+                ordinal = yield self.r_server.hget(ordinals_key, user_id)
+        ordinal = int(ordinal)
+        self.user_ordinals[cache_key] = ordinal
+        returnValue(ordinal)
+
+    @Manager.calls_manager
+    def compile_segment(self, collection_id, segment, keys, program):
+        """
+        Append `segment` to `program` as the postfix program the SEGMENT
+        script runs, adding the respondent sets it reads to `keys`.
+        """
+        if isinstance(segment, AnswerSegment):
+            question_id = yield self.get_question_id(collection_id,
+                                                     segment.question)
+            field = segment.answer
+            if self.is_coded(collection_id, question_id):
+                codes = yield self.load_answer_codes(collection_id,
+                                                     question_id)
+                field = codes.get(to_unicode(segment.answer))
+            if field is None:
+                program.append('0')
+            else:
+                keys.append(self.get_respondents_key(collection_id,
+                                                     question_id, field))
+                program.append(str(len(keys)))
+        elif isinstance(segment, NotSegment):
+            yield self.compile_segment(collection_id, segment.segment, keys,
+                                       program)
+            program.append('~')
+        elif isinstance(segment, (AndSegment, OrSegment)):
+            operator = '&' if isinstance(segment, AndSegment) else '|'
+            for index, sub_segment in enumerate(segment.segments):
+                yield self.compile_segment(collection_id, sub_segment, keys,
+                                           program)
+                if index:
+                    program.append(operator)
+        else:
+            raise ResultManagerException('%r is not a segment.' % (
+                segment,))
+
+    @Manager.calls_manager
+    def query_segment(self, collection_id, segment, offset=0, limit=-1):
+        """
+        Return the number of users in `segment` or, with a `limit`, the
+        ids of up to `limit` of them skipping the first `offset` in the
+        order the users first answered.
+
+        The respondent sets are combined by the SEGMENT script so only
+        the result is sent back. The fake redis can't run scripts, there
+        the sets are combined here the same way.
+        """
+        r_server = yield self.router.get_read_server()
+        keys = [self.get_ordinal_counter_key(collection_id),
+                self.get_ordinal_users_key(collection_id)]
+        program = []
+        yield self.compile_segment(collection_id, segment, keys, program)
+        if SEGMENT.is_supported(r_server):
+            result = yield SEGMENT(r_server, keys,
+                                   [offset, limit] + program)
+            returnValue(result)
+
+        stack = []
+        for token in program:
+            if token == '~':
+                members, negated = stack.pop()
+                stack.append((members, not negated))
+            elif token in ('&', '|'):
+                b = stack.pop()
+                a = stack.pop()
+                stack.append(combine_segments(token, a, b))
+            else:
+                members = set()
+                if token != '0':
+                    members = set(int(ordinal) for ordinal in (
+                        yield r_server.smembers(keys[int(token) - 1])))
+                stack.append((members, False))
+        members, negated = stack.pop()
+        users = int((yield r_server.get(keys[0])) or 0)
+        if limit < 0:
+            returnValue(users - len(members) if negated else len(members))
+        if negated:
+            ordinals = [ordinal for ordinal in range(users)
+                        if ordinal not in members]
+        else:
+            ordinals = sorted(members)
+        user_ids = []
+        for ordinal in ordinals[offset:offset + limit]:
+            user_ids.append((yield r_server.hget(keys[1], ordinal)))
+        returnValue(user_ids)
+
+    def count_segment(self, collection_id, segment):
+        """
+        Count the users in `segment`, for example
+        `AnswerSegment(q1, 'yes') & ~AnswerSegment(q3, 'no')`.
+        """
+        return self.query_segment(collection_id, segment)
+
+    def get_segment_users(self, collection_id, segment, offset=0,
+                          limit=100):
+        """
+        Return up to `limit` user ids in `segment`, skipping the first
+        `offset` in the order the users first answered.
+        """
+        return self.query_segment(collection_id, segment, offset=offset,
+                                  limit=limit)
+
     @Manager.calls_manager
     def get_results(self, collection_id):
         questions = yield self.get_questions(collection_id)
@@ -151,9 +971,38 @@ class ResultManager(object):
             results.append((question, result))
         returnValue(dict(results))
 
+    @Manager.calls_manager
+    def get_time_series(self, collection_id, question, start, end):
+        """
+        Return the answers given to `question` per rollup bucket between
+        the `start` and `end` timestamps as `[(bucket, {answer: count})]`,
+        oldest first. Buckets are identified by the timestamp they start
+        at. Needs a `rollup_interval`.
+        """
+        if not self.rollup_interval:
+            raise ResultManagerException('Rollups are not enabled.')
+        r_server = yield self.router.get_read_server()
+        question_id = yield self.get_question_id(collection_id, question)
+        answers = yield self.get_answers(collection_id, question)
+        series = []
+        bucket = self.get_bucket(start)
+        while bucket <= end:
+            counts = dict((answer, 0) for answer in answers)
+            fields = yield r_server.hgetall(
+                self.get_rollup_key(collection_id, question_id, bucket))
+            for field, value in fields.items():
+                answer = yield self.decode_answer(collection_id, question_id,
+                                                  field)
+                counts[answer] = counts.get(answer, 0) + int(value)
+            series.append((bucket, counts))
+            bucket += self.rollup_interval
+        returnValue(series)
+
     @Manager.calls_manager
     def get_results_for_question(self, collection_id, question):
-        results_key = self.get_results_key(collection_id, question)
+        r_server = yield self.router.get_read_server()
+        question_id = yield self.get_question_id(collection_id, question)
+        results_key = self.get_results_key(collection_id, question_id)
         answers = yield self.get_answers(collection_id, question)
         # If we've been given a list of possible answers, return the
         # full list of possible answers and automatically set 0
@@ -162,39 +1011,166 @@ class ResultManager(object):
         if answers:
             results = []
             for answer in answers:
-                if (yield self.r_server.hexists(results_key, answer)):
-                    result = yield self.r_server.hget(results_key, answer)
+                field = yield self.lookup_answer(collection_id, question_id,
+                                                 answer)
+                if field is None:
+                    # never given, so never counted
+                    result = 0
+                elif (yield r_server.hexists(results_key, field)):
+                    result = yield r_server.hget(results_key, field)
                 else:
                     result = 0
                 results.append((answer, int(result)))
             returnValue(dict(results))
         else:
-            results = yield self.r_server.hgetall(results_key)
+            results = yield r_server.hgetall(results_key)
             answers = []
-            for answer, value in results.items():
+            for field, value in results.items():
+                answer = yield self.decode_answer(collection_id, question_id,
+                                                  field)
                 answers.append((answer, int(value)))
             returnValue(dict(answers))
 
     @Manager.calls_manager
-    def get_users(self, collection_id, questions=None):
-        users_key = self.get_users_key(collection_id)
-        user_ids = yield self.r_server.smembers(users_key)
+    def get_users(self, collection_id, questions=None, since=None):
+        """
+        :param collection_id:   the collection to get the users of.
+        :param questions:       the questions to include answers for,
+                                defaults to all questions in the collection.
+        :param since:           if given, only users who answered a
+                                question after this UNIX timestamp are
+                                returned.
+        """
+        r_server = yield self.router.get_read_server()
+        if since is None:
+            users_key = self.get_users_key(collection_id)
+            user_ids = yield r_server.smembers(users_key)
+        else:
+            user_ids = yield self.get_updated_user_ids(collection_id, since)
         users = []
         for user_id in user_ids:
             user = yield self.get_user(collection_id, user_id, questions)
             users.append((user_id, user))
         returnValue(users)
 
+    @Manager.calls_manager
+    def get_updated_user_ids(self, collection_id, since):
+        """
+        Return the ids of the users who answered a question after the
+        UNIX timestamp `since`, oldest first.
+        """
+        r_server = yield self.router.get_read_server()
+        updated_key = self.get_updated_key(collection_id)
+        user_ids = yield r_server.zrangebyscore(
+            updated_key, '(%r' % (since,), '+inf')
+        returnValue(user_ids)
+
     @Manager.calls_manager
     def get_user(self, collection_id, user_id, questions=None):
+        r_server = yield self.router.get_read_server()
         answers_key = self.get_user_answers_key(collection_id, user_id)
         questions = questions or (yield self.get_questions(collection_id))
         user_results = []
         for question in questions:
-            answer = yield self.r_server.hget(answers_key, question)
+            question_id = yield self.get_question_id(collection_id, question)
+            answer = yield self.decode_answer(collection_id, question_id,
+                (yield r_server.hget(answers_key, question_id)))
             user_results.append((question, answer))
         returnValue(dict(user_results))
 
+    @Manager.calls_manager
+    def count_answers(self, collection_id, user_ids):
+        """
+        Count the answers `user_ids` gave straight from their answer
+        hashes, ignoring the counters in the results hashes.
+        Returns `{question: Counter({answer: count})}`.
+        """
+        r_server = yield self.router.get_read_server()
+        names = yield self.get_question_names(collection_id)
+        for question in names.values():
+            yield self.get_question_id(collection_id, question)
+        counts = {}
+        for user_id in user_ids:
+            answers_key = self.get_user_answers_key(collection_id, user_id)
+            user_answers = yield r_server.hgetall(answers_key)
+            for question_id, answer in user_answers.items():
+                question = names.get(question_id, to_unicode(question_id))
+                counter = counts.setdefault(question, Counter())
+                answer = yield self.decode_answer(collection_id, question_id,
+                                                  answer)
+                counter[to_unicode(answer)] += 1
+        returnValue(counts)
+
+    @Manager.calls_manager
+    def get_answer_matrix(self, collection_id, questions, chunk_size=1000):
+        """
+        Load the answers users gave to `questions` into a compact matrix.
+        The answers of `chunk_size` users are read concurrently and only
+        their answer codes are kept. Returns `(user_ids, coders, columns)`
+        where `coders` and `columns` map every question to its
+        `AnswerCoder` and to an array of answer codes, one per user in the
+        order of `user_ids`.
+        """
+        r_server = yield self.router.get_read_server()
+        coders = {}
+        columns = {}
+        question_ids = {}
+        answer_names = {}
+        for question in questions:
+            answers = yield self.get_answers(collection_id, question)
+            coders[question] = AnswerCoder(answers)
+            columns[question] = array('I')
+            question_id = yield self.get_question_id(collection_id, question)
+            question_ids[question] = to_unicode(question_id)
+            if self.is_coded(collection_id, question_id):
+                cache_key = (collection_id, question_id)
+                if cache_key not in self.answer_names:
+                    yield self.load_answer_codes(collection_id, question_id)
+                answer_names[question] = cache_key
+        users_key = self.get_users_key(collection_id)
+        user_ids = sorted(to_unicode(user_id) for user_id in
+                          (yield r_server.smembers(users_key)))
+        for start in range(0, len(user_ids), chunk_size):
+            # the users of a chunk are all read at once
+            chunk = yield gather([
+                r_server.hgetall(self.get_user_answers_key(collection_id,
+                                                           user_id))
+                for user_id in user_ids[start:start + chunk_size]])
+            chunk = [dict((to_unicode(q), to_unicode(a))
+                          for q, a in user_answers.items())
+                     for user_answers in chunk]
+            # decoded a column at a time, the answer codes are only
+            # reloaded when the chunk has codes handed out since
+            for question in questions:
+                values = [user_answers.get(question_ids[question])
+                          for user_answers in chunk]
+                cache_key = answer_names.get(question)
+                if cache_key is not None:
+                    names = self.answer_names[cache_key]
+                    if any(value not in names for value in values
+                           if value is not None):
+                        yield self.load_answer_codes(*cache_key)
+                        names = self.answer_names[cache_key]
+                    values = [names.get(value, value) for value in values]
+                encode = coders[question].encode
+                columns[question].extend(encode(value) for value in values)
+        returnValue((user_ids, coders, columns))
+
+    @Manager.calls_manager
+    def get_crosstab(self, collection_id, row_question, column_question,
+                     chunk_size=1000):
+        """
+        Break the answers to `column_question` down by the answers given
+        to `row_question`, returns `{row_answer: {column_answer: count}}`
+        for users that answered both questions.
+        """
+        questions = [row_question, column_question]
+        user_ids, coders, columns = yield self.get_answer_matrix(
+            collection_id, questions, chunk_size=chunk_size)
+        returnValue(count_crosstab(
+            coders[row_question], columns[row_question],
+            coders[column_question], columns[column_question]))
+
     @Manager.calls_manager
     def get_users_as_csv(self, collection_id):
         sio = StringIO()
@@ -239,6 +1215,11 @@ class ContextResultManager(object):
             'get_results',
             'get_results_for_question',
             'get_users',
+            'get_crosstab',
+            'count_segment',
+            'get_segment_users',
+            'count_respondents',
+            'get_time_series',
         ]
         for func_name in wrap_collection_ids:
             wrapped = partial(getattr(result_manager, func_name),
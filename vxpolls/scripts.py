@@ -0,0 +1,256 @@
+# -*- test-case-name: tests.test_manager -*-
+"""
+Lua scripts run server side by Redis, and publishing to its channels.
+
+vumi's redis managers don't expose `EVAL` or `PUBLISH`, both are sent
+with the manager's underlying client, the keys and channels prefixed
+the same way the manager prefixes keys. Scripts are run by their SHA1
+with `EVALSHA` so the source is only sent when Redis doesn't have it
+cached yet.
+"""
+import hashlib
+
+
+def get_channel(r_server, channel):
+    """
+    Return the name `channel` is published on, prefixed like `r_server`'s
+    keys.
+    """
+    return r_server._key(channel)
+
+
+def can_publish(r_server):
+    """
+    Return whether `r_server` is able to publish, the fake redis used in
+    tests isn't.
+    """
+    return callable(getattr(r_server._client, 'publish', None))
+
+
+def publish(r_server, channel, message):
+    """
+    Publish `message` on `r_server`'s `channel`.
+    """
+    return r_server._client.publish(get_channel(r_server, channel),
+                                    message)
+
+
+class LuaScript(object):
+
+    def __init__(self, source):
+        self.source = source
+        self.sha1 = hashlib.sha1(source).hexdigest()
+
+    def is_supported(self, r_server):
+        """
+        Return whether `r_server` is able to run scripts, the fake redis
+        used in tests isn't.
+        """
+        client = r_server._client
+        return (callable(getattr(client, 'eval', None)) and
+                callable(getattr(client, 'evalsha', None)))
+
+    def encode(self, value):
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    def __call__(self, r_server, keys, args):
+        # Imported here, it's only needed once there's a connection.
+        from vumi.persist.txredis_manager import TxRedisManager
+        keys = [self.encode(r_server._key(key)) for key in keys]
+        args = [self.encode(arg) for arg in args]
+        client = r_server._client
+        if isinstance(r_server, TxRedisManager):
+            from txredis.exceptions import NoScript
+
+            def send_source(failure):
+                failure.trap(NoScript)
+                return client.eval(self.source, keys, args)
+
+            d = client.evalsha(self.sha1, keys, args)
+            d.addErrback(send_source)
+            return d
+        from redis.exceptions import NoScriptError
+        try:
+            return client.evalsha(self.sha1, len(keys), *(keys + args))
+        except NoScriptError:
+            return client.eval(self.source, len(keys), *(keys + args))
+
+
+# KEYS: collections, questions, users, updated, user answers, results,
+#       session, change counter
+# ARGV: collection id, question, user id, timestamp, question id,
+#       answer, followed by the session's field & value pairs
+#
+# Returns 0, the previous answer, an empty string if there wasn't one,
+# and the number of the change once recorded, 0 if the answer is the
+# same, 1 for an unknown collection and 2 for an unknown question. The
+# change is numbered along with the counters so results read at any
+# point count exactly the changes numbered up to the counter.
+RECORD_ANSWER = LuaScript("""
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return {1}
+end
+if redis.call('SISMEMBER', KEYS[2], ARGV[2]) == 0 then
+    return {2}
+end
+redis.call('SADD', KEYS[3], ARGV[3])
+redis.call('ZADD', KEYS[4], ARGV[4], ARGV[3])
+local previous = redis.call('HGET', KEYS[5], ARGV[5])
+local seq = 0
+if not previous or previous == '' then
+    redis.call('HINCRBY', KEYS[6], ARGV[6], 1)
+    seq = redis.call('INCR', KEYS[8])
+elseif previous ~= ARGV[6] then
+    redis.call('HINCRBY', KEYS[6], ARGV[6], 1)
+    redis.call('HINCRBY', KEYS[6], previous, -1)
+    seq = redis.call('INCR', KEYS[8])
+end
+redis.call('HSET', KEYS[5], ARGV[5], ARGV[6])
+for index = 7, #ARGV, 2 do
+    redis.call('HSET', KEYS[7], ARGV[index], ARGV[index + 1])
+end
+return {0, previous or '', seq}
+""")
+
+
+# KEYS: the collection's and the day's respondent counts
+# ARGV: user id, seconds to keep the day's count for or 0 for forever
+ADD_RESPONDENT = LuaScript("""
+redis.call('PFADD', KEYS[1], ARGV[1])
+redis.call('PFADD', KEYS[2], ARGV[1])
+if tonumber(ARGV[2]) > 0 then
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+end
+return 0
+""")
+
+
+# KEYS: the respondent counts to count the union of
+COUNT_RESPONDENTS = LuaScript("""
+return redis.call('PFCOUNT', unpack(KEYS))
+""")
+
+
+# KEYS: session activity, session, offloaded sessions
+# ARGV: session key, the time before which sessions are idle, the
+#       session's offloaded copy or an empty string to only delete it
+#
+# Returns 1 once swept and 0 if the session was saved since it was
+# found to be idle.
+SWEEP_SESSION = LuaScript("""
+local score = redis.call('ZSCORE', KEYS[1], ARGV[1])
+if not score or tonumber(score) > tonumber(ARGV[2]) then
+    return 0
+end
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[3], ARGV[1], ARGV[3])
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[1], ARGV[1])
+return 1
+""")
+
+
+# KEYS: the collection's ordinal counter and ordinal users, followed by
+#       the respondent sets the segment is made of
+# ARGV: offset, limit or -1 to only count, followed by the segment as a
+#       postfix program of `KEYS` indexes (0 for an empty set), `&`, `|`
+#       and `~`
+#
+# Returns the number of users in the segment or the page of their ids.
+# Only reads so it can run on a replica. A negated set stands for
+# everyone but its members so `~` never builds the set of all users.
+SEGMENT = LuaScript("""
+local function load(token)
+    local members = {}
+    if token ~= '0' then
+        local key = KEYS[tonumber(token)]
+        for _, ordinal in ipairs(redis.call('SMEMBERS', key)) do
+            members[ordinal] = true
+        end
+    end
+    return members
+end
+
+local function combine(operator, a, b)
+    if operator == '|' then
+        local c = combine('&', {a[1], not a[2]}, {b[1], not b[2]})
+        return {c[1], not c[2]}
+    end
+    local members = {}
+    if a[2] and b[2] then
+        for ordinal in pairs(a[1]) do members[ordinal] = true end
+        for ordinal in pairs(b[1]) do members[ordinal] = true end
+        return {members, true}
+    end
+    if a[2] then
+        a, b = b, a
+    end
+    for ordinal in pairs(a[1]) do
+        if (b[1][ordinal] == nil) == b[2] then
+            members[ordinal] = true
+        end
+    end
+    return {members, false}
+end
+
+local stack = {}
+for index = 3, #ARGV do
+    local token = ARGV[index]
+    if token == '~' then
+        stack[#stack][2] = not stack[#stack][2]
+    elseif token == '&' or token == '|' then
+        local b = table.remove(stack)
+        local a = table.remove(stack)
+        table.insert(stack, combine(token, a, b))
+    else
+        table.insert(stack, {load(token), false})
+    end
+end
+local members, negated = stack[1][1], stack[1][2]
+local users = tonumber(redis.call('GET', KEYS[1]) or 0)
+local offset, limit = tonumber(ARGV[1]), tonumber(ARGV[2])
+
+if limit < 0 then
+    local size = 0
+    for _ in pairs(members) do
+        size = size + 1
+    end
+    if negated then
+        return users - size
+    end
+    return size
+end
+
+local page = {}
+if negated then
+    local skipped = 0
+    for ordinal = 0, users - 1 do
+        if #page >= limit then
+            break
+        end
+        if not members[tostring(ordinal)] then
+            if skipped < offset then
+                skipped = skipped + 1
+            else
+                table.insert(page, tostring(ordinal))
+            end
+        end
+    end
+else
+    local ordinals = {}
+    for ordinal in pairs(members) do
+        table.insert(ordinals, tonumber(ordinal))
+    end
+    table.sort(ordinals)
+    for index = offset + 1, math.min(offset + limit, #ordinals) do
+        table.insert(page, tostring(ordinals[index]))
+    end
+end
+if #page == 0 then
+    return {}
+end
+return redis.call('HMGET', KEYS[2], unpack(page))
+""")
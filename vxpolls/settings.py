@@ -150,5 +150,13 @@ LOGGING = {
 
 VXPOLLS_REDIS_CONFIG = {}
 VXPOLLS_PREFIX = 'poll_manager'
+# An optional read-only replica for the dashboard to read from, falling
+# back to VXPOLLS_REDIS_CONFIG when it lags more than the given seconds
+# behind. `None` never falls back.
+VXPOLLS_REPLICA_REDIS_CONFIG = None
+VXPOLLS_MAX_REPLICA_STALENESS = None
+# Redis configs, keyed by shard name, of the nodes poll results are
+# sharded across. Empty keeps results in VXPOLLS_REDIS_CONFIG.
+VXPOLLS_RESULT_SHARDS = {}
 
 TEST_RUNNER = 'django_nose.NoseTestSuiteRunner'
@@ -0,0 +1,189 @@
+# -*- test-case-name: tests.test_sharding -*-
+import hashlib
+
+from bisect import bisect
+from functools import partial
+
+from twisted.internet.defer import returnValue
+
+from vumi.persist.redis_base import Manager
+
+from vxpolls.results import ResultManager
+
+
+class HashRing(object):
+    """
+    Consistent hashing of keys onto named nodes. Every node is placed on
+    the ring `replicas` times so keys spread evenly, adding or removing a
+    node only moves the keys of that node.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        self.replicas = replicas
+        self.ring = sorted(
+            (self.hash('%s-%s' % (node, index)), node)
+            for node in nodes for index in range(replicas))
+        self.points = [point for point, node in self.ring]
+
+    def hash(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return int(hashlib.md5(key).hexdigest()[:16], 16)
+
+    def get_node(self, key):
+        if not self.ring:
+            raise ValueError('The hash ring has no nodes.')
+        index = bisect(self.points, self.hash(key)) % len(self.ring)
+        return self.ring[index][1]
+
+
+class ShardedResultManager(object):
+    """
+    Stores every result collection, including the answers of its users, on
+    one of several Redis nodes chosen by consistent hashing of the
+    collection id.
+
+    It has the same methods as `ResultManager`, the ones that take a
+    collection id are handed to the `ResultManager` of the collection's
+    shard and `get_collections` lists the collections of all shards.
+
+    The settings of `ResultManager`, such as `rollup_interval` and
+    `count_respondents_enabled`, are the same for every shard and are
+    available as attributes. Collections don't share a Redis server so
+    there's no `r_server`, use `get_r_server` instead.
+
+    :param dict shards:
+        Redis managers keyed by shard name. The names place the shards on
+        the hash ring so they have to stay the same when shards are
+        added or removed.
+    :param dict routers:
+        `ReplicaRouter` instances keyed by shard name, for the shards
+        that have a replica to read reports from. Every shard needs its
+        own so a single `router` isn't accepted.
+    """
+
+    # the methods of `ResultManager` that take a collection id first
+    routed_methods = [
+        'register_collection',
+        'get_r_server',
+        'get_read_server',
+        'get_collection_key',
+        'get_results_key',
+        'get_questions_key',
+        'get_answers_key',
+        'get_question_ids_key',
+        'get_question_names_key',
+        'get_question_counter_key',
+        'get_answer_codes_key',
+        'get_answer_counter_key',
+        'get_respondents_key',
+        'get_user_ordinals_key',
+        'get_ordinal_users_key',
+        'get_ordinal_counter_key',
+        'get_respondent_count_key',
+        'get_rollup_key',
+        'get_changes_channel',
+        'get_change_counter_key',
+        'get_users_key',
+        'get_updated_key',
+        'get_user_answers_key',
+        'get_questions',
+        'get_question_id',
+        'get_question_names',
+        'is_coded',
+        'load_answer_codes',
+        'lookup_answer',
+        'encode_answer',
+        'decode_answer',
+        'get_answers',
+        'register_question',
+        'add_result',
+        'get_user_ordinal',
+        'add_respondent',
+        'count_respondents',
+        'query_segment',
+        'count_segment',
+        'get_segment_users',
+        'get_results',
+        'get_results_for_question',
+        'get_time_series',
+        'get_change_seq',
+        'get_change_listeners',
+        'add_change_listener',
+        'remove_change_listener',
+        'publish_change',
+        'get_users',
+        'get_updated_user_ids',
+        'get_user',
+        'count_answers',
+        'get_answer_matrix',
+        'get_crosstab',
+        'get_users_as_csv',
+        'get_results_as_csv',
+    ]
+
+    # the settings of `ResultManager` that every shard shares
+    settings = [
+        'r_prefix',
+        'index_respondents',
+        'cluster_keys',
+        'count_respondents_enabled',
+        'daily_respondents_ttl',
+        'publish_changes',
+        'rollup_interval',
+        'rollup_retention',
+        'counter_flush_interval',
+    ]
+
+    def __init__(self, shards, r_prefix='results', routers=None, **kwargs):
+        if not shards:
+            raise ValueError('At least one shard is required.')
+        if 'router' in kwargs:
+            raise ValueError('Shards need a router each, use `routers`.')
+        routers = routers or {}
+        self.shards = shards
+        # create a manager attribute so the @calls_manager works
+        self.manager = shards[sorted(shards)[0]]
+        self.ring = HashRing(shards.keys())
+        self.result_managers = dict(
+            (name, ResultManager(r_server, r_prefix,
+                                 router=routers.get(name), **kwargs))
+            for name, r_server in shards.items())
+        result_manager = self.result_managers[sorted(shards)[0]]
+        for name in self.settings:
+            setattr(self, name, getattr(result_manager, name))
+        for method_name in self.routed_methods:
+            setattr(self, method_name, partial(self.route, method_name))
+
+    def get_shard_name(self, collection_id):
+        return self.ring.get_node(collection_id)
+
+    def get_result_manager(self, collection_id):
+        return self.result_managers[self.get_shard_name(collection_id)]
+
+    def route(self, method_name, collection_id, *args, **kwargs):
+        result_manager = self.get_result_manager(collection_id)
+        return getattr(result_manager, method_name)(
+            collection_id, *args, **kwargs)
+
+    def defaults(self, collection_id, user_id):
+        return self.get_result_manager(collection_id).defaults(
+            collection_id, user_id)
+
+    @Manager.calls_manager
+    def flush_counters(self):
+        for name in sorted(self.result_managers):
+            yield self.result_managers[name].flush_counters()
+
+    @Manager.calls_manager
+    def stop(self):
+        for name in sorted(self.result_managers):
+            yield self.result_managers[name].stop()
+
+    @Manager.calls_manager
+    def get_collections(self):
+        collections = set()
+        for name in sorted(self.result_managers):
+            collections.update(
+                (yield self.result_managers[name].get_collections()))
+        returnValue(collections)
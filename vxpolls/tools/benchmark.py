@@ -0,0 +1,196 @@
+# -*- test-case-name: tests.test_tools -*-
+import os
+import sys
+import time
+import json
+import subprocess
+
+from vxpolls.participant import (
+    PollParticipant, serialize_messages, compress, decompress)
+
+from twisted.python import usage
+
+
+class CodecBenchmark(object):
+    """
+    Compare the size of plain and compressed values as stored in Redis
+    against the time spent compressing and decompressing them.
+    """
+
+    stdout = sys.stdout
+
+    def __init__(self, questions=200, messages=50, rounds=100,
+                 threshold=0):
+        self.questions = questions
+        self.messages = messages
+        self.rounds = rounds
+        self.threshold = threshold
+
+    def mk_version(self):
+        return {
+            'batch_size': 5,
+            'questions': [{
+                'copy': 'Question %s? Please reply with one of the options '
+                        'below to let us know what you think.\n1. Yes\n'
+                        '2. No\n3. Maybe' % (index,),
+                'label': 'question-%s' % (index,),
+                'valid_responses': ['1', '2', '3'],
+                'checks': [['equal', 'question-%s' % (index - 1,), '1']],
+            } for index in range(self.questions)],
+        }
+
+    def mk_participant(self):
+        from vumi.message import TransportUserMessage
+        participant = PollParticipant('+27761234567')
+        for index in range(self.messages):
+            participant.add_received_message(TransportUserMessage(
+                to_addr='*120*1234#', from_addr='+27761234567',
+                transport_name='sphex', transport_type='ussd',
+                content=str(index % 3 + 1)))
+        participant.sent_messages = participant.received_messages[:]
+        return participant
+
+    def measure(self, name, json_data):
+        start = time.time()
+        for _ in range(self.rounds):
+            data = compress(json_data, self.threshold)
+        encode_time = (time.time() - start) / self.rounds
+        start = time.time()
+        for _ in range(self.rounds):
+            decompress(data)
+        decode_time = (time.time() - start) / self.rounds
+        return (name, len(json_data), len(data), encode_time, decode_time)
+
+    def run(self):
+        participant = self.mk_participant()
+        results = [
+            self.measure('poll version', json.dumps(self.mk_version())),
+            self.measure('message history',
+                         serialize_messages(participant.received_messages)),
+            self.measure('archived participant',
+                         json.dumps(participant.clean_dump())),
+        ]
+        self.stdout.write('%-22s %10s %10s %7s %11s %11s\n' % (
+            'value', 'plain (B)', 'stored (B)', 'saved', 'encode (ms)',
+            'decode (ms)'))
+        for name, plain, stored, encode_time, decode_time in results:
+            self.stdout.write('%-22s %10d %10d %6.1f%% %11.3f %11.3f\n' % (
+                name, plain, stored, 100.0 * (plain - stored) / plain,
+                encode_time * 1000, decode_time * 1000))
+        return results
+
+
+class ImportBenchmark(object):
+    """
+    Time importing modules in a fresh interpreter, the way a cron job
+    running one of the tools does, less the time it takes to start an
+    interpreter that imports nothing.
+    """
+
+    stdout = sys.stdout
+
+    DEFAULT_MODULES = [
+        'vxpolls',
+        'vxpolls.participant',
+        'vxpolls.results',
+        'vxpolls.manager',
+        'vxpolls.tools.exporter',
+        'vxpolls.tools.importer',
+    ]
+
+    def __init__(self, modules=None, rounds=5, python=sys.executable):
+        self.modules = modules or self.DEFAULT_MODULES
+        self.rounds = rounds
+        self.python = python
+        # The interpreter gets our sys.path so it finds the same modules,
+        # relative entries such as `PYTHONPATH=.` are resolved now in
+        # case the working directory changes.
+        self.path = [os.path.abspath(entry) for entry in sys.path]
+
+    def time_import(self, module=None):
+        """
+        Return the fastest time taken to import `module` and the number of
+        modules it loaded.
+        """
+        statement = ('import sys; loaded = len(sys.modules); '
+                     'import %s; print len(sys.modules) - loaded' % (
+                         module or 'sys',))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(self.path))
+        timings = []
+        for _ in range(self.rounds):
+            start = time.time()
+            output = subprocess.check_output(
+                [self.python, '-c', statement], env=env,
+                stderr=open(os.devnull, 'w'))
+            timings.append(time.time() - start)
+        return min(timings), int(output.split()[-1])
+
+    def run(self):
+        baseline, _ = self.time_import()
+        results = []
+        for module in self.modules:
+            elapsed, loaded = self.time_import(module)
+            results.append((module, max(elapsed - baseline, 0), loaded))
+        self.stdout.write('%-26s %11s %8s\n' % (
+            'module', 'import (ms)', 'modules'))
+        for module, elapsed, loaded in results:
+            self.stdout.write('%-26s %11.1f %8d\n' % (
+                module, elapsed * 1000, loaded))
+        return results
+
+
+class CodecOptions(usage.Options):
+
+    optParameters = [
+        ['questions', 'q', 200, 'Number of questions in the poll', int],
+        ['messages', 'm', 50, 'Number of messages in the history', int],
+        ['rounds', 'r', 100, 'Number of rounds to time', int],
+        ['threshold', 't', 0, 'The compress_threshold to use', int],
+    ]
+
+
+class ImportOptions(usage.Options):
+
+    optParameters = [
+        ['rounds', 'r', 5, 'Number of rounds to time', int],
+    ]
+
+    def parseArgs(self, *modules):
+        self['modules'] = list(modules)
+
+
+class Options(usage.Options):
+
+    subCommands = [
+        ['codec', None, CodecOptions,
+            'Benchmark compressed storage of versions and sessions'],
+        ['imports', None, ImportOptions,
+            'Benchmark the time it takes to import modules'],
+    ]
+
+    def postOptions(self):
+        if not self.subCommand:
+            raise usage.UsageError('Please provide a subcommand')
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    if options.subCommand == 'codec':
+        sub_options = options.subOptions
+        benchmark = CodecBenchmark(
+            questions=sub_options['questions'],
+            messages=sub_options['messages'],
+            rounds=sub_options['rounds'],
+            threshold=sub_options['threshold'])
+        benchmark.run()
+    elif options.subCommand == 'imports':
+        sub_options = options.subOptions
+        benchmark = ImportBenchmark(modules=sub_options['modules'],
+                                    rounds=sub_options['rounds'])
+        benchmark.run()
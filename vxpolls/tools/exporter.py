@@ -1,15 +1,45 @@
 # -*- test-case-name: tests.test_tools -*-
+import os
 import sys
-import yaml
+import time
 import json
 
 from datetime import datetime
 
-from vumi.persist.redis_manager import RedisManager
+from twisted.python import usage
 
-from vxpolls.manager import PollManager
 
-from twisted.python import usage
+SINCE_FORMATS = ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']
+
+
+def parse_since(value):
+    """
+    Parse a `--since` value given either as a UNIX timestamp or as a
+    local date & time into a UNIX timestamp.
+    """
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    for since_format in SINCE_FORMATS:
+        try:
+            return time.mktime(
+                datetime.strptime(value, since_format).timetuple())
+        except ValueError:
+            pass
+    raise ValueError('Unable to parse %r as a timestamp.' % (value,))
+
+
+def read_checkpoint(path):
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as fp:
+        return float(fp.read().strip())
+
+
+def write_checkpoint(path, timestamp):
+    with open(path, 'w') as fp:
+        fp.write('%r\n' % (timestamp,))
 
 
 class VxpollExporter(object):
@@ -17,11 +47,29 @@ class VxpollExporter(object):
     stdout = sys.stdout
 
     def __init__(self, config, serializer):
+        # Redis and the poll manager are imported when they're needed so
+        # that `--help` and bad options are reported without the cost of
+        # importing Twisted's reactor and vumi.
+        from vumi.persist.redis_manager import RedisManager
+        from vxpolls.manager import PollManager
         r_config = config.get('redis_manager', {})
         vxp_config = config.get('vxpolls', {})
         self.poll_prefix = vxp_config.get('prefix', 'poll_manager')
         self.r_server = self.manager = RedisManager.from_config(r_config)
-        self.pm = PollManager(self.r_server, self.poll_prefix)
+        read_server = None
+        if config.get('replica_redis_manager') is not None:
+            read_server = RedisManager.from_config(
+                config['replica_redis_manager'])
+        result_shards = dict(
+            (name, RedisManager.from_config(shard_config))
+            for name, shard_config in config.get('result_shards', {}).items())
+        self.pm = PollManager(
+            self.r_server, self.poll_prefix,
+            compress_threshold=vxp_config.get('compress_threshold'),
+            cluster_keys=vxp_config.get('cluster_keys', False),
+            read_server=read_server,
+            max_replica_staleness=vxp_config.get('max_replica_staleness'),
+            result_shards=result_shards or None)
         self.serializer = serializer
 
     def export(self, poll_id):
@@ -54,9 +102,16 @@ class ParticipantExporter(VxpollExporter):
         questions = [q['label'] for q in poll.questions]
         single_user_id = options.subOptions.get('user-id')
         skip_nones = options.subOptions.get('skip-nones')
+        checkpoint = options.subOptions.get('checkpoint')
+        since = options.subOptions.get('since')
+        if since is None and checkpoint:
+            since = read_checkpoint(checkpoint)
+        started_at = time.time()
 
         if single_user_id:
             msisdns = [single_user_id]
+        elif since is not None:
+            msisdns = self.get_updated_msisdns(poll, since)
         else:
             msisdns = self.get_msisdns(poll)
 
@@ -64,13 +119,17 @@ class ParticipantExporter(VxpollExporter):
             poll, msisdns)
 
         users = self.get_active_users(poll, active, questions,
-                                      label_key, labels, skip_nones)
+                                      label_key, labels, skip_nones,
+                                      since=since)
 
         if options.subOptions['include-archived']:
             users.extend(self.get_archived_users(poll, archived))
 
         self.serializer(users, self.stdout)
 
+        if checkpoint:
+            write_checkpoint(checkpoint, started_at)
+
     def is_archived(self, poll, user_id):
         # bloody multisurvey crap
         poll_id = poll.poll_id.split('_')[0]
@@ -89,15 +148,22 @@ class ParticipantExporter(VxpollExporter):
         return active, archived
 
     def get_msisdns(self, poll):
-        keys = self.r_server.keys('%s:poll:results:collections:%s*' % (
-            self.poll_prefix, poll.poll_id,))
+        results_manager = poll.results_manager
+        r_server = results_manager.get_read_server(poll.poll_id)
+        keys = r_server.keys('%s*' % (
+            results_manager.get_collection_key(poll.poll_id),))
         return set([key.split(':', 9)[-1] for key in keys])
 
+    def get_updated_msisdns(self, poll, since):
+        return set(poll.results_manager.get_updated_user_ids(
+            poll.poll_id, since))
+
     def get_active_users(self, poll, msisdns, questions, label_key, labels,
-                         skip_nones):
+                         skip_nones, since=None):
         poll_id = poll.poll_id
         users = [(user_id, user_data) for user_id, user_data in
-                 poll.results_manager.get_users(poll_id, questions)
+                 poll.results_manager.get_users(poll_id, questions,
+                                                since=since)
                  if user_id in msisdns]
         for user_id, user_data in users:
             # bloody multisurvey crap
@@ -176,6 +242,12 @@ class ExportParticipantOptions(usage.Options):
         ['extra-labels', 'l', None,
             'Any extra labels to extract (comma separated)'],
         ['user-id', None, None, 'Extract only for a single user'],
+        ['since', None, None,
+            'Only extract users who answered after this UNIX timestamp '
+            'or local YYYY-MM-DD[THH:MM:SS] time', parse_since],
+        ['checkpoint', None, None,
+            'Only extract users who answered since the time stored in '
+            'this file and store the time of this export in it'],
     ]
 
     optFlags = [
@@ -228,6 +300,7 @@ if __name__ == '__main__':
         print '%s: Try --help for usage details.' % (sys.argv[0])
         sys.exit(1)
 
+    import yaml
     config_file = options['config']
     config = yaml.safe_load(open(config_file, 'r'))
 
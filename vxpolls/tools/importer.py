@@ -1,10 +1,5 @@
 # -*- test-case-name: tests.test_tools -*-
 import sys
-import yaml
-
-from vumi.persist.redis_manager import RedisManager
-
-from vxpolls.manager import PollManager
 
 from twisted.python import usage
 
@@ -12,11 +7,16 @@ from twisted.python import usage
 class PollImporter(object):
 
     def __init__(self, config):
+        from vumi.persist.redis_manager import RedisManager
+        from vxpolls.manager import PollManager
         r_config = config.get('redis_manager', {})
         vxp_config = config.get('vxpolls', {})
         poll_prefix = vxp_config.get('prefix', 'poll_manager')
         self.r_server = self.manager = RedisManager.from_config(r_config)
-        self.pm = PollManager(self.r_server, poll_prefix)
+        self.pm = PollManager(
+            self.r_server, poll_prefix,
+            compress_threshold=vxp_config.get('compress_threshold'),
+            cluster_keys=vxp_config.get('cluster_keys', False))
 
     def import_config(self, poll_id, config, force=False):
         if poll_id in self.pm.polls() and not force:
@@ -50,6 +50,7 @@ if __name__ == '__main__':
         print '%s: Try --help for usage details.' % (sys.argv[0])
         sys.exit(1)
 
+    import yaml
     config_file = options['config']
     config = yaml.safe_load(open(config_file, 'r'))
 
@@ -0,0 +1,158 @@
+# -*- test-case-name: tests.test_tools -*-
+import sys
+
+from twisted.python import usage
+
+
+def escape_pattern(value):
+    """
+    Escape the glob characters in `value` for use in a `SCAN` pattern.
+    """
+    return ''.join('[%s]' % (char,) if char in '*?[' else char
+                   for char in value)
+
+
+class KeyMigrator(object):
+    """
+    Copies the keys of every poll and results collection from the plain
+    layout to the hash tagged layout used with `cluster_keys`, so that a
+    poll's keys end up in the same Redis Cluster slot.
+
+    The migration can be run again, keys that already exist in the new
+    layout are overwritten with the current data.
+    """
+
+    stdout = sys.stdout
+
+    # The per poll keys of `PollManager`, see `PollManager.get_poll_key`.
+    POLL_KEYS = ['versions', 'version_timestamps', 'label_users',
+                 'label_index', 'label_value', 'invitations']
+
+    def __init__(self, config):
+        from vumi.persist.redis_manager import RedisManager
+        from vxpolls.manager import PollManager
+        from vxpolls.results import ResultManager
+        r_config = config.get('redis_manager', {})
+        vxp_config = config.get('vxpolls', {})
+        poll_prefix = vxp_config.get('prefix', 'poll_manager')
+        self.r_server = self.manager = RedisManager.from_config(r_config)
+        self.pm = PollManager(self.r_server, poll_prefix)
+        self.cluster_pm = PollManager(self.r_server, poll_prefix,
+                                      cluster_keys=True)
+        results_prefix = self.pm.r_key('poll', 'results')
+        self.results_manager = ResultManager(self.r_server, results_prefix)
+        self.cluster_results_manager = ResultManager(
+            self.r_server, results_prefix, cluster_keys=True)
+
+    def stop(self):
+        self.pm.stop()
+        self.cluster_pm.stop()
+
+    def get_prefixes(self):
+        """
+        Return the old and new prefix of the keys of every poll and every
+        results collection.
+        """
+        prefixes = []
+        for poll_id in sorted(self.pm.polls()):
+            for name in self.POLL_KEYS:
+                prefixes.append((self.pm.get_poll_key(name, poll_id),
+                                 self.cluster_pm.get_poll_key(name, poll_id)))
+        for collection_id in sorted(self.results_manager.get_collections()):
+            prefixes.append((
+                self.results_manager.get_collection_key(collection_id),
+                self.cluster_results_manager.get_collection_key(
+                    collection_id)))
+        return prefixes
+
+    def scan_keys(self, prefix):
+        """
+        Return the key `prefix` and all keys under it.
+        """
+        keys = set()
+        match = '%s*' % (escape_pattern(prefix),)
+        cursor = None
+        while True:
+            cursor, batch = self.r_server.scan(cursor, match=match,
+                                               count=1000)
+            keys.update(key for key in batch
+                        if key == prefix or key.startswith(prefix + ':'))
+            if cursor is None:
+                break
+        return sorted(keys)
+
+    def copy_key(self, key, new_key):
+        key_type = self.r_server.type(key)
+        self.r_server.delete(new_key)
+        if key_type == 'string':
+            self.r_server.set(new_key, self.r_server.get(key))
+        elif key_type == 'hash':
+            self.r_server.hmset(new_key, self.r_server.hgetall(key))
+        elif key_type == 'set':
+            for member in self.r_server.smembers(key):
+                self.r_server.sadd(new_key, member)
+        elif key_type == 'zset':
+            self.r_server.zadd(new_key, **dict(
+                self.r_server.zrange(key, 0, -1, withscores=True)))
+        elif key_type == 'list':
+            for value in self.r_server.lrange(key, 0, -1):
+                self.r_server.rpush(new_key, value)
+        else:
+            raise ValueError('Unable to copy %r of type %r' % (key,
+                                                               key_type))
+        ttl = self.r_server.ttl(key)
+        if ttl > 0:
+            self.r_server.expire(new_key, ttl)
+
+    def migrate(self, delete=False, dry_run=False):
+        """
+        Copy every key to the new layout and return the number of keys
+        copied. With `delete` the old keys are removed once copied, with
+        `dry_run` the keys are only listed.
+        """
+        copied = 0
+        for prefix, new_prefix in self.get_prefixes():
+            for key in self.scan_keys(prefix):
+                new_key = new_prefix + key[len(prefix):]
+                self.stdout.write('%s -> %s\n' % (key, new_key))
+                if not dry_run:
+                    self.copy_key(key, new_key)
+                    if delete:
+                        self.r_server.delete(key)
+                copied += 1
+        return copied
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ["config", "u", None, "The config file to read"],
+    ]
+
+    optFlags = [
+        ["delete", "D", "Delete the old keys once they're copied"],
+        ["dry-run", "d", "Only print the keys that would be copied"],
+    ]
+
+    def postOptions(self):
+        if not self['config']:
+            raise usage.UsageError("Please specify --config")
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    import yaml
+    config_file = options['config']
+    config = yaml.safe_load(open(config_file, 'r'))
+
+    migrator = KeyMigrator(config)
+    copied = migrator.migrate(delete=options['delete'],
+                              dry_run=options['dry-run'])
+    migrator.stop()
+    print 'Copied %s keys' % (copied,)
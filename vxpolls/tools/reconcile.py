@@ -0,0 +1,219 @@
+# -*- test-case-name: tests.test_tools -*-
+import sys
+import time
+
+from collections import Counter
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, DeferredSemaphore)
+from twisted.internet.task import react
+from twisted.python import usage
+
+from vxpolls.results import to_unicode
+
+
+class ReconcileError(Exception):
+    pass
+
+
+class ResultReconciler(object):
+    """
+    Rebuilds the answer counters of a collection from the answers stored
+    for every user. Users are counted `chunk_size` at a time with up to
+    `concurrency` chunks in flight.
+
+    The counters are read before the users are counted and corrected
+    relative to what was read, so answers recorded after that are kept.
+    A count is only trusted if no user answered while it ran, otherwise
+    it's retried up to `attempts` times. Counters buffered in memory by
+    the poll applications aren't seen, don't reconcile while they are.
+
+    :param ResultManager results_manager:
+        The results manager to reconcile, it needs an asynchronous
+        redis manager.
+    :param float clock_skew:
+        How many seconds the clocks of the poll applications, which
+        timestamp answers, may be ahead of this one.
+    """
+
+    stdout = sys.stdout
+
+    def __init__(self, results_manager, chunk_size=1000, concurrency=10,
+                 attempts=3, clock_skew=5, clock=time.time):
+        self.results_manager = results_manager
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.attempts = attempts
+        self.clock_skew = clock_skew
+        self.clock = clock
+
+    @inlineCallbacks
+    def count(self, collection_id):
+        r_server = self.results_manager.get_r_server(collection_id)
+        users_key = self.results_manager.get_users_key(collection_id)
+        user_ids = sorted(to_unicode(user_id) for user_id in
+                          (yield r_server.smembers(users_key)))
+        semaphore = DeferredSemaphore(self.concurrency)
+        chunk_counts = yield gatherResults([
+            semaphore.run(self.results_manager.count_answers, collection_id,
+                          user_ids[start:start + self.chunk_size])
+            for start in range(0, len(user_ids), self.chunk_size)])
+        totals = {}
+        for counts in chunk_counts:
+            for question, counter in counts.items():
+                totals.setdefault(question, Counter()).update(counter)
+        returnValue(totals)
+
+    @inlineCallbacks
+    def get_counters(self, collection_id):
+        """
+        Return the stored counters as `{question: {answer: count}}`.
+        """
+        r_server = self.results_manager.get_r_server(collection_id)
+        questions = yield self.results_manager.get_questions(collection_id)
+        counters = {}
+        for question in questions:
+            question_id = yield self.results_manager.get_question_id(
+                collection_id, question)
+            results_key = self.results_manager.get_results_key(
+                collection_id, question_id)
+            fields = yield r_server.hgetall(results_key)
+            stored = counters[question] = {}
+            for field, count in fields.items():
+                answer = yield self.results_manager.decode_answer(
+                    collection_id, question_id, field)
+                stored[to_unicode(answer)] = int(count)
+        returnValue(counters)
+
+    @inlineCallbacks
+    def has_changed(self, collection_id, since):
+        """
+        Return whether any user answered a question after `since`.
+        """
+        r_server = self.results_manager.get_r_server(collection_id)
+        updated_key = self.results_manager.get_updated_key(collection_id)
+        user_ids = yield r_server.zrangebyscore(
+            updated_key, repr(since), '+inf', start=0, num=1)
+        returnValue(bool(user_ids))
+
+    @inlineCallbacks
+    def diff(self, collection_id):
+        """
+        Compare the stored counters with the counts from the users'
+        answers. Returns `{question: {answer: (stored, expected)}}` for
+        every counter that is wrong, `stored` being the counter as it was
+        before the users were counted.
+        """
+        for attempt in range(self.attempts):
+            since = self.clock() - self.clock_skew
+            counters = yield self.get_counters(collection_id)
+            totals = yield self.count(collection_id)
+            if not (yield self.has_changed(collection_id, since)):
+                break
+        else:
+            raise ReconcileError(
+                'Users of %s kept answering while they were counted, '
+                'try again when it is quieter.' % (collection_id,))
+        diff = {}
+        for question, stored in counters.items():
+            expected = totals.get(question, Counter())
+            for answer in set(stored) | set(expected):
+                if stored.get(answer, 0) != expected[answer]:
+                    diff.setdefault(question, {})[answer] = (
+                        stored.get(answer, 0), expected[answer])
+        returnValue(diff)
+
+    @inlineCallbacks
+    def reconcile(self, collection_id, dry_run=False):
+        """
+        Correct the counters that don't match the users' answers and
+        return the differences found, see `diff`. Counters are adjusted by
+        the difference so that answers recorded since they were read are
+        kept. With `dry_run` the counters are left as they are.
+        """
+        r_server = self.results_manager.get_r_server(collection_id)
+        diff = yield self.diff(collection_id)
+        for question, answers in sorted(diff.items()):
+            question_id = yield self.results_manager.get_question_id(
+                collection_id, question)
+            results_key = self.results_manager.get_results_key(
+                collection_id, question_id)
+            for answer, (stored, expected) in sorted(answers.items()):
+                self.stdout.write('%s: %s: %s -> %s\n' % (
+                    question.encode('utf-8'), answer.encode('utf-8'),
+                    stored, expected))
+                if not dry_run:
+                    field = yield self.results_manager.encode_answer(
+                        collection_id, question_id, answer)
+                    yield r_server.hincrby(results_key, field,
+                                           expected - stored)
+        returnValue(diff)
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ["config", "u", None, "The config file to read"],
+        ["poll-id", "p", None, "The poll-id to reconcile"],
+        ["chunk-size", "c", 1000, "How many users to count at a time", int],
+        ["concurrency", "n", 10, "How many chunks to count at once", int],
+    ]
+
+    optFlags = [
+        ["dry-run", "d", "Only print the counters that are wrong"],
+    ]
+
+    def postOptions(self):
+        if not (self['config'] and self['poll-id']):
+            raise usage.UsageError(
+                "Please specify both --config and --poll-id")
+
+
+@inlineCallbacks
+def main(reactor, options):
+    import yaml
+    from vumi.persist.txredis_manager import TxRedisManager
+    from vxpolls.manager import PollManager
+    from vxpolls.results import ResultManager
+    from vxpolls.sharding import ShardedResultManager
+    config = yaml.safe_load(open(options['config'], 'r'))
+    vxp_config = config.get('vxpolls', {})
+    poll_prefix = vxp_config.get('prefix', 'poll_manager')
+    r_server = yield TxRedisManager.from_config(
+        config.get('redis_manager', {}))
+    result_shards = {}
+    for name, shard_config in config.get('result_shards', {}).items():
+        result_shards[name] = yield TxRedisManager.from_config(shard_config)
+    cluster_keys = vxp_config.get('cluster_keys', False)
+    pm = PollManager(r_server, poll_prefix, cluster_keys=cluster_keys)
+    # Not `pm.get`, setting up a poll registers its questions and
+    # a dry run mustn't write anything.
+    if not (yield pm.get_config(options['poll-id'])):
+        raise usage.UsageError('Unknown poll %r' % (options['poll-id'],))
+    results_prefix = pm.r_key('poll', 'results')
+    if result_shards:
+        results_manager = ShardedResultManager(
+            result_shards, results_prefix, cluster_keys=cluster_keys)
+    else:
+        results_manager = ResultManager(r_server, results_prefix,
+                                        cluster_keys=cluster_keys)
+    reconciler = ResultReconciler(results_manager,
+                                  chunk_size=options['chunk-size'],
+                                  concurrency=options['concurrency'])
+    yield reconciler.reconcile(options['poll-id'],
+                               dry_run=options['dry-run'])
+    yield pm.stop()
+    for shard in result_shards.values():
+        yield shard.close_manager()
+    yield r_server.close_manager()
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    react(main, [options])
@@ -0,0 +1,258 @@
+# -*- test-case-name: tests.test_tools -*-
+import os
+import sys
+import json
+import mmap
+
+from array import array
+from itertools import chain
+
+from vxpolls.results import AnswerCoder, ResultManager, count_crosstab
+from vxpolls.sharding import ShardedResultManager
+
+from twisted.python import usage
+
+
+META_FILE = 'meta.json'
+USERS_FILE = 'users.txt'
+USERS_INDEX_FILE = 'users.idx'
+CODE_TYPE = 'I'
+
+
+def map_file(path):
+    """
+    Memory-map the file at `path` read-only. Empty files can't be mapped
+    so an empty string is returned for those instead.
+    """
+    with open(path, 'rb') as fp:
+        if not os.fstat(fp.fileno()).st_size:
+            return ''
+        return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def write_array(path, values):
+    with open(path, 'wb') as fp:
+        values.tofile(fp)
+
+
+def write_snapshot(path, collection_id, user_ids, coders, columns):
+    """
+    Write an answer matrix as returned by
+    `ResultManager.get_answer_matrix` to the directory at `path`.
+
+    Every question gets a file of raw answer codes, user ids are stored
+    one per line with an index of their offsets and the answers the codes
+    stand for are kept in `meta.json`.
+
+    :param str path: The directory to write to, created if missing.
+    :param str collection_id: The collection the answers came from.
+    :param list user_ids: The user ids, in row order.
+    :param dict coders: The `AnswerCoder` for every question.
+    :param dict columns: The array of answer codes for every question.
+    """
+    if not os.path.isdir(path):
+        os.makedirs(path)
+
+    offsets = array(CODE_TYPE, [0])
+    with open(os.path.join(path, USERS_FILE), 'wb') as fp:
+        for user_id in user_ids:
+            fp.write(user_id.encode('utf-8') + '\n')
+            offsets.append(fp.tell())
+    write_array(os.path.join(path, USERS_INDEX_FILE), offsets)
+
+    questions = []
+    for index, question in enumerate(sorted(columns)):
+        file_name = 'column-%s.codes' % (index,)
+        write_array(os.path.join(path, file_name),
+                    array(CODE_TYPE, columns[question]))
+        questions.append({
+            'question': question,
+            'file': file_name,
+            'answers': coders[question].answers[1:],
+        })
+
+    with open(os.path.join(path, META_FILE), 'wb') as fp:
+        json.dump({
+            'collection_id': collection_id,
+            'rows': len(user_ids),
+            'typecode': CODE_TYPE,
+            'itemsize': array(CODE_TYPE).itemsize,
+            'byteorder': sys.byteorder,
+            'questions': questions,
+        }, fp)
+
+
+class SnapshotColumn(object):
+    """
+    A memory-mapped array of answer codes, read in chunks on demand.
+    """
+
+    def __init__(self, path, typecode, swap=False):
+        self.data = map_file(path)
+        self.typecode = typecode
+        self.itemsize = array(typecode).itemsize
+        self.swap = swap
+
+    def __len__(self):
+        return len(self.data) / self.itemsize
+
+    def __getitem__(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return self.get_chunk(index, 1)[0]
+
+    def get_chunk(self, start, size):
+        codes = array(self.typecode)
+        codes.fromstring(self.data[start * self.itemsize:
+                                   (start + size) * self.itemsize])
+        if self.swap:
+            codes.byteswap()
+        return codes
+
+    def iter_chunks(self, chunk_size=65536):
+        for start in range(0, len(self), chunk_size):
+            yield self.get_chunk(start, chunk_size)
+
+    def __iter__(self):
+        return chain.from_iterable(self.iter_chunks())
+
+
+class Snapshot(object):
+    """
+    Read access to a snapshot written by `write_snapshot`. Columns are
+    memory-mapped so scanning them doesn't load the whole snapshot.
+
+    :param str path: The snapshot directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'rb') as fp:
+            self.meta = json.load(fp)
+        self.collection_id = self.meta['collection_id']
+        self.rows = self.meta['rows']
+        if array(self.meta['typecode']).itemsize != self.meta['itemsize']:
+            raise ValueError('Snapshot %r was written with a different '
+                             'item size.' % (path,))
+        swap = self.meta['byteorder'] != sys.byteorder
+        self.coders = {}
+        self.columns = {}
+        for entry in self.meta['questions']:
+            question = entry['question']
+            self.coders[question] = AnswerCoder()
+            for answer in entry['answers']:
+                self.coders[question].encode(answer)
+            self.columns[question] = SnapshotColumn(
+                os.path.join(path, entry['file']), self.meta['typecode'],
+                swap)
+        self.users = map_file(os.path.join(path, USERS_FILE))
+        self.user_offsets = SnapshotColumn(
+            os.path.join(path, USERS_INDEX_FILE), self.meta['typecode'],
+            swap)
+
+    @property
+    def questions(self):
+        return [entry['question'] for entry in self.meta['questions']]
+
+    def get_user_id(self, index):
+        start, end = self.user_offsets.get_chunk(index, 2)
+        return self.users[start:end - 1].decode('utf-8')
+
+    def iter_user_ids(self):
+        for index in range(self.rows):
+            yield self.get_user_id(index)
+
+    def iter_answers(self, question):
+        coder = self.coders[question]
+        for code in self.columns[question]:
+            yield coder.decode(code)
+
+    def get_crosstab(self, row_question, column_question):
+        return count_crosstab(
+            self.coders[row_question], self.columns[row_question],
+            self.coders[column_question], self.columns[column_question])
+
+
+class PollSnapshotter(object):
+
+    def __init__(self, config):
+        from vumi.persist.redis_manager import RedisManager
+        from vxpolls.manager import PollManager
+        r_config = config.get('redis_manager', {})
+        vxp_config = config.get('vxpolls', {})
+        self.poll_prefix = vxp_config.get('prefix', 'poll_manager')
+        self.r_server = RedisManager.from_config(r_config)
+        read_server = None
+        if config.get('replica_redis_manager') is not None:
+            read_server = RedisManager.from_config(
+                config['replica_redis_manager'])
+        result_shards = dict(
+            (name, RedisManager.from_config(shard_config))
+            for name, shard_config in config.get('result_shards', {}).items())
+        self.pm = PollManager(
+            self.r_server, self.poll_prefix,
+            compress_threshold=vxp_config.get('compress_threshold'),
+            cluster_keys=vxp_config.get('cluster_keys', False),
+            read_server=read_server,
+            max_replica_staleness=vxp_config.get('max_replica_staleness'),
+            result_shards=result_shards or None)
+
+    def get_results_manager(self):
+        results_prefix = self.pm.r_key('poll', 'results')
+        if self.pm.result_shards:
+            return ShardedResultManager(
+                self.pm.result_shards, results_prefix,
+                routers=self.pm.result_routers,
+                cluster_keys=self.pm.cluster_keys)
+        return ResultManager(self.r_server, results_prefix,
+                             cluster_keys=self.pm.cluster_keys,
+                             router=self.pm.router)
+
+    def snapshot(self, poll_id, path, chunk_size=1000):
+        # Not `pm.get`, setting up a poll registers its questions and
+        # taking a snapshot mustn't write anything.
+        if not self.pm.get_config(poll_id):
+            raise usage.UsageError('Unknown poll %r' % (poll_id,))
+        results_manager = self.get_results_manager()
+        questions = results_manager.get_questions(poll_id)
+        user_ids, coders, columns = results_manager.get_answer_matrix(
+            poll_id, questions, chunk_size=chunk_size)
+        write_snapshot(path, poll_id, user_ids, coders, columns)
+        return len(user_ids)
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ["config", "u", None, "The config file to read"],
+        ["poll-id", "p", None, "The poll-id to snapshot"],
+        ["path", "d", None, "The directory to write the snapshot to"],
+        ["chunk-size", "c", 1000, "How many users to read at a time", int],
+    ]
+
+    def postOptions(self):
+        if not (self['config'] and self['poll-id'] and self['path']):
+            raise usage.UsageError(
+                "Please specify --config, --poll-id and --path")
+
+if __name__ == '__main__':
+    options = Options()
+    try:
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    import yaml
+    config_file = options['config']
+    config = yaml.safe_load(open(config_file, 'r'))
+
+    snapshotter = PollSnapshotter(config)
+    try:
+        rows = snapshotter.snapshot(options['poll-id'], options['path'],
+                                    chunk_size=options['chunk-size'])
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        sys.exit(1)
+    print 'Wrote %s rows to %s' % (rows, options['path'])